@@ -0,0 +1,71 @@
+import asyncio
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+"""
+Asyncio engine that keeps up to `concurrency` translation calls in flight.
+
+The translator calls are blocking, so each one runs on a thread of a shared
+executor while the event loop only hands out work and collects results.
+Results always come back in input order.
+
+Every process has one engine: an event loop running on its own thread, a
+semaphore of `concurrency` request slots and the executor. They live as long
+as the process, so the threads, the keep-alive connections the backends keep
+per thread and the slots are shared by every unit. Several units translated
+at once by one worker (see `Scheduler(unit_threads=...)`) all draw from the
+same slots, so a worker keeps `concurrency` requests in flight however few
+requests each unit makes, and a unit waiting on its slowest request does not
+hold the others back.
+"""
+
+
+class Engine:
+    def __init__(self, concurrency):
+        self.concurrency = concurrency
+        self.pid = os.getpid()
+        self.executor = ThreadPoolExecutor(max_workers=concurrency)
+        self.loop = asyncio.new_event_loop()
+        threading.Thread(target=self.loop.run_forever, daemon=True).start()
+        # Made on the loop's thread, older Pythons bind a semaphore to the loop it is created on
+        self.slots = asyncio.run_coroutine_threadsafe(make_slots(concurrency), self.loop).result()
+
+    def map_ordered(self, fn, items):
+        # Block the calling thread until every item is done
+        future = asyncio.run_coroutine_threadsafe(map_ordered(fn, items, self.slots, self.executor), self.loop)
+        return future.result()
+
+
+# Engine of the current process, made on first use so forked workers get their own
+_engine = None
+_engine_lock = threading.Lock()
+
+
+def shared_engine(concurrency):
+    global _engine
+    with _engine_lock:
+        if _engine is None or _engine.pid != os.getpid() or _engine.concurrency < concurrency:
+            _engine = Engine(concurrency)
+        return _engine
+
+
+async def make_slots(concurrency):
+    return asyncio.Semaphore(concurrency)
+
+
+async def map_ordered(fn, items, slots, executor=None):
+    loop = asyncio.get_running_loop()
+
+    async def call(item):
+        async with slots:
+            return await loop.run_in_executor(executor, fn, item)
+
+    return await asyncio.gather(*(call(item) for item in items))
+
+
+def run_ordered(fn, items, concurrency=64):
+    items = list(items)
+    if not items:
+        return []
+    return shared_engine(concurrency).map_ordered(fn, items)
@@ -0,0 +1,139 @@
+import http.client
+import json
+import os
+import threading
+from urllib.parse import urlsplit
+
+"""
+Translator backends.
+
+Every backend translates one text with `translate` and a list of texts with
+`translate_batch`, and raises on failure so the caller can retry. The
+googletrans backend talks to Google through an optional proxy; the HTTP
+backend talks to any service speaking the small JSON protocol of
+stub_server.py, which is what offline benchmarks run against. PooledBackend
+spreads the calls of either over the endpoints of a proxy_pool.ProxyPool.
+"""
+
+
+class TranslatorBackend:
+    name = 'base'
+
+    def translate(self, text, src='en', dest='vi'):
+        raise NotImplementedError
+
+    def translate_batch(self, texts, src='en', dest='vi'):
+        return [self.translate(text, src, dest) for text in texts]
+
+
+class GoogletransBackend(TranslatorBackend):
+    name = 'google'
+
+    def __init__(self, proxy=None):
+        import httpx
+        from googletrans import Translator
+        # raise_exception: a throttled call must fail instead of returning the source text
+        self.translator = Translator(raise_exception=True)
+        if proxy:
+            # googletrans swaps client.proxies in after building its httpx client, where httpx
+            # expects transports, not URLs. Let httpx build them; 'all' also covers the https
+            # URLs googletrans calls.
+            self.translator.client.proxies = httpx.Client(proxies={'all': proxy}).proxies
+
+    def translate(self, text, src='en', dest='vi'):
+        return self.translator.translate(text, src=src, dest=dest).text
+
+    def translate_batch(self, texts, src='en', dest='vi'):
+        return [translated.text for translated in self.translator.translate(texts, src=src, dest=dest)]
+
+
+class HttpBackend(TranslatorBackend):
+    # POST {"q": [...], "source": src, "target": dest} -> {"translations": [...]}
+    name = 'http'
+
+    def __init__(self, url, timeout=60, proxy=None):
+        self.url = url
+        self.timeout = timeout
+        self.proxy = proxy
+        parts = urlsplit(url)
+        self.host = parts.hostname
+        self.port = parts.port or 80
+        self.path = parts.path or '/'
+        self._local = threading.local()
+
+    def _connection(self):
+        # Keep-alive connection per thread and per process
+        local = self._local
+        if getattr(local, 'conn', None) is None or local.pid != os.getpid():
+            if self.proxy:
+                proxy = urlsplit(self.proxy)
+                local.conn = http.client.HTTPConnection(proxy.hostname, proxy.port or 80, timeout=self.timeout)
+            else:
+                local.conn = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+            local.pid = os.getpid()
+        return local.conn
+
+    def translate(self, text, src='en', dest='vi'):
+        return self.translate_batch([text], src, dest)[0]
+
+    def translate_batch(self, texts, src='en', dest='vi'):
+        body = json.dumps({'q': list(texts), 'source': src, 'target': dest}).encode('utf-8')
+        # Through a proxy the request line carries the absolute URL
+        path = self.url if self.proxy else self.path
+        conn = self._connection()
+        try:
+            conn.request('POST', path, body, {'Content-Type': 'application/json'})
+            response = conn.getresponse()
+            payload = response.read()
+        except (http.client.HTTPException, OSError):
+            conn.close()
+            self._local.conn = None
+            raise
+        if response.status != 200:
+            raise Exception(f'Unexpected status code "{response.status}" from {self.url}')
+        translations = json.loads(payload)['translations']
+        if len(translations) != len(texts):
+            raise Exception(f'{self.url} returned {len(translations)} translations for {len(texts)} texts')
+        return translations
+
+
+class PooledBackend(TranslatorBackend):
+    # Every call goes through the best endpoint of the pool, with one backend per endpoint
+    name = 'pooled'
+
+    def __init__(self, pool, factory):
+        self.pool = pool
+        self.factory = factory
+        self._backends = {}
+        self._lock = threading.Lock()
+
+    def _backend(self, endpoint):
+        # Built lazily, so each worker process has its own connections
+        key = (os.getpid(), endpoint.url)
+        with self._lock:
+            if key not in self._backends:
+                self._backends[key] = self.factory(endpoint.proxy)
+            return self._backends[key]
+
+    def translate(self, text, src='en', dest='vi'):
+        return self.translate_batch([text], src, dest)[0]
+
+    def translate_batch(self, texts, src='en', dest='vi'):
+        with self.pool.endpoint() as endpoint:
+            return self._backend(endpoint).translate_batch(texts, src, dest)
+
+
+# Privoxy in front of Tor, see the Dockerfile
+DEFAULT_GOOGLE_PROXY = 'http://localhost:8118'
+
+
+def make_backend(name, url=None, proxy=None, pool=None):
+    # proxy None picks the backend default, 'direct' forces a direct connection
+    if pool is not None:
+        return PooledBackend(pool, lambda endpoint_proxy: make_backend(name, url, endpoint_proxy))
+    if name == 'google':
+        proxy = DEFAULT_GOOGLE_PROXY if proxy is None else proxy
+        return GoogletransBackend(proxy if proxy != 'direct' else None)
+    if name == 'http':
+        return HttpBackend(url, proxy=proxy if proxy != 'direct' else None)
+    raise ValueError(f'unknown translator backend: {name}')
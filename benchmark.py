@@ -0,0 +1,224 @@
+import argparse
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+import stub_server
+
+"""
+End-to-end throughput benchmark of p3_translated.py on synthetic P3-shaped corpora.
+
+Each profile writes a small mixture of tasks shaped like a family of P3
+tasks, starts a stub translator with injected latency and runs the whole
+read -> translate -> write pipeline against it in a subprocess. The report
+has examples/s, requests/s and characters/s, p50/p99 service latency (the
+time the stub spent on a request, not what the client waited), peak RSS and
+CPU time of the run, and goes to a JSON file so runs can be compared. CPU
+time is the total of the main process and its workers, also given as the
+mean per process; the split between workers is not measured.
+
+Commands:
+python3 benchmark.py --examples 2000 --latency-ms 100 --output bench_results.json
+python3 benchmark.py --profiles template_reuse --workers 4 -- --engine async --concurrency 16
+Arguments after -- are passed to p3_translated.py unchanged.
+"""
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+WORDS = ('the of and to in a is that for it as was with be by on not he this are or his from at which '
+         'but have an they you were her she there been one all we their has would when if so no will '
+         'more can about said market city team film review season company people year government '
+         'product quality service story police music family school report water energy').split()
+LABELS = ['positive', 'negative', 'World', 'Sports', 'Business', 'Sci/Tech', 'Yes', 'No']
+TEMPLATES = [
+    ('Answer the following question about this review.\n{text}\nIs this review positive or negative?', '{label}'),
+    ('{text}\n\nDid the reviewer enjoy the product? Yes or No?', '{label}'),
+    ('Here is an article:\n{text}\nWhat is a summary of it?', '{summary}'),
+    ('Read the text below and pick the best topic.\n\n{text}\n\nOptions:\n- World\n- Sports\n- Business\n- Sci/Tech',
+     '{label}'),
+]
+
+
+def sentence(rng, low=6, high=28):
+    words = [rng.choice(WORDS) for _ in range(rng.randint(low, high))]
+    return ' '.join(words).capitalize() + rng.choice('..!?')
+
+
+def paragraph(rng, sentences):
+    return ' '.join(sentence(rng) for _ in range(sentences))
+
+
+def document(rng, chars):
+    paragraphs = []
+    while sum(len(p) for p in paragraphs) < chars:
+        paragraphs.append(paragraph(rng, rng.randint(2, 8)))
+    return '\n\n'.join(paragraphs)
+
+
+def short_classification(rng, examples):
+    # ag_news / amazon_polarity / imdb *_Yes_No: a sentence or two in, a label out
+    rows = []
+    for _ in range(examples):
+        text = paragraph(rng, max(1, int(rng.lognormvariate(0.8, 0.6))))
+        rows.append({'inputs': TEMPLATES[0][0].format(text=text), 'targets': rng.choice(LABELS[:2])})
+    return {'bench_short_classification': rows}
+
+
+def long_summarization(rng, examples):
+    # cnn_dailymail / multi_news / xsum: thousands of characters in, a few sentences out
+    rows = []
+    for _ in range(examples):
+        text = document(rng, int(rng.lognormvariate(8.3, 0.5)))
+        rows.append({'inputs': TEMPLATES[2][0].format(text=text), 'targets': paragraph(rng, rng.randint(1, 3))})
+    return {'bench_long_summarization': rows}
+
+
+def template_reuse(rng, examples):
+    # Several prompt templates over the same source texts, like the nine cnn_dailymail variants
+    per_task = max(1, examples // len(TEMPLATES))
+    sources = [(paragraph(rng, rng.randint(1, 6)), rng.choice(LABELS), sentence(rng)) for _ in range(per_task)]
+    tasks = {}
+    for t, (inputs, targets) in enumerate(TEMPLATES):
+        tasks[f'bench_template_reuse_{t}'] = [
+            {'inputs': inputs.format(text=text), 'targets': targets.format(label=label, summary=summary)}
+            for text, label, summary in sources]
+    return tasks
+
+
+PROFILES = {
+    'short_classification': short_classification,
+    'long_summarization': long_summarization,
+    'template_reuse': template_reuse,
+}
+
+
+def write_corpus(workdir, tasks, split):
+    chars = 0
+    for task_name, rows in tasks.items():
+        with open(os.path.join(workdir, f'p3_{task_name}_{split}.jsonl'), 'w', encoding='utf-8') as fp:
+            for row in rows:
+                fp.write(json.dumps(row, ensure_ascii=False) + '\n')
+                chars += len(row['inputs']) + len(row['targets'])
+    with open(os.path.join(workdir, 'task_list.txt'), 'w') as fp:
+        for task_name in tasks:
+            fp.write("%s\n" %task_name)
+    return chars
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q / 100 * (len(values) - 1))))]
+
+
+def run_profile(name, args, extra_args):
+    rng = random.Random(args.seed)
+    tasks = PROFILES[name](rng, args.examples)
+    examples = sum(len(rows) for rows in tasks.values())
+    server = stub_server.serve(latency_ms=args.latency_ms, latency_sigma=args.latency_sigma,
+                               error_rate=args.error_rate, rate_limit=args.rate_limit, seed=args.seed)
+    try:
+        with tempfile.TemporaryDirectory(prefix=f'bench_{name}_') as workdir:
+            source_chars = write_corpus(workdir, tasks, args.split)
+            command = [sys.executable, os.path.join(HERE, 'p3_translated.py'),
+                       '--path', 'task_list.txt', '--split', args.split,
+                       '--backend', 'http', '--backend-url', stub_server.server_url(server),
+                       '--workers', str(args.workers), '--rate', str(args.rate), '--max-rate', str(args.rate)]
+            command += extra_args
+            with open(os.path.join(workdir, 'stderr.txt'), 'w+') as errfile:
+                started = time.monotonic()
+                process = subprocess.Popen(command, cwd=workdir, stdout=subprocess.DEVNULL, stderr=errfile)
+                # wait4 gives the usage of the run and of the worker processes it reaped
+                _, status, usage = os.wait4(process.pid, 0)
+                wall = time.monotonic() - started
+                process.returncode = os.waitstatus_to_exitcode(status)
+                errfile.seek(0)
+                stderr = errfile.read()
+        with urllib.request.urlopen(stub_server.server_url(server, '/stats')) as response:
+            stats = json.load(response)
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    latencies = stats['latencies']
+    cpu = usage.ru_utime + usage.ru_stime
+    return {
+        'profile': name,
+        'tasks': len(tasks),
+        'examples': examples,
+        'source_chars': source_chars,
+        'exit_code': process.returncode,
+        'stderr_tail': stderr[-2000:] if process.returncode else '',
+        'wall_seconds': round(wall, 3),
+        'examples_per_second': round(examples / wall, 2),
+        'requests': stats['requests'],
+        'requests_per_second': round(stats['requests'] / wall, 2),
+        'chars_sent': stats['chars'],
+        'chars_per_second': round(stats['chars'] / wall, 1),
+        'source_chars_per_second': round(source_chars / wall, 1),
+        'errors': stats['errors'],
+        'throttled': stats['throttled'],
+        # measured by the stub, so it leaves out queueing and transfer on the client side
+        'service_latency_p50_ms': round(percentile(latencies, 50) * 1000, 2) if latencies else None,
+        'service_latency_p99_ms': round(percentile(latencies, 99) * 1000, 2) if latencies else None,
+        # ru_maxrss is in KiB on Linux: the largest process, main or worker
+        'peak_rss_mib': round(usage.ru_maxrss / 1024, 1),
+        'cpu_seconds': round(cpu, 3),
+        # wait4 only gives the sum over the main process and its workers
+        'cpu_seconds_per_process': round(cpu / (args.workers + 1), 3),
+    }
+
+
+def parse_args():
+    argv = sys.argv[1:]
+    extra_args = []
+    if '--' in argv:
+        extra_args = argv[argv.index('--') + 1:]
+        argv = argv[:argv.index('--')]
+    parser = argparse.ArgumentParser(description='Benchmark p3_translated.py against a stub translator')
+    parser.add_argument('--profiles', nargs='+', default=list(PROFILES), choices=list(PROFILES))
+    parser.add_argument('--examples', default=2000, type=int, help='examples per profile')
+    parser.add_argument('--split', default='train')
+    parser.add_argument('--workers', default=8, type=int)
+    parser.add_argument('--rate', default=1000.0, type=float, help='requests per second allowed by the client')
+    parser.add_argument('--latency-ms', default=100.0, type=float)
+    parser.add_argument('--latency-sigma', default=0.5, type=float)
+    parser.add_argument('--error-rate', default=0.0, type=float)
+    parser.add_argument('--rate-limit', default=0.0, type=float, help='stub requests per second before 429')
+    parser.add_argument('--seed', default=0, type=int)
+    parser.add_argument('--output', default='bench_results.json')
+    return parser.parse_args(argv), extra_args
+
+
+def main():
+    args, extra_args = parse_args()
+    results = []
+    for name in args.profiles:
+        result = run_profile(name, args, extra_args)
+        print(f"{name}: {result['examples_per_second']} examples/s, {result['requests_per_second']} requests/s, "
+              f"service p50 {result['service_latency_p50_ms']} ms, p99 {result['service_latency_p99_ms']} ms, "
+              f"peak RSS {result['peak_rss_mib']} MiB")
+        results.append(result)
+    report = {
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'config': vars(args),
+        'p3_translated_args': extra_args,
+        'results': results,
+    }
+    with open(args.output, 'w') as fp:
+        json.dump(report, fp, indent=2)
+    print(f'Write benchmark results to {args.output}')
+
+
+if __name__ == '__main__':
+    main()
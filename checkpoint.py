@@ -0,0 +1,81 @@
+import json
+import os
+import time
+
+"""
+Example-level checkpoint journal of one task.
+
+Every finished work unit appends one line that maps the offsets of its
+examples to their translated records. The journal is flushed on every append
+and fsynced at most every `sync_interval` seconds, so a crash loses at most a
+few seconds of work. A line cut short by a crash is ignored when the journal
+is loaded again. The file is only created by the first append, so a task
+that never translated anything leaves no journal behind.
+"""
+
+
+def checkpoint_path(task_name, split):
+    return f'{task_name}_{split}.checkpoint.jsonl'
+
+
+class CheckpointJournal:
+    def __init__(self, path, sync_interval=5.0):
+        self.path = path
+        self.sync_interval = sync_interval
+        self._file = None
+        self._synced = time.monotonic()
+
+    def load(self):
+        # Return {example offset: record} of everything journaled so far
+        done = {}
+        if not os.path.exists(self.path):
+            return done
+        with open(self.path, 'r', encoding='utf-8') as fp:
+            for line in fp:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # torn write at the end of the journal
+                    continue
+                for offset, record in entry['records'].items():
+                    done[int(offset)] = record
+        return done
+
+    def done_offsets(self):
+        return set(self.load())
+
+    def open(self, resume=False):
+        # A fresh run drops the journal of an earlier one; the file is opened on the first append
+        if not resume and os.path.exists(self.path):
+            os.remove(self.path)
+
+    def _open_file(self):
+        self._file = open(self.path, 'a', encoding='utf-8')
+        if self._file.tell() > 0:
+            # Start on a fresh line after a torn write
+            with open(self.path, 'rb') as fp:
+                fp.seek(-1, os.SEEK_END)
+                if fp.read(1) != b'\n':
+                    self._file.write('\n')
+
+    def append(self, records):
+        # `records` maps example offsets to translated records
+        if not records:
+            return
+        if self._file is None:
+            self._open_file()
+        self._file.write(json.dumps({'records': records}, ensure_ascii=False) + '\n')
+        self._file.flush()
+        if time.monotonic() - self._synced >= self.sync_interval:
+            os.fsync(self._file.fileno())
+            self._synced = time.monotonic()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def remove(self):
+        self.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
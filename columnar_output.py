@@ -0,0 +1,239 @@
+import hashlib
+import json
+import os
+import shutil
+
+"""
+Sharded columnar output of translated tasks.
+
+A task is written to a directory of size-bounded shards in the Arrow IPC
+stream format or in Parquet. Rows are buffered into record batches (Parquet
+row groups) of `batch_rows` rows and a new shard is started once the current
+one reaches `max_shard_bytes`. The shards are written to `{path}.tmp`;
+closing the writer renames them to `data-00000-of-0000N.{arrow,parquet}`,
+writes `index.json` with the rows, bytes and first row of every shard and
+only then moves the directory over an existing output at `path`.
+
+Row n is example n of the task: a failed example is a row of nulls until
+`patch_shards` writes its translation, rewriting only the shards it touches.
+
+Arrow output also gets the `state.json` and `dataset_info.json` files of
+`datasets.Dataset.save_to_disk`, so `datasets.load_from_disk(path)` memory-maps
+it without parsing anything. Parquet output loads with
+`datasets.load_dataset('parquet', data_files=f'{path}/*.parquet')`.
+
+pyarrow is only needed for these formats and is imported when a writer is created.
+"""
+
+COLUMNS = ['inputs', 'targets', 'source_inputs', 'source_targets', 'task']
+EXTENSIONS = {'arrow': 'arrow', 'parquet': 'parquet'}
+MAX_SHARD_BYTES = 500 * 1024 * 1024
+
+
+def columnar_path(task_name, split):
+    return f'p3_translated_{task_name}_{split}'
+
+
+def shard_name(index, total, fmt):
+    return f'data-{index:05d}-of-{total:05d}.{EXTENSIONS.get(fmt, fmt)}'
+
+
+class ShardedWriter:
+    def __init__(self, path, fmt='arrow', max_shard_bytes=MAX_SHARD_BYTES, batch_rows=1000):
+        if fmt not in EXTENSIONS:
+            raise ValueError(f'unknown columnar format: {fmt}')
+        import pyarrow
+        self.pa = pyarrow
+        self.schema = pyarrow.schema([(column, pyarrow.string()) for column in COLUMNS])
+        self.path = path
+        self.fmt = fmt
+        self.max_shard_bytes = max_shard_bytes
+        self.batch_rows = batch_rows
+        self.rows = {column: [] for column in COLUMNS}
+        self.buffered = 0
+        # [file name, rows, bytes] of every shard closed so far
+        self.shards = []
+        self._sink = None
+        self._writer = None
+        self._shard_rows = 0
+        # An existing output stays in place until close()
+        self.tmp_path = path + '.tmp'
+        if os.path.exists(self.tmp_path):
+            shutil.rmtree(self.tmp_path)
+        os.makedirs(self.tmp_path)
+
+    def write(self, record):
+        for column in COLUMNS:
+            self.rows[column].append(record.get(column))
+        self.buffered += 1
+        if self.buffered >= self.batch_rows:
+            self.flush()
+
+    def flush(self):
+        # Write the buffered rows as one record batch, then roll the shard over if it is full
+        if not self.buffered:
+            return 0
+        batch = self.pa.record_batch([self.pa.array(self.rows[column], self.pa.string()) for column in COLUMNS],
+                                     schema=self.schema)
+        if self._writer is None:
+            self._open_shard()
+        if self.fmt == 'parquet':
+            self._writer.write_table(self.pa.Table.from_batches([batch]))
+        else:
+            self._writer.write_batch(batch)
+        self._shard_rows += self.buffered
+        written = self.buffered
+        self.rows = {column: [] for column in COLUMNS}
+        self.buffered = 0
+        if self._sink.tell() >= self.max_shard_bytes:
+            self._close_shard()
+        return written
+
+    def _open_shard(self):
+        name = f'shard-{len(self.shards):05d}.tmp'
+        self._sink, self._writer = open_shard(self.pa, os.path.join(self.tmp_path, name), self.fmt, self.schema)
+        self.shards.append([name, 0, 0])
+
+    def _close_shard(self):
+        self._writer.close()
+        self.shards[-1][1] = self._shard_rows
+        self.shards[-1][2] = self._sink.tell()
+        self._sink.close()
+        self._writer = None
+        self._sink = None
+        self._shard_rows = 0
+
+    def close(self, info=None):
+        self.flush()
+        if self._writer is None and not self.shards:
+            # an empty dataset still gets one (empty) shard
+            self._open_shard()
+        if self._writer is not None:
+            self._close_shard()
+        total = len(self.shards)
+        index = []
+        offset = 0
+        for i, (name, rows, size) in enumerate(self.shards):
+            final = shard_name(i, total, self.fmt)
+            os.replace(os.path.join(self.tmp_path, name), os.path.join(self.tmp_path, final))
+            index.append({'filename': final, 'rows': rows, 'bytes': size, 'offset': offset})
+            offset += rows
+        write_index(self.tmp_path, self.fmt, index, info)
+        replace_dir(self.tmp_path, self.path)
+        return offset
+
+    def abort(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._sink.close()
+            self._writer = None
+        shutil.rmtree(self.tmp_path, ignore_errors=True)
+
+
+def replace_dir(src, dst):
+    # Move a finished directory over `dst`; the old one is only deleted once the new one is in place
+    old = dst + '.old'
+    if os.path.exists(old):
+        shutil.rmtree(old)
+    if os.path.exists(dst):
+        os.rename(dst, old)
+    os.rename(src, dst)
+    shutil.rmtree(old, ignore_errors=True)
+
+
+def write_index(path, fmt, index, info=None):
+    # index.json, plus the save_to_disk files for arrow; `index` has filename, rows, bytes and offset per shard
+    _dump(path, 'index.json', {'format': fmt, 'columns': COLUMNS, 'num_rows': sum(shard['rows'] for shard in index),
+                               'shards': index})
+    if fmt == 'arrow':
+        info = info or {}
+        features = {column: {'dtype': 'string', '_type': 'Value'} for column in COLUMNS}
+        _dump(path, 'dataset_info.json', dict(info, features=features))
+        _dump(path, 'state.json', {
+            '_data_files': [{'filename': shard['filename']} for shard in index],
+            '_fingerprint': hashlib.sha1(json.dumps(index).encode('utf-8')).hexdigest()[:16],
+            '_format_columns': None,
+            '_format_kwargs': {},
+            '_format_type': None,
+            '_output_all_columns': False,
+            '_split': info.get('split'),
+        })
+
+
+def _dump(path, name, payload):
+    with open(os.path.join(path, name), 'w') as fp:
+        json.dump(payload, fp, indent=2)
+
+
+def open_shard(pa, path, fmt, schema):
+    sink = pa.OSFile(path, 'wb')
+    if fmt == 'parquet':
+        import pyarrow.parquet
+        return sink, pyarrow.parquet.ParquetWriter(sink, schema)
+    # save_to_disk writes the stream format, which load_from_disk memory-maps
+    return sink, pa.ipc.new_stream(sink, schema)
+
+
+def read_shard(pa, path, fmt):
+    if fmt == 'parquet':
+        import pyarrow.parquet
+        return pyarrow.parquet.read_table(path)
+    with pa.memory_map(path) as source:
+        return pa.ipc.open_stream(source).read_all()
+
+
+def iter_columnar(path, batch_rows=1000):
+    # Rows of a sharded output as dicts, one record batch in memory at a time
+    import pyarrow
+    with open(os.path.join(path, 'index.json')) as fp:
+        index = json.load(fp)
+    for shard in index['shards']:
+        shard_path = os.path.join(path, shard['filename'])
+        if index['format'] == 'parquet':
+            import pyarrow.parquet
+            batches = pyarrow.parquet.ParquetFile(shard_path).iter_batches(batch_size=batch_rows)
+            for batch in batches:
+                yield from batch.to_pylist()
+            continue
+        with pyarrow.memory_map(shard_path) as source:
+            for batch in pyarrow.ipc.open_stream(source):
+                yield from batch.to_pylist()
+
+
+def patch_shards(path, patches):
+    # Overwrite rows {row: record} in place, return how many were written
+    import pyarrow
+    with open(os.path.join(path, 'index.json')) as fp:
+        index = json.load(fp)
+    fmt = index['format']
+    patched = 0
+    for shard in index['shards']:
+        rows = {row - shard['offset']: record for row, record in patches.items()
+                if shard['offset'] <= row < shard['offset'] + shard['rows']}
+        if not rows:
+            continue
+        shard_path = os.path.join(path, shard['filename'])
+        table = read_shard(pyarrow, shard_path, fmt)
+        columns = {column: table.column(column).to_pylist() for column in COLUMNS}
+        for row, record in rows.items():
+            for column in COLUMNS:
+                if column in record:
+                    columns[column][row] = record[column]
+        del table
+        schema = pyarrow.schema([(column, pyarrow.string()) for column in COLUMNS])
+        sink, writer = open_shard(pyarrow, shard_path + '.tmp', fmt, schema)
+        table = pyarrow.table({column: pyarrow.array(columns[column], pyarrow.string()) for column in COLUMNS},
+                              schema=schema)
+        if fmt == 'parquet':
+            writer.write_table(table)
+        else:
+            for batch in table.to_batches(max_chunksize=1000):
+                writer.write_batch(batch)
+        writer.close()
+        shard['bytes'] = sink.tell()
+        sink.close()
+        os.replace(shard_path + '.tmp', shard_path)
+        patched += len(rows)
+    with open(os.path.join(path, 'index.json'), 'w') as fp:
+        json.dump(index, fp, indent=2)
+    return patched
@@ -0,0 +1,425 @@
+import argparse
+import http.client
+import json
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlencode, urlsplit
+
+import dead_letters
+
+"""
+Lease-based coordinator for translating tasks on several machines.
+
+`init` cuts every (task, split) input file into units of `unit_size` examples
+and stores their example and byte offsets in a SQLite file. Workers
+(`p3_translated.py --coordinator SPEC`) lease a unit for `lease_seconds`, read
+its examples from their own copy of the inputs, translate them and report
+the records back. Workers renew their leases while a unit is in flight. The
+lease of a crashed worker expires and the unit is leased again.
+
+Results are exactly-once: a unit's records are written in the same
+transaction that marks it done, and only the first report of a unit is
+kept, whichever lease it comes from. A worker whose lease expired can still
+complete the unit if it reports before the new holder; the new holder's
+report is then dropped.
+Failed examples go to the dead-letter table of the same file, so
+`--replay-failures --dead-letters coordinator.db` works on the exported
+outputs.
+
+SPEC is the path of the SQLite file, when every worker can reach it on a
+shared file system, or the URL of `coordinator.py serve`, a small HTTP
+front end over that file.
+
+Commands:
+python3 coordinator.py init --db coordinator.db --path task_list.txt --split train validation --unit-size 256
+python3 coordinator.py serve --db coordinator.db --port 8700
+python3 coordinator.py status --coordinator http://coordinator-host:8700
+python3 p3_translated.py --coordinator http://coordinator-host:8700 --workers 8
+python3 p3_translated.py --coordinator coordinator.db --export --output-format arrow
+"""
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tasks (
+    task TEXT NOT NULL,
+    split TEXT NOT NULL,
+    examples INTEGER NOT NULL,
+    units INTEGER NOT NULL,
+    error TEXT,
+    exported INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (task, split)
+);
+CREATE TABLE IF NOT EXISTS units (
+    id INTEGER PRIMARY KEY,
+    task TEXT NOT NULL,
+    split TEXT NOT NULL,
+    start INTEGER NOT NULL,
+    count INTEGER NOT NULL,
+    byte_offset INTEGER NOT NULL,
+    state TEXT NOT NULL DEFAULT 'pending',
+    owner TEXT,
+    token INTEGER NOT NULL DEFAULT 0,
+    expires REAL NOT NULL DEFAULT 0,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    failed INTEGER NOT NULL DEFAULT 0,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS units_state ON units (state, expires);
+CREATE INDEX IF NOT EXISTS units_task ON units (task, split);
+CREATE TABLE IF NOT EXISTS results (
+    task TEXT NOT NULL,
+    split TEXT NOT NULL,
+    example INTEGER NOT NULL,
+    record TEXT NOT NULL,
+    PRIMARY KEY (task, split, example)
+);
+"""
+
+# A unit whose worker fails it this many times is given up, its task stays incompleted
+MAX_ATTEMPTS = 5
+
+
+def unit_offsets(path, unit_size):
+    # (first example, examples, byte offset) of every unit of an input file
+    units = []
+    offset = 0
+    start = 0
+    count = 0
+    with open(path, 'rb') as fp:
+        for line in fp:
+            if line.strip():
+                if count == 0:
+                    unit_offset = offset
+                count += 1
+                if count == unit_size:
+                    units.append((start, count, unit_offset))
+                    start += count
+                    count = 0
+            offset += len(line)
+    if count:
+        units.append((start, count, unit_offset))
+    return units
+
+
+def read_unit(task_name, split, byte_offset, count):
+    examples = []
+    with open(f'p3_{task_name}_{split}.jsonl', 'r', encoding='utf-8') as json_file:
+        json_file.seek(byte_offset)
+        for json_str in json_file:
+            if json_str.strip():
+                examples.append(list(json.loads(json_str).values()))
+                if len(examples) == count:
+                    break
+    return examples
+
+
+class Coordinator:
+    def __init__(self, path, timeout=60):
+        self.path = path
+        self.timeout = timeout
+        self._local = threading.local()
+        self._connect()
+
+    def _connect(self):
+        local = self._local
+        if getattr(local, 'conn', None) is None or local.pid != os.getpid():
+            # Transactions are started by hand, BEGIN IMMEDIATE takes the write lock up front
+            conn = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.executescript(SCHEMA + dead_letters.SCHEMA)
+            local.conn = conn
+            local.pid = os.getpid()
+        return local.conn
+
+    @contextmanager
+    def _transaction(self):
+        conn = self._connect()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield conn
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+
+    def add_task(self, task_name, split, unit_size=256):
+        # Cut a task into units, once; return its number of units or None when it is already known
+        with self._transaction() as conn:
+            if conn.execute('SELECT 1 FROM tasks WHERE task = ? AND split = ?', (task_name, split)).fetchone():
+                return None
+            try:
+                units = unit_offsets(f'p3_{task_name}_{split}.jsonl', unit_size)
+                error = None
+            except OSError as err:
+                units, error = [], f'{type(err).__name__}: {err}'
+            conn.execute('INSERT INTO tasks (task, split, examples, units, error) VALUES (?, ?, ?, ?, ?)',
+                         (task_name, split, sum(count for _, count, _ in units), len(units), error))
+            conn.executemany('INSERT INTO units (task, split, start, count, byte_offset) VALUES (?, ?, ?, ?, ?)',
+                             [(task_name, split, start, count, byte_offset) for start, count, byte_offset in units])
+        return len(units)
+
+    def lease(self, owner, lease_seconds=600.0):
+        # A pending or expired unit, {'wait': seconds} while every unit left is leased, None when all are done
+        now = time.time()
+        with self._transaction() as conn:
+            row = conn.execute(
+                "SELECT id, task, split, start, count, byte_offset, token FROM units "
+                "WHERE state = 'pending' OR (state = 'leased' AND expires < ?) ORDER BY id LIMIT 1", (now,)).fetchone()
+            if row is None:
+                expires = conn.execute("SELECT MIN(expires) FROM units WHERE state = 'leased'").fetchone()[0]
+                return None if expires is None else {'wait': max(0.0, expires - now)}
+            unit_id, task_name, split, start, count, byte_offset, token = row
+            conn.execute("UPDATE units SET state = 'leased', owner = ?, token = ?, expires = ?, attempts = attempts + 1 "
+                         "WHERE id = ?", (owner, token + 1, now + lease_seconds, unit_id))
+        return {'id': unit_id, 'task': task_name, 'split': split, 'start': start, 'count': count,
+                'byte_offset': byte_offset, 'token': token + 1}
+
+    def heartbeat(self, unit_id, token, lease_seconds=600.0):
+        # False once the lease was taken over, the unit may still be completed
+        with self._transaction() as conn:
+            cursor = conn.execute("UPDATE units SET expires = ? WHERE id = ? AND token = ? AND state = 'leased'",
+                                  (time.time() + lease_seconds, unit_id, token))
+        return cursor.rowcount == 1
+
+    def complete(self, unit_id, token, records, failures=()):
+        # Store the records of a unit, only for the first report of it. Return whether they were kept.
+        # The token is not checked: a report from an expired lease is as good as any while the unit is open.
+        with self._transaction() as conn:
+            row = conn.execute('SELECT task, split, start, state FROM units WHERE id = ?', (unit_id,)).fetchone()
+            if row is None or row[3] in ('done', 'error'):
+                return False
+            task_name, split, start, _ = row
+            conn.executemany('INSERT OR REPLACE INTO results (task, split, example, record) VALUES (?, ?, ?, ?)',
+                             [(task_name, split, start + i, json.dumps(record, ensure_ascii=False))
+                              for i, record in enumerate(records)])
+            dead_letters.insert_rows(conn, failures)
+            conn.execute("UPDATE units SET state = 'done', failed = ?, owner = NULL WHERE id = ?",
+                         (sum(1 for record in records if not record), unit_id))
+        return True
+
+    def fail(self, unit_id, token, error):
+        # Give a unit back after a worker error, or give it up after MAX_ATTEMPTS
+        with self._transaction() as conn:
+            conn.execute("UPDATE units SET state = CASE WHEN attempts >= ? THEN 'error' ELSE 'pending' END, "
+                         "expires = 0, owner = NULL, error = ? WHERE id = ? AND token = ? AND state = 'leased'",
+                         (MAX_ATTEMPTS, error, unit_id, token))
+
+    def status(self):
+        conn = self._connect()
+        tasks = []
+        for task_name, split, examples, units, error, exported in conn.execute(
+                'SELECT task, split, examples, units, error, exported FROM tasks ORDER BY rowid'):
+            states = dict(conn.execute('SELECT state, COUNT(*) FROM units WHERE task = ? AND split = ? GROUP BY state',
+                                       (task_name, split)).fetchall())
+            failed = conn.execute('SELECT COALESCE(SUM(failed), 0) FROM units WHERE task = ? AND split = ?',
+                                  (task_name, split)).fetchone()[0]
+            tasks.append({'task': task_name, 'split': split, 'examples': examples, 'units': units,
+                          'done': states.get('done', 0), 'leased': states.get('leased', 0),
+                          'pending': states.get('pending', 0), 'error_units': states.get('error', 0),
+                          'failed_examples': failed, 'error': error, 'exported': bool(exported)})
+        return tasks
+
+    def finished(self):
+        # Tasks not exported yet whose units are all done or given up
+        return [task for task in self.status()
+                if not task['exported'] and task['done'] + task['error_units'] == task['units']]
+
+    def results(self, task_name, split):
+        # Records of a task in example order
+        conn = self._connect()
+        for example, record in conn.execute('SELECT example, record FROM results WHERE task = ? AND split = ? '
+                                            'ORDER BY example', (task_name, split)):
+            yield example, json.loads(record)
+
+    def mark_exported(self, task_name, split):
+        with self._transaction() as conn:
+            conn.execute('UPDATE tasks SET exported = 1 WHERE task = ? AND split = ?', (task_name, split))
+
+
+class CoordinatorHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, payload, status=200):
+        body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        coordinator = self.server.coordinator
+        parts = urlsplit(self.path)
+        if parts.path == '/status':
+            self._reply(coordinator.status())
+        elif parts.path == '/finished':
+            self._reply(coordinator.finished())
+        elif parts.path == '/results':
+            query = parse_qs(parts.query)
+            # One JSON line per example, without holding the task in memory
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/x-ndjson')
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            for example, record in coordinator.results(query['task'][0], query['split'][0]):
+                line = (json.dumps([example, record], ensure_ascii=False) + '\n').encode('utf-8')
+                self.wfile.write(b'%x\r\n%s\r\n' % (len(line), line))
+            self.wfile.write(b'0\r\n\r\n')
+        else:
+            self._reply({'error': 'not found'}, 404)
+
+    def do_POST(self):
+        coordinator = self.server.coordinator
+        request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+        path = urlsplit(self.path).path
+        if path == '/lease':
+            self._reply(coordinator.lease(request['owner'], request['lease_seconds']))
+        elif path == '/heartbeat':
+            self._reply(coordinator.heartbeat(request['id'], request['token'], request['lease_seconds']))
+        elif path == '/complete':
+            self._reply(coordinator.complete(request['id'], request['token'], request['records'],
+                                             request.get('failures', [])))
+        elif path == '/fail':
+            self._reply(coordinator.fail(request['id'], request['token'], request['error']))
+        elif path == '/exported':
+            self._reply(coordinator.mark_exported(request['task'], request['split']))
+        else:
+            self._reply({'error': 'not found'}, 404)
+
+
+def serve(path, host='0.0.0.0', port=8700):
+    server = ThreadingHTTPServer((host, port), CoordinatorHandler)
+    server.daemon_threads = True
+    server.coordinator = Coordinator(path)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+class HttpCoordinator:
+    # Same methods as Coordinator, through `coordinator.py serve`
+    def __init__(self, url, timeout=120):
+        self.url = url.rstrip('/')
+        parts = urlsplit(self.url)
+        self.host = parts.hostname
+        self.port = parts.port or 80
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _call(self, method, path, payload=None):
+        local = self._local
+        if getattr(local, 'conn', None) is None or local.pid != os.getpid():
+            local.conn = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+            local.pid = os.getpid()
+        body = json.dumps(payload, ensure_ascii=False).encode('utf-8') if payload is not None else None
+        try:
+            local.conn.request(method, path, body, {'Content-Type': 'application/json'})
+            response = local.conn.getresponse()
+        except (http.client.HTTPException, OSError):
+            local.conn.close()
+            local.conn = None
+            raise
+        if response.status != 200:
+            raise Exception(f'Unexpected status code "{response.status}" from {self.url}{path}')
+        return response
+
+    def _json(self, method, path, payload=None):
+        return json.loads(self._call(method, path, payload).read())
+
+    def lease(self, owner, lease_seconds=600.0):
+        return self._json('POST', '/lease', {'owner': owner, 'lease_seconds': lease_seconds})
+
+    def heartbeat(self, unit_id, token, lease_seconds=600.0):
+        return self._json('POST', '/heartbeat', {'id': unit_id, 'token': token, 'lease_seconds': lease_seconds})
+
+    def complete(self, unit_id, token, records, failures=()):
+        return self._json('POST', '/complete', {'id': unit_id, 'token': token, 'records': records,
+                                                'failures': list(failures)})
+
+    def fail(self, unit_id, token, error):
+        return self._json('POST', '/fail', {'id': unit_id, 'token': token, 'error': error})
+
+    def status(self):
+        return self._json('GET', '/status')
+
+    def finished(self):
+        return self._json('GET', '/finished')
+
+    def results(self, task_name, split):
+        response = self._call('GET', '/results?' + urlencode({'task': task_name, 'split': split}))
+        for line in response:
+            example, record = json.loads(line)
+            yield example, record
+
+    def mark_exported(self, task_name, split):
+        return self._json('POST', '/exported', {'task': task_name, 'split': split})
+
+
+def connect(spec):
+    if spec.startswith('http://'):
+        return HttpCoordinator(spec)
+    return Coordinator(spec)
+
+
+def format_status(tasks):
+    lines = [f'{"task":<60} {"split":<10} {"examples":>9} {"units":>6} {"done":>6} {"leased":>6} {"failed":>7}']
+    for task in tasks:
+        if task['error']:
+            lines.append(f'{task["task"]:<60} {task["split"]:<10} {task["error"]}')
+            continue
+        lines.append(f'{task["task"]:<60} {task["split"]:<10} {task["examples"]:>9} {task["units"]:>6} '
+                     f'{task["done"]:>6} {task["leased"]:>6} {task["failed_examples"]:>7}'
+                     + (' exported' if task['exported'] else ''))
+    units = sum(task['units'] for task in tasks)
+    done = sum(task['done'] for task in tasks)
+    lines.append(f'{done}/{units} units done')
+    return '\n'.join(lines)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Coordinator of distributed translation runs')
+    commands = parser.add_subparsers(dest='command', required=True)
+    init = commands.add_parser('init', help='cut the tasks of a task list into units')
+    init.add_argument('--db', default='coordinator.db')
+    init.add_argument('--path', default='task_list.txt')
+    init.add_argument('--split', nargs='+', default=['train'])
+    init.add_argument('--unit-size', default=256, type=int, help='examples per leased unit')
+    server = commands.add_parser('serve', help='serve the coordinator over HTTP')
+    server.add_argument('--db', default='coordinator.db')
+    server.add_argument('--host', default='0.0.0.0')
+    server.add_argument('--port', default=8700, type=int)
+    status = commands.add_parser('status', help='print the progress of every task')
+    status.add_argument('--coordinator', default='coordinator.db', help='SQLite file or http:// URL')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    if args.command == 'init':
+        coordinator = Coordinator(args.db)
+        with open(args.path) as fp:
+            task_list = [line.strip() for line in fp if line.strip()]
+        for split in args.split:
+            for task_name in task_list:
+                units = coordinator.add_task(task_name, split, args.unit_size)
+                if units is not None:
+                    print(f'Added {task_name} ({split}): {units} units')
+    elif args.command == 'serve':
+        server = serve(args.db, args.host, args.port)
+        print(f'Coordinator listening on http://{args.host}:{server.server_address[1]}')
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            server.shutdown()
+    else:
+        print(format_status(connect(args.coordinator).status()))
+
+
+if __name__ == '__main__':
+    main()
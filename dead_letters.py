@@ -0,0 +1,116 @@
+import os
+import sqlite3
+import threading
+import time
+
+"""
+Dead-letter store of examples whose translation failed.
+
+Every field of a failed example gets a row keyed by (task, split, example
+offset, field) with its source text, its translation when that field did
+succeed, and the error class and message when it did not. The rows are what
+`p3_translated.py --replay-failures` translates again and patches into the
+existing outputs. Rows go away once their example is translated, by a replay
+or by a later run of the task.
+"""
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS dead_letters (
+    task TEXT NOT NULL,
+    split TEXT NOT NULL,
+    example INTEGER NOT NULL,
+    field TEXT NOT NULL,
+    source TEXT NOT NULL,
+    translation TEXT,
+    error_class TEXT,
+    error TEXT,
+    attempts INTEGER NOT NULL DEFAULT 1,
+    updated REAL NOT NULL,
+    PRIMARY KEY (task, split, example, field)
+);
+"""
+
+
+def insert_rows(conn, rows):
+    # Also used by the coordinator, inside the transaction that completes a unit
+    now = time.time()
+    conn.executemany(
+        'INSERT INTO dead_letters (task, split, example, field, source, translation, error_class, error, updated) '
+        'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?) '
+        'ON CONFLICT (task, split, example, field) DO UPDATE SET source = excluded.source, '
+        'translation = excluded.translation, error_class = excluded.error_class, error = excluded.error, '
+        'attempts = attempts + 1, updated = excluded.updated',
+        [tuple(row) + (now,) for row in rows])
+
+
+class DeadLetterStore:
+    def __init__(self, path, timeout=60):
+        self.path = path
+        self.timeout = timeout
+        self._local = threading.local()
+        self._connect()
+
+    def _connect(self):
+        # One connection per thread and per process, like the translation memory
+        local = self._local
+        if getattr(local, 'conn', None) is None or local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=self.timeout)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.executescript(SCHEMA)
+            local.conn = conn
+            local.pid = os.getpid()
+        return local.conn
+
+    def add(self, rows):
+        # rows of (task, split, example, field, source, translation, error_class, error)
+        if not rows:
+            return
+        conn = self._connect()
+        with conn:
+            insert_rows(conn, rows)
+
+    def pending(self, task_name, split):
+        # {example offset: {field: (source, translation, error_class)}}
+        conn = self._connect()
+        examples = {}
+        for example, field, source, translation, error_class in conn.execute(
+                'SELECT example, field, source, translation, error_class FROM dead_letters '
+                'WHERE task = ? AND split = ? ORDER BY example', (task_name, split)):
+            examples.setdefault(example, {})[field] = (source, translation, error_class)
+        return examples
+
+    def count(self, task_name=None, split=None):
+        conn = self._connect()
+        if task_name is None:
+            # DISTINCT over the columns: concatenated, ('a', 'b1', 2) and ('ab', '1', 2) would be one example
+            return conn.execute('SELECT COUNT(*) FROM (SELECT DISTINCT task, split, example FROM dead_letters)'
+                                ).fetchone()[0]
+        return conn.execute('SELECT COUNT(DISTINCT example) FROM dead_letters WHERE task = ? AND split = ?',
+                            (task_name, split)).fetchone()[0]
+
+    def summary(self):
+        # Failed examples per (task, split, error class)
+        conn = self._connect()
+        return conn.execute(
+            'SELECT task, split, error_class, COUNT(DISTINCT example) FROM dead_letters '
+            'WHERE error_class IS NOT NULL GROUP BY task, split, error_class ORDER BY task, split').fetchall()
+
+    def resolve(self, task_name, split, examples):
+        examples = list(examples)
+        if not examples:
+            return
+        conn = self._connect()
+        with conn:
+            conn.executemany('DELETE FROM dead_letters WHERE task = ? AND split = ? AND example = ?',
+                             [(task_name, split, example) for example in examples])
+
+    def clear(self, task_name, split):
+        conn = self._connect()
+        with conn:
+            conn.execute('DELETE FROM dead_letters WHERE task = ? AND split = ?', (task_name, split))
+
+    def close(self):
+        local = self._local
+        if getattr(local, 'conn', None) is not None and local.pid == os.getpid():
+            local.conn.close()
+        local.conn = None
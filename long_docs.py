@@ -0,0 +1,58 @@
+import re
+
+"""
+Length-aware splitting of long documents (cnn_dailymail, multi_news, xsum, duorc).
+
+A text over the per-request limit is cut into pieces under the limit,
+preferring paragraph breaks, then sentence ends, then any whitespace, and
+only as a last resort the middle of a word. The pieces keep every character
+of the text, so joining their translations with the original separators
+gives back the whole document with its whitespace.
+"""
+
+PARAGRAPH_BREAK = re.compile(r'\n\s*\n')
+LINE_BREAK = re.compile(r'\n')
+SENTENCE_END = re.compile(r'(?<=[.!?])["\')\]]*\s+')
+WHITESPACE = re.compile(r'\s+')
+BOUNDARIES = [PARAGRAPH_BREAK, LINE_BREAK, SENTENCE_END, WHITESPACE]
+
+
+def _split_at(text, pattern):
+    # Split after each match so the separators stay attached to the pieces
+    pieces, start = [], 0
+    for match in pattern.finditer(text):
+        if match.end() > start and match.end() < len(text):
+            pieces.append(text[start:match.end()])
+            start = match.end()
+    pieces.append(text[start:])
+    return pieces
+
+
+def split_text(text, max_chars, boundaries=BOUNDARIES):
+    # Return pieces of at most max_chars whose concatenation is `text`
+    if len(text) <= max_chars:
+        return [text]
+    if not boundaries:
+        return [text[i:i + max_chars] for i in range(0, len(text), max_chars)]
+
+    pieces = []
+    current = ''
+    for part in _split_at(text, boundaries[0]):
+        if len(part) > max_chars:
+            if current:
+                pieces.append(current)
+                current = ''
+            pieces.extend(split_text(part, max_chars, boundaries[1:]))
+        elif len(current) + len(part) > max_chars:
+            pieces.append(current)
+            current = part
+        else:
+            current += part
+    if current:
+        pieces.append(current)
+    return pieces
+
+
+def sort_by_length(texts):
+    # Indexes of texts from longest to shortest, so batches hold similar lengths
+    return sorted(range(len(texts)), key=lambda i: len(texts[i]), reverse=True)
@@ -0,0 +1,296 @@
+import argparse
+import json
+import math
+import os
+import random
+import shutil
+import time
+from functools import partial
+from multiprocessing import Pool, cpu_count
+
+from columnar_output import MAX_SHARD_BYTES, ShardedWriter, columnar_path, iter_columnar, shard_name, write_index
+from planner import text_hash
+
+"""
+Commands:
+python3 merge_outputs.py --path train_translated_list.txt --split train --out-dir p3_merged
+python3 merge_outputs.py --path task_list.txt --split train validation --output-format arrow --processes 16
+
+Merges the p3_translated_{task}_{split} outputs of every task into one
+deduplicated, shuffled dataset per split, with bounded memory.
+
+1. Scatter: every task is read in its own process, json, jsonl, arrow or
+   parquet. Failed (empty) examples are dropped. Each example goes to one of
+   the bucket files on disk, picked by a hash of its `inputs` and `targets`
+   keyed by `--seed`. Identical examples, e.g. from several template variants
+   of a dataset, always land in the same bucket.
+2. Gather: every bucket is read in its own process. Only the first copy of an
+   example is kept, in task list order, using a set of 64-bit hashes. The
+   bucket is then shuffled with a generator seeded by `--seed` and the bucket
+   number, and written as shards of at most `--shard-size-mb`.
+
+The number of buckets is chosen so that one bucket holds about `--bucket-mb`
+of input, which bounds the memory of a process. Buckets are assigned at
+random, so writing them one after the other is a full shuffle. The output
+only depends on the task list, `--seed` and `--bucket-mb`, not on
+`--processes`.
+
+Shards are renamed to {out_dir}/{split}/data-00000-of-0000N.{jsonl,arrow,parquet}
+with an index.json. Arrow output loads with `datasets.load_from_disk`.
+"""
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Merge, deduplicate and shuffle translated outputs')
+    parser.add_argument('--path', type=str, required=True, help='Task list of the outputs to merge')
+    parser.add_argument('--split', type=str, nargs='+', default=['train'], help='Splits to merge, one dataset each')
+    parser.add_argument('--input-dir', type=str, default='.', help='Directory of the translated outputs')
+    parser.add_argument('--out-dir', type=str, default='p3_merged', help='The merged splits go to OUT_DIR/SPLIT')
+    parser.add_argument('--output-format', choices=['jsonl', 'arrow', 'parquet'], default='jsonl',
+                        help='Format of the merged shards')
+    parser.add_argument('--shard-size-mb', type=int, default=MAX_SHARD_BYTES // (1024 * 1024),
+                        help='Size of a merged shard, at most')
+    parser.add_argument('--bucket-mb', type=float, default=128, help='Input per shuffle bucket, held in memory at once')
+    parser.add_argument('--buffer-mb', type=int, default=32, help='Write buffer of every scatter process')
+    parser.add_argument('--processes', type=int, default=cpu_count(), help='Processes reading and writing')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the shuffle')
+    parser.add_argument('--no-dedup', action='store_true', help='Keep duplicate examples')
+    parser.add_argument('--keep-source', action='store_true',
+                        help='Keep the source_inputs and source_targets columns when the outputs have them')
+    return parser.parse_args()
+
+
+def output_path(input_dir, task_name, split):
+    # The columnar directory or the json/jsonl file of a task, None if it was not translated
+    directory = os.path.join(input_dir, columnar_path(task_name, split))
+    if os.path.isfile(os.path.join(directory, 'index.json')):
+        return directory
+    path = os.path.join(input_dir, f'p3_translated_{task_name}_{split}.jsonl')
+    return path if os.path.isfile(path) else None
+
+
+def output_bytes(path):
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    with open(os.path.join(path, 'index.json')) as fp:
+        return sum(shard['bytes'] for shard in json.load(fp)['shards'])
+
+
+def iter_output(path):
+    if os.path.isdir(path):
+        yield from iter_columnar(path)
+        return
+    with open(path, 'r', encoding='utf-8') as infile:
+        if infile.read(1) == '[':
+            # output of save_translated_json, one task in memory
+            infile.seek(0)
+            yield from json.load(infile)
+            return
+        infile.seek(0)
+        for line in infile:
+            if line.strip():
+                yield json.loads(line)
+
+
+def bucket_dir(work_dir, bucket):
+    return os.path.join(work_dir, f'bucket-{bucket:05d}')
+
+
+def scatter_task(job, work_dir, buckets, seed=0, dedup=True, keep_source=False, buffer_bytes=32 * 1024 * 1024):
+    # Write the examples of one task to `{bucket}/{task index}.part` as "hash<TAB>json" lines
+    task_index, task_name, path = job
+    counts = {'task': task_name, 'examples': 0, 'failed': 0, 'error': None}
+    buffers = {}
+    buffered = 0
+
+    def flush():
+        for bucket, lines in buffers.items():
+            with open(os.path.join(bucket_dir(work_dir, bucket), f'{task_index:05d}.part'), 'a', encoding='utf-8') as fp:
+                fp.writelines(lines)
+        buffers.clear()
+
+    try:
+        for offset, record in enumerate(iter_output(path)):
+            if not record or record.get('inputs') is None or record.get('targets') is None:
+                counts['failed'] += 1
+                continue
+            merged = {'inputs': record['inputs'], 'targets': record['targets'], 'task': task_name}
+            if keep_source:
+                for column in ('source_inputs', 'source_targets'):
+                    if record.get(column) is not None:
+                        merged[column] = record[column]
+            value = text_hash(record['inputs'] + '\x1f' + record['targets'])
+            if dedup:
+                bucket = text_hash(f'{seed}:{value}') % buckets
+            else:
+                bucket = text_hash(f'{seed}:{task_name}:{offset}') % buckets
+            line = f'{value:016x}\t{json.dumps(merged, ensure_ascii=False)}\n'
+            buffers.setdefault(bucket, []).append(line)
+            buffered += len(line)
+            counts['examples'] += 1
+            if buffered >= buffer_bytes:
+                flush()
+                buffered = 0
+        flush()
+    except Exception as err:
+        counts['error'] = f'{type(err).__name__}: {err}'
+    return counts
+
+
+class JsonlShards:
+    # JSONL counterpart of ShardedWriter: size-bounded shards and an index.json
+    def __init__(self, path, max_shard_bytes=MAX_SHARD_BYTES):
+        self.path = path
+        self.max_shard_bytes = max_shard_bytes
+        self.shards = []
+        self._file = None
+        if os.path.exists(path):
+            shutil.rmtree(path)
+        os.makedirs(path)
+
+    def write_line(self, line):
+        if self._file is None or self.shards[-1][2] >= self.max_shard_bytes:
+            self._close_shard()
+            name = f'shard-{len(self.shards):05d}.tmp'
+            self._file = open(os.path.join(self.path, name), 'wb')
+            self.shards.append([name, 0, 0])
+        data = line.encode('utf-8')
+        self._file.write(data)
+        self.shards[-1][1] += 1
+        self.shards[-1][2] += len(data)
+
+    def _close_shard(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def close(self, info=None):
+        self._close_shard()
+        index = []
+        offset = 0
+        for i, (name, rows, size) in enumerate(self.shards):
+            final = shard_name(i, len(self.shards), 'jsonl')
+            os.replace(os.path.join(self.path, name), os.path.join(self.path, final))
+            index.append({'filename': final, 'rows': rows, 'bytes': size, 'offset': offset})
+            offset += rows
+        write_index(self.path, 'jsonl', index, info)
+        return offset
+
+
+def gather_bucket(bucket, work_dir, output_format='jsonl', max_shard_bytes=MAX_SHARD_BYTES, seed=0, dedup=True):
+    # Deduplicate and shuffle one bucket, then write it to `{bucket}.out`; return its counts
+    directory = bucket_dir(work_dir, bucket)
+    seen = set()
+    lines = []
+    duplicates = 0
+    for name in sorted(os.listdir(directory)):
+        with open(os.path.join(directory, name), 'r', encoding='utf-8') as fp:
+            for line in fp:
+                value, _, record = line.partition('\t')
+                if dedup:
+                    if value in seen:
+                        duplicates += 1
+                        continue
+                    seen.add(value)
+                lines.append(record)
+    del seen
+    random.Random(f'{seed}-{bucket}').shuffle(lines)
+    path = directory + '.out'
+    if output_format == 'jsonl':
+        writer = JsonlShards(path, max_shard_bytes)
+        for record in lines:
+            writer.write_line(record)
+    else:
+        writer = ShardedWriter(path, output_format, max_shard_bytes)
+        for record in lines:
+            writer.write(json.loads(record))
+    rows = writer.close()
+    shutil.rmtree(directory)
+    return bucket, rows, duplicates
+
+
+def collect_shards(work_dir, buckets, out_dir, output_format, info):
+    # Move the shards of every bucket to `out_dir` in bucket order, numbered across buckets
+    shards = []
+    for bucket in range(buckets):
+        path = bucket_dir(work_dir, bucket) + '.out'
+        with open(os.path.join(path, 'index.json')) as fp:
+            shards.extend((path, shard) for shard in json.load(fp)['shards'] if shard['rows'])
+    index = []
+    offset = 0
+    for i, (path, shard) in enumerate(shards):
+        final = shard_name(i, len(shards), output_format)
+        os.replace(os.path.join(path, shard['filename']), os.path.join(out_dir, final))
+        index.append({'filename': final, 'rows': shard['rows'], 'bytes': shard['bytes'], 'offset': offset})
+        offset += shard['rows']
+    write_index(out_dir, output_format, index, info)
+    return len(index)
+
+
+def merge_split(task_list, split, args):
+    started = time.monotonic()
+    jobs = []
+    total_bytes = 0
+    for task_name in task_list:
+        path = output_path(args.input_dir, task_name, split)
+        if path is None:
+            print(f'No output for {task_name} ({split}), skipped')
+            continue
+        jobs.append((len(jobs), task_name, path))
+        total_bytes += output_bytes(path)
+    # Not tied to --processes, so the output is the same whatever the number of processes
+    buckets = max(1, math.ceil(total_bytes / (args.bucket_mb * 1024 * 1024)))
+    out_dir = os.path.join(args.out_dir, split)
+    work_dir = out_dir + '.buckets'
+    for directory in (out_dir, work_dir):
+        if os.path.exists(directory):
+            shutil.rmtree(directory)
+    os.makedirs(out_dir)
+    for bucket in range(buckets):
+        os.makedirs(bucket_dir(work_dir, bucket))
+    print(f'Merging {len(jobs)} tasks ({split}), {total_bytes / 2 ** 20:.1f} MiB into {buckets} buckets')
+
+    dedup = not args.no_dedup
+    examples = failed = 0
+    errors = []
+    scatter = partial(scatter_task, work_dir=work_dir, buckets=buckets, seed=args.seed, dedup=dedup,
+                      keep_source=args.keep_source, buffer_bytes=args.buffer_mb * 1024 * 1024)
+    gather = partial(gather_bucket, work_dir=work_dir, output_format=args.output_format,
+                     max_shard_bytes=args.shard_size_mb * 1024 * 1024, seed=args.seed, dedup=dedup)
+    with Pool(args.processes) as pool:
+        for counts in pool.imap_unordered(scatter, jobs):
+            if counts['error']:
+                errors.append(f'{counts["task"]}: {counts["error"]}')
+                continue
+            examples += counts['examples']
+            failed += counts['failed']
+        if errors:
+            # a half-read task would make the merge depend on where it failed
+            shutil.rmtree(work_dir)
+            for error in errors:
+                print(f'Exception when reading task: {error}')
+            print(f'Merge of {split} stopped, nothing written')
+            return False
+        print(f'Scattered {examples} examples in {time.monotonic() - started:.1f}s, {failed} failed examples dropped')
+        rows = duplicates = 0
+        for bucket, bucket_rows, bucket_duplicates in pool.imap_unordered(gather, range(buckets)):
+            rows += bucket_rows
+            duplicates += bucket_duplicates
+    shards = collect_shards(work_dir, buckets, out_dir, args.output_format,
+                            {'split': split, 'description': f'P3 translated, merged from {len(jobs)} tasks'})
+    shutil.rmtree(work_dir)
+    print(f'Merged {split}: {rows} examples, {duplicates} duplicates dropped, {shards} shards in {out_dir}, '
+          f'{time.monotonic() - started:.1f}s')
+    return True
+
+
+def main():
+    args = parse_args()
+    with open(args.path, 'r') as f:
+        task_list = [line.strip() for line in f if line.strip()]
+    for split in args.split:
+        merge_split(task_list, split, args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,201 @@
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+"""
+Metrics and progress reporting of translation runs.
+
+Every process records into its own Metrics registry. Workers `drain()` theirs
+after each work unit and the snapshot travels back with the unit result, so
+the main process can `merge()` them into one view of the whole run. That view
+is served in the Prometheus text format and summarised in a periodic
+progress line with per-task and overall ETA.
+"""
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = defaultdict(float)
+        self.gauges = {}
+        # key -> [count per bucket..., count above the last bucket, sum]
+        self.histograms = {}
+
+    def inc(self, name, value=1, **labels):
+        with self.lock:
+            self.counters[_key(name, labels)] += value
+
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.gauges[_key(name, labels)] = value
+
+    def observe(self, name, value, **labels):
+        key = _key(name, labels)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [0] * (len(LATENCY_BUCKETS) + 2)
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if value <= bound:
+                    histogram[i] += 1
+                    break
+            else:
+                histogram[len(LATENCY_BUCKETS)] += 1
+            histogram[-1] += value
+
+    @contextmanager
+    def timer(self, name, **labels):
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(name, time.monotonic() - started, **labels)
+
+    def value(self, name, **labels):
+        with self.lock:
+            return self.counters.get(_key(name, labels), self.gauges.get(_key(name, labels), 0))
+
+    def total(self, name):
+        # Sum of a counter over all its labels
+        with self.lock:
+            return sum(value for (key, _), value in self.counters.items() if key == name)
+
+    def drain(self):
+        # Snapshot and reset counters and histograms, gauges are copied as they are
+        with self.lock:
+            snapshot = {'counters': dict(self.counters), 'gauges': dict(self.gauges),
+                        'histograms': {key: list(values) for key, values in self.histograms.items()}}
+            self.counters.clear()
+            self.histograms.clear()
+        return snapshot
+
+    def merge(self, snapshot):
+        with self.lock:
+            for key, value in snapshot['counters'].items():
+                self.counters[key] += value
+            self.gauges.update(snapshot['gauges'])
+            for key, values in snapshot['histograms'].items():
+                histogram = self.histograms.setdefault(key, [0] * len(values))
+                for i, value in enumerate(values):
+                    histogram[i] += value
+
+    def render(self):
+        # Prometheus text exposition format
+        def labels_text(labels, extra=()):
+            items = list(labels) + list(extra)
+            if not items:
+                return ''
+            return '{' + ','.join(f'{k}="{v}"' for k, v in items) + '}'
+
+        lines = []
+        with self.lock:
+            for (name, labels), value in sorted(self.counters.items()):
+                lines.append(f'{name}{labels_text(labels)} {value}')
+            for (name, labels), value in sorted(self.gauges.items()):
+                lines.append(f'{name}{labels_text(labels)} {value}')
+            for (name, labels), values in sorted(self.histograms.items()):
+                cumulative = 0
+                for bound, count in zip(LATENCY_BUCKETS, values):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{labels_text(labels, [("le", bound)])} {cumulative}')
+                cumulative += values[len(LATENCY_BUCKETS)]
+                lines.append(f'{name}_bucket{labels_text(labels, [("le", "+Inf")])} {cumulative}')
+                lines.append(f'{name}_sum{labels_text(labels)} {values[-1]}')
+                lines.append(f'{name}_count{labels_text(labels)} {cumulative}')
+        return '\n'.join(lines) + '\n'
+
+
+# Registry of the current process
+METRICS = Metrics()
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.rstrip('/') not in ('', '/metrics'):
+            self.send_error(404)
+            return
+        body = self.server.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def serve_metrics(render, port, host='127.0.0.1'):
+    # `render` returns the page, so the caller can refresh gauges first
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    server.render = render
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def format_seconds(seconds):
+    if seconds is None:
+        return '?'
+    seconds = int(seconds)
+    if seconds >= 3600:
+        return f'{seconds // 3600}h{seconds % 3600 // 60:02d}m'
+    if seconds >= 60:
+        return f'{seconds // 60}m{seconds % 60:02d}s'
+    return f'{seconds}s'
+
+
+class Progress:
+    # Examples done and expected per task, for throughput and ETA
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.monotonic()
+        self.totals = {}
+        self.done = {}
+        self.task_started = {}
+        self.finished = set()
+
+    def set_total(self, task, total):
+        with self.lock:
+            self.totals[task] = total
+
+    def advance(self, task, count):
+        with self.lock:
+            self.task_started.setdefault(task, time.monotonic())
+            self.done[task] = self.done.get(task, 0) + count
+
+    def finish(self, task):
+        with self.lock:
+            self.finished.add(task)
+
+    def _eta(self, done, total, elapsed):
+        if total is None or not done or elapsed <= 0:
+            return None
+        return max(0, total - done) / (done / elapsed)
+
+    def line(self):
+        now = time.monotonic()
+        with self.lock:
+            done = sum(self.done.values())
+            known_total = sum(self.totals.values()) if self.totals else None
+            active = []
+            for task, started in self.task_started.items():
+                if task in self.finished:
+                    continue
+                task_done = self.done.get(task, 0)
+                total = self.totals.get(task)
+                eta = self._eta(task_done, total, now - started)
+                active.append(f'{task} {task_done}/{total if total is not None else "?"} ETA {format_seconds(eta)}')
+        elapsed = now - self.started
+        rate = done / elapsed if elapsed > 0 else 0.0
+        overall = f'overall {done}/{known_total if known_total is not None else "?"} ' \
+                  f'ETA {format_seconds(self._eta(done, known_total, elapsed))}'
+        return f'{rate:.1f} ex/s | ' + ' | '.join(active + [overall])
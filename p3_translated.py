@@ -2,45 +2,73 @@ import os
 import argparse
 import json
 import logging
-from googletrans import Translator
-from retrying import retry
-from multiprocessing import Pool
+import socket
+import threading
+import time
+from itertools import islice
 from functools import partial
+from backends import make_backend
+from proxy_pool import ProxyPool, parse_endpoint
+from translation_memory import TranslationMemory
+from template_segmenter import TemplateSegmenter, strip_parts
+from async_engine import run_ordered
+from scheduler import Scheduler, WorkUnit
+from packing import MAX_REQUEST_CHARS, pack_segments, join_segments, split_segments
+from long_docs import split_text, sort_by_length
+from checkpoint import CheckpointJournal, checkpoint_path
+from rate_limiter import AdaptiveRateLimiter, RetryBudget, RetryExhausted, call_with_retries, is_throttled
+from metrics import METRICS, Metrics, Progress, serve_metrics
+from columnar_output import MAX_SHARD_BYTES, ShardedWriter, columnar_path, patch_shards
+from dead_letters import DeadLetterStore
+from planner import make_plan, format_plan
+from coordinator import connect, read_unit
 
 """
 Commands:
 python3 p3_translated.py --path file_path --split train --size 1000
 python3 p3_translated.py --path file_path --split validation --size 100
+python3 p3_translated.py --path file_path --split train --stream --workers 8 --unit-size 32
+python3 p3_translated.py --path file_path --split train --output-format arrow --shard-size-mb 500
+python3 p3_translated.py --path file_path --split train validation --stream
+python3 p3_translated.py --path file_path --split train --replay-failures
+python3 p3_translated.py --path file_path --split train validation --plan --workers 16 --concurrency 64
+python3 p3_translated.py --coordinator http://coordinator-host:8700 --workers 8
 """
 
-translator = Translator(proxies={'http': 'http://localhost:8118'})
+# Translator backend (googletrans or an HTTP service), built in main() and inherited by the workers
+backend = None
+# Shared health of the --proxy-pool endpoints, None without a pool
+proxy_pool = None
+# Shared by every worker, set in main() before the workers are forked
+rate_limiter = None
+retry_budget = None
+max_retries = 6
+# Set in main() when the translation memory is enabled, inherited by the workers
+translation_memory = None
+# Character budget of one packed request, 0 sends every segment alone
+pack_chars = MAX_REQUEST_CHARS
+# Translated template fragments of the current tasks, filled per process
+template_translations = {}
+# Columnar outputs also keep the source texts, set in main()
+keep_source = False
+# Error of every text that ran out of retries, filled per process. Several units can be in
+# flight at once, so each one takes out the errors of its own texts instead of clearing it
+failure_errors = {}
+# Translated fields of an example, in the order of the input files
+FIELDS = ['inputs', 'targets']
 
 logging.basicConfig(filename='/tmp/p3_translated.log', level=logging.DEBUG, 
                     format='%(asctime)s %(levelname)s %(name)s %(message)s')
 logger=logging.getLogger(__name__)
 
 
-def read_json(task_name, split):
+# Yield examples one by one so a task never has to fit in memory
+def iter_json(task_name, split):
     with open(f'p3_{task_name}_{split}.jsonl', 'r') as json_file:
-        json_list = list(json_file)
-
-    data_list = []
-    for json_str in json_list:
-        data_list.append(list(json.loads(json_str).values()))
-    return data_list
-
-# List of translated object to list of translated text string
-def to_list_text(mylist):
-    res_texts = []
-    for i in range(len(mylist)):
-        res_texts.append(mylist[i].text)
-    return res_texts
-
-# Divide small chunks
-def divide_chunks(mylist, n): 
-  # looping till length l
-  for i in range(0, len(mylist), n):
-    yield mylist[i:i + n]
+        for json_str in json_file:
+            METRICS.inc('io_read_bytes_total', len(json_str))
+            if json_str.strip():
+                yield list(json.loads(json_str).values())
 
 # Convert list to dict 
 def list_to_dict(mylist):
@@ -52,47 +80,488 @@ def save_translated_json(mydict, task_name, split):
     json_object = json.dumps(mydict, indent=2, ensure_ascii=False)
 
     # Writing to .jsonl
-    with open(f'p3_translated_{task_name}_{split}.jsonl', "w", encoding='utf-8') as outfile:
-        outfile.write(json_object)
+    with METRICS.timer('io_write_seconds'):
+        path = f'p3_translated_{task_name}_{split}.jsonl'
+        with open(path + '.tmp', "w", encoding='utf-8') as outfile:
+            outfile.write(json_object)
+        os.replace(path + '.tmp', path)
+    METRICS.inc('io_write_bytes_total', len(json_object))
 
-@retry(wait_fixed=7000)
-def translate_list_str(task_name, translator, list_str):
+# Append JSONL records to an already opened output file
+def append_jsonl(outfile, records):
+    with METRICS.timer('io_write_seconds'):
+        for record in records:
+            line = json.dumps(record, ensure_ascii=False) + "\n"
+            outfile.write(line)
+            METRICS.inc('io_write_bytes_total', len(line))
+        outfile.flush()
+
+# Keeps results that finished early until every earlier index has arrived
+class ReorderBuffer:
+    def __init__(self, start=0):
+        self.next_index = start
+        self.pending = {}
+
+    def __len__(self):
+        return len(self.pending)
+
+    def push(self, index, item):
+        # Return the items that can be released in order
+        self.pending[index] = item
+        ready = []
+        while self.next_index in self.pending:
+            ready.append(self.pending.pop(self.next_index))
+            self.next_index += 1
+        return ready
+
+# Failure sink: texts that ran out of retries are skipped, their error goes to the dead-letter store
+# with the examples they belong to
+def record_failure(task_name, list_str, err):
+    cause = err.__cause__ or err
+    error_class = 'Throttled' if is_throttled(cause) else type(cause).__name__
+    for text in list_str:
+        failure_errors[text] = (error_class, str(err))
+
+def translate_list_str(task_name, backend, list_str):
     translated = []
+    chars = sum(len(text) for text in list_str)
+    attempts = []
+
+    # One call to the backend, timed and counted
+    def attempt():
+        attempts.append(1)
+        started = time.monotonic()
+        try:
+            return backend.translate_batch(list_str, src='en', dest='vi')
+        except Exception as err:
+            METRICS.inc('translate_request_errors_total', throttled=str(is_throttled(err)).lower())
+            raise
+        finally:
+            METRICS.observe('translate_request_seconds', time.monotonic() - started)
+            METRICS.inc('translate_requests_total')
+            METRICS.inc('translate_chars_total', chars)
+
     try:
-        translated = translator.translate(list_str, src='en', dest='vi')
-    except Exception as err:
+        translated = call_with_retries(attempt, limiter=rate_limiter, budget=retry_budget, retries=max_retries)
+    except RetryExhausted as err:
         logger.error(err)
+        METRICS.inc('translate_failed_calls_total')
         print(f'Exception occured when translating: {task_name}')
         print(f"Exception occurred for sentence: {list_str}")
-        # Write error list that stores sentences that exception occurred
-        with open(f'{task_name}_error_sentences.txt', 'a+') as fp:
-            fp.write("%s\n" %list_str)
-            print(f'Write {task_name} error sentences successuflly!')
+        record_failure(task_name, list_str, err)
+    METRICS.inc('translate_retries_total', max(0, len(attempts) - 1))
     return translated
 
-def translate_chunks(task_name, list_chunks):
+# Send one packed request, or each text alone when the reply can't be split back.
+# A packed request that runs out of retries fails all its texts: sending them one
+# by one would only add load to an endpoint that is already failing.
+def translate_packed(task_name, texts):
+    if len(texts) > 1:
+        packed = join_segments(texts)
+        translated = translate_list_str(task_name=task_name, backend=backend, list_str=[packed])
+        if not translated:
+            error = failure_errors.pop(packed, None)
+            if error is not None:
+                for text in texts:
+                    failure_errors[strip_parts(text)[1]] = error
+            return [None] * len(texts)
+        parts = split_segments(translated[0], texts)
+        if parts is not None:
+            return parts
+        logger.debug(f'Packed reply of {len(texts)} segments did not split back, sending them one by one')
+    results = []
+    for text in texts:
+        lead, core, trail = strip_parts(text)
+        translated = translate_list_str(task_name=task_name, backend=backend, list_str=[core])
+        results.append(lead + translated[0] + trail if translated else None)
+    return results
+
+# Translate a list of strings, asking the translation memory before the network.
+# Failed texts come back as None.
+def translate_texts(task_name, list_str, concurrency=1):
+    with METRICS.timer('translate_texts_seconds'):
+        return _translate_texts(task_name, list_str, concurrency)
+
+def _translate_texts(task_name, list_str, concurrency=1):
+    results = list(list_str)
+    if translation_memory is not None:
+        cached = translation_memory.get_many(list_str, 'en', 'vi')
+        hits = sum(1 for text in cached if text is not None)
+        METRICS.inc('cache_hits_total', hits)
+        METRICS.inc('cache_misses_total', len(cached) - hits)
+        for i in range(len(list_str)):
+            if cached[i] is not None:
+                results[i] = cached[i]
+    else:
+        cached = [None] * len(list_str)
+
+    # Unique texts that still need the translator, blank ones are kept as they are
+    missing = list(dict.fromkeys(list_str[i] for i in range(len(list_str))
+                                 if cached[i] is None and list_str[i].strip()))
+    if not missing:
+        return results
+    # Long documents are cut into pieces under the request limit at paragraph
+    # and sentence boundaries, the pieces are translated like any other segment
+    max_chars = pack_chars or MAX_REQUEST_CHARS
+    pieces = {text: split_text(text, max_chars) for text in missing}
+    segments = list(dict.fromkeys(piece for text in missing for piece in pieces[text] if piece.strip()))
+    # Longest first, so short and long segments don't share a request
+    order = sort_by_length(segments)
+    if pack_chars:
+        batches = [[order[i] for i in batch] for batch in pack_segments([segments[i] for i in order], pack_chars)]
+    else:
+        batches = [[i] for i in order]
+    batch_texts = [[segments[i] for i in batch] for batch in batches]
+    send = partial(translate_packed, task_name)
+    if concurrency > 1 and len(batch_texts) > 1:
+        replies = run_ordered(send, batch_texts, concurrency)
+    else:
+        replies = [send(texts) for texts in batch_texts]
+
+    segment_translations = {}
+    for texts, reply in zip(batch_texts, replies):
+        segment_translations.update(zip(texts, reply))
+    translated = {}
+    for text in missing:
+        parts = [segment_translations[piece] if piece.strip() else piece for piece in pieces[text]]
+        translated[text] = None if None in parts else ''.join(parts)
+        if translated[text] is None and len(pieces[text]) > 1:
+            # the error of a failed piece stands for the whole document
+            errors = [failure_errors.pop(strip_parts(piece)[1], None) for piece in pieces[text]]
+            failure_errors[text] = next((error for error in errors if error is not None),
+                                        ('RetryExhausted', 'a segment of this text ran out of retries'))
+    if translation_memory is not None:
+        done = [text for text in missing if translated[text] is not None]
+        translation_memory.put_many(done, [translated[text] for text in done], 'en', 'vi')
+    for i in range(len(list_str)):
+        if list_str[i] in translated:
+            results[i] = translated[list_str[i]]
+    return results
+
+# Translate a batch of examples in one go. Template fragments of the inputs are
+# only sent once and an example with a failed text comes back as [].
+# With a `failures` list, (example index, fields, errors) of failed examples are added to it,
+# fields holding the translations that did succeed and None for the others.
+def translate_examples(task_name, examples, segmenter=None, concurrency=1, failures=None):
+    split_examples = []
+    for example in examples:
+        if segmenter:
+            split_examples.append([segmenter.split(example[0])] + [[(text, False)] for text in example[1:]])
+        else:
+            split_examples.append([[(text, False)] for text in example])
+
+    # Unique texts still to translate, template fragments already known are skipped
+    pending = {}
+    for split_texts in split_examples:
+        for pieces in split_texts:
+            for piece, is_template in pieces:
+                core = strip_parts(piece)[1]
+                if core and not (is_template and core in template_translations):
+                    pending[core] = pending.get(core, False) or is_template
+    known = dict(zip(pending, translate_texts(task_name, list(pending), concurrency)))
+    for core, is_template in pending.items():
+        if is_template and known[core] is not None:
+            template_translations[core] = known[core]
+
+    def rebuild(pieces):
+        text = ''
+        for piece, is_template in pieces:
+            lead, core, trail = strip_parts(piece)
+            if core:
+                core = template_translations.get(core) if is_template else known[core]
+                if core is None:
+                    return None
+            text += lead + core + trail
+        return text
+
+    def error(pieces):
+        for piece, is_template in pieces:
+            core = strip_parts(piece)[1]
+            if core in failure_errors:
+                return failure_errors[core]
+        # a piece of a long document failed
+        return ('RetryExhausted', 'a segment of this text ran out of retries')
+
+    results = []
+    for i, split_texts in enumerate(split_examples):
+        result = [rebuild(pieces) for pieces in split_texts]
+        if None in result and failures is not None:
+            failures.append((i, result, [error(pieces) if text is None else None
+                                         for text, pieces in zip(result, split_texts)]))
+        results.append([] if None in result else result)
+    for core in pending:
+        failure_errors.pop(core, None)
+    return results
+
+def fit_segmenter(examples, sample_size=500):
+    segmenter = TemplateSegmenter.fit([example[0] for example in islice(examples, sample_size)])
+    if segmenter:
+        print(f'Template fragments: {segmenter}')
+    return segmenter
+
+def translate_chunks(task_name, list_chunks, segmenter=None, concurrency=1, failures=None):
     translated_chunks = []
     for i in range(len(list_chunks)):
-        translated_chunk = []
-        for j in range(len(list_chunks[i])):
-            translated_chunk.append(translate_list_str(task_name=task_name, translator=translator, list_str=list_chunks[i][j]))
-        translated_list_chunk = []
-        for j in range(len(translated_chunk)):
-            translated_list_chunk.append(to_list_text(translated_chunk[j]))
+        chunk_failures = []
+        with METRICS.timer('translate_chunks_seconds'):
+            translated_list_chunk = translate_examples(task_name, list_chunks[i], segmenter, concurrency, chunk_failures)
+        if failures is not None:
+            failures.extend((i,) + failure for failure in chunk_failures)
         translated_list_dict_chunk = []
         for j in range(len(translated_list_chunk)):
             translated_list_dict_chunk.append(list_to_dict(translated_list_chunk[j]))
         translated_chunks.append(translated_list_dict_chunk)
     return translated_chunks
 
+# Examples already in the checkpoint journal are None and come back as None.
+# The metrics recorded by this worker since its last unit travel back with the records,
+# and so do the dead-letter rows of its failed examples.
+def translate_unit(unit, engine='pool', concurrency=64):
+    offsets = [unit.start + i for i, example in enumerate(unit.examples) if example is not None]
+    todo = [example for example in unit.examples if example is not None]
+    failures = []
+    # With the async engine the requests of every unit this worker is translating share its
+    # `concurrency` slots, the pool engine sends one at a time
+    concurrency = concurrency if engine == 'async' else 1
+    translated = translate_chunks(unit.task_name, [todo], unit.segmenter, concurrency, failures)[0]
+    translated = iter(translated)
+    records = [None if example is None else next(translated) for example in unit.examples]
+    if keep_source:
+        for record, example in zip(records, unit.examples):
+            if record:
+                record['source_inputs'], record['source_targets'] = example[0], example[1]
+    dead_letters = []
+    for _, i, fields, errors in failures:
+        for field, source, translation, error in zip(FIELDS, todo[i], fields, errors):
+            error_class, message = error or (None, None)
+            dead_letters.append((unit.task_name, unit.split, offsets[i], field, source, translation,
+                                 error_class, message))
+    return records, METRICS.drain(), dead_letters
+
+# Split every task into small work units, reading the input files lazily
+# With `resume`, examples found in the task's checkpoint journal are sent as None.
+# Several splits go through the same scheduler, one after the other.
+# Tasks in `finished` (per split) are skipped.
+def iter_units(task_list, splits, unit_size=32, segment_templates=False, resume=False, finished=None):
+    if isinstance(splits, str):
+        splits = [splits]
+    finished = finished or {}
+    for split, task_name in ((split, task_name) for split in splits for task_name in task_list):
+        if task_name in finished.get(split, ()):
+            continue
+        yield from task_units(task_name, split, partial(iter_json, task_name, split), unit_size, segment_templates, resume)
+
+# Run `starts` (e.g. the start of a thread) from the generator the scheduler pulls units from,
+# i.e. once the workers are forked: a worker forked while a thread of this process holds a lock,
+# such as METRICS.lock during a scrape, would inherit it held and hang on its first metric
+def start_with_units(units, starts):
+    for start in starts:
+        start()
+    yield from units
+
+# Work units of one task; `read` returns a fresh iterator over its examples
+def task_units(task_name, split, read, unit_size=32, segment_templates=False, resume=False):
+    index = 0
+    try:
+        print(f'Starting translation task: {task_name} ({split})...')
+        done = set()
+        if resume:
+            done = CheckpointJournal(checkpoint_path(task_name, split)).done_offsets()
+            if done:
+                print(f'Resuming {task_name}: {len(done)} examples already translated')
+        segmenter = fit_segmenter(read()) if segment_templates else None
+        examples = (None if offset in done else example
+                    for offset, example in enumerate(read()))
+        start = 0
+        chunk = list(islice(examples, unit_size))
+        while True:
+            next_chunk = list(islice(examples, unit_size))
+            yield WorkUnit(task_name, split, index, start, chunk, segmenter, last=not next_chunk)
+            if not next_chunk:
+                break
+            index += 1
+            start += len(chunk)
+            chunk = next_chunk
+    except Exception as err:
+        logger.error(err)
+        yield WorkUnit(task_name, split, index, 0, None, last=True, error=f'{type(err).__name__}: {err}')
+
+# Collects the units of one task, journals them and writes them in order
+class TaskWriter:
+    def __init__(self, task_name, split, output_format='json', resume=False, max_shard_bytes=MAX_SHARD_BYTES,
+                 dead_letters=None, checkpoint=True):
+        self.task_name = task_name
+        self.split = split
+        # Dead letters of a previous run are dropped, or resolved as their examples get translated on resume
+        self.dead_letters = None
+        if dead_letters is not None:
+            if not resume:
+                dead_letters.clear(task_name, split)
+            elif dead_letters.count(task_name, split):
+                self.dead_letters = dead_letters
+        # Without a checkpoint (e.g. records that come from the coordinator) nothing is journaled
+        self.journal = CheckpointJournal(checkpoint_path(task_name, split)) if checkpoint else None
+        self.restored = self.journal.load() if resume and checkpoint else {}
+        if self.journal is not None:
+            self.journal.open(resume)
+        self.buffer = ReorderBuffer()
+        self.total_units = None
+        self.done_units = 0
+        self.count = 0
+        self.failed = 0
+        self.errors = []
+        self.records = [] if output_format == 'json' else None
+        self.outfile = None
+        self.shards = None
+        if output_format == 'jsonl':
+            # Written next to the output, which is only replaced once the task is complete
+            self.output_path = f'p3_translated_{task_name}_{split}.jsonl'
+            self.outfile = open(self.output_path + '.tmp', "w", encoding='utf-8')
+        elif output_format in ('arrow', 'parquet'):
+            self.shards = ShardedWriter(columnar_path(task_name, split), output_format, max_shard_bytes)
+
+    @property
+    def finished(self):
+        return self.total_units is not None and self.done_units == self.total_units
+
+    def add(self, unit, records, error):
+        # Return how many units left memory, so their scheduler slots can be freed
+        self.done_units += 1
+        if unit.last:
+            self.total_units = unit.index + 1
+        if error is not None:
+            self.errors.append(error)
+        if records is not None:
+            # Journal new translations, failed (empty) ones are retried on resume
+            if self.journal is not None:
+                with METRICS.timer('checkpoint_write_seconds'):
+                    self.journal.append({unit.start + i: record for i, record in enumerate(records) if record})
+            if self.dead_letters is not None:
+                self.dead_letters.resolve(self.task_name, self.split,
+                                          [unit.start + i for i, record in enumerate(records) if record])
+            records = [self.restored.pop(unit.start + i) if record is None else record
+                       for i, record in enumerate(records)]
+        if self.errors:
+            released = len(self.buffer) + 1
+            self.buffer.pending.clear()
+            return released
+        ready = self.buffer.push(unit.index, records)
+        for chunk in ready:
+            self.count += len(chunk)
+            self.failed += sum(1 for record in chunk if not record)
+            if self.outfile is not None:
+                append_jsonl(self.outfile, chunk)
+            elif self.shards is not None:
+                # failed examples are null rows, filled in by --replay-failures
+                with METRICS.timer('io_write_seconds'):
+                    for record in chunk:
+                        self.shards.write(dict(record, task=self.task_name) if record else {})
+            else:
+                self.records.extend(chunk)
+        return len(ready)
+
+    def close(self):
+        if self.journal is None:
+            pass
+        elif not self.errors and not self.failed:
+            self.journal.remove()
+        else:
+            self.journal.close()
+        if self.outfile is not None:
+            self.outfile.close()
+            if self.errors:
+                # the task is translated again from scratch, drop the partial output
+                os.remove(self.outfile.name)
+            else:
+                os.replace(self.outfile.name, self.output_path)
+        elif self.shards is not None:
+            if self.errors:
+                self.shards.abort()
+            else:
+                self.shards.close({'description': f'P3 {self.task_name} translated', 'split': self.split})
+        elif not self.errors:
+            save_translated_json(self.records, self.task_name, self.split)
+
+# Write replayed records {example offset: record} over the failed ones of an existing output
+def patch_output(task_name, split, patches):
+    directory = columnar_path(task_name, split)
+    if os.path.isdir(directory):
+        return patch_shards(directory, {offset: dict(record, task=task_name) for offset, record in patches.items()})
+    path = f'p3_translated_{task_name}_{split}.jsonl'
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r', encoding='utf-8') as infile, open(path + '.tmp', 'w', encoding='utf-8') as outfile:
+        if infile.read(1) == '[':
+            # output of save_translated_json
+            infile.seek(0)
+            records = json.load(infile)
+            for offset, record in patches.items():
+                records[offset] = record
+            outfile.write(json.dumps(records, indent=2, ensure_ascii=False))
+        else:
+            infile.seek(0)
+            for offset, line in enumerate(infile):
+                outfile.write(json.dumps(patches[offset], ensure_ascii=False) + "\n" if offset in patches else line)
+    os.replace(path + '.tmp', path)
+    return len(patches)
+
+# Translate the dead letters of every task again and patch them into the outputs in place.
+# Return the tasks of each split that have no failed example left.
+def replay_failures(task_list, splits, dead_letters, concurrency=64):
+    finished = {split: [] for split in splits}
+    for split in splits:
+        for task_name in task_list:
+            pending = dead_letters.pending(task_name, split)
+            if not pending:
+                continue
+            print(f'Replaying {len(pending)} failed examples of {task_name} ({split})...')
+            failure_errors.clear()
+            sources = list(dict.fromkeys(source for fields in pending.values()
+                                         for source, translation, _ in fields.values() if translation is None))
+            known = dict(zip(sources, translate_texts(task_name, sources, concurrency)))
+            patches = {}
+            still_failed = []
+            for offset, fields in pending.items():
+                record = {field: fields[field][1] if fields[field][1] is not None else known[fields[field][0]]
+                          for field in FIELDS}
+                if None not in record.values():
+                    # columnar outputs keep the source texts, like keep_source records
+                    if os.path.isdir(columnar_path(task_name, split)):
+                        record['source_inputs'], record['source_targets'] = fields['inputs'][0], fields['targets'][0]
+                    patches[offset] = record
+                    continue
+                for field in FIELDS:
+                    source = fields[field][0]
+                    error = None
+                    if record[field] is None:
+                        error = failure_errors.get(strip_parts(source)[1],
+                                                   ('RetryExhausted', 'a segment of this text ran out of retries'))
+                    still_failed.append((task_name, split, offset, field, source, record[field]) + (error or (None, None)))
+            if patch_output(task_name, split, patches) is None:
+                print(f'No output of {task_name} ({split}) to patch, translate the task again')
+                continue
+            dead_letters.resolve(task_name, split, patches)
+            dead_letters.add(still_failed)
+            journal = CheckpointJournal(checkpoint_path(task_name, split))
+            if dead_letters.count(task_name, split):
+                # --resume must not translate the replayed examples again
+                journal.open(resume=True)
+                journal.append(patches)
+                journal.close()
+            else:
+                journal.remove()
+                finished[split].append(task_name)
+            print(f'Patched {len(patches)} examples of {task_name} ({split}), {len(pending) - len(patches)} still failed.')
+    return finished
+
 def dir_path(string):
     if os.path.exists(string):
         return string
     else:
         raise NotADirectoryError(string)
 
-def parse_args():
-    parser = argparse.ArgumentParser(description='Translate dataset')
+def build_parser(description='Translate dataset'):
+    parser = argparse.ArgumentParser(description=description)
     parser.add_argument(
         '--path',
         default='task_list.txt',
@@ -100,60 +569,563 @@ def parse_args():
     )
     parser.add_argument(
         '--split',
-        default='train',
-        help='define split')
-    args = parser.parse_args()
+        nargs='+',
+        default=['train'],
+        help='splits to translate in the same run, e.g. train validation')
+    parser.add_argument(
+        '--stream',
+        action='store_true',
+        help='stream examples and append JSONL records as they finish, same as --output-format jsonl')
+    parser.add_argument(
+        '--output-format',
+        default='json',
+        choices=['json', 'jsonl', 'arrow', 'parquet'],
+        help='json: one JSON array per task, jsonl: one record per line, '
+             'arrow/parquet: a directory of columnar shards with the source texts')
+    parser.add_argument(
+        '--shard-size-mb',
+        default=MAX_SHARD_BYTES // (1024 * 1024),
+        type=int,
+        help='start a new arrow/parquet shard above this size')
+    parser.add_argument(
+        '--backend',
+        default='google',
+        choices=['google', 'http'],
+        help='google: googletrans, http: a JSON translation service such as stub_server.py')
+    parser.add_argument(
+        '--backend-url',
+        default='http://127.0.0.1:8765/translate',
+        help='translate endpoint of --backend http')
+    parser.add_argument(
+        '--proxy',
+        default=None,
+        help='HTTP proxy of the translator, "direct" for none. '
+             'Defaults to the Privoxy/Tor proxy on localhost:8118 for google and none for http')
+    parser.add_argument(
+        '--proxy-pool',
+        nargs='+',
+        default=None,
+        help='spread requests over these endpoints instead of --proxy: URL[,control=[HOST:]PORT][,max=N], '
+             'URL being an HTTP proxy or "direct" and control a Tor control port for NEWNYM on throttling')
+    parser.add_argument(
+        '--proxy-concurrency',
+        default=8,
+        type=int,
+        help='max in-flight requests per --proxy-pool endpoint unless set with max=N')
+    parser.add_argument(
+        '--tor-password',
+        default='',
+        help='password of the Tor control ports')
+    parser.add_argument(
+        '--workers',
+        default=8,
+        type=int,
+        help='number of worker processes pulling work units')
+    parser.add_argument(
+        '--unit-size',
+        default=32,
+        type=int,
+        help='examples per work unit')
+    parser.add_argument(
+        '--queue-size',
+        default=1024,
+        type=int,
+        help='max examples queued, in flight or waiting to be written')
+    parser.add_argument(
+        '--engine',
+        default='pool',
+        choices=['pool', 'async'],
+        help='pool: each worker translates one unit at a time, one request at a time, '
+             'async: each worker translates up to --concurrency units at once and keeps up to '
+             '--concurrency requests in flight across them')
+    parser.add_argument(
+        '--concurrency',
+        default=64,
+        type=int,
+        help='max in-flight requests, and units in progress, per worker for --engine async')
+    parser.add_argument(
+        '--pack-chars',
+        default=MAX_REQUEST_CHARS,
+        type=int,
+        help='pack short segments into requests of up to this many characters, 0 disables packing. '
+             'Longer texts are split at paragraph and sentence boundaries under this limit')
+    parser.add_argument(
+        '--rate',
+        default=5.0,
+        type=float,
+        help='initial requests per second shared by all workers, adapted while running')
+    parser.add_argument(
+        '--min-rate',
+        default=0.2,
+        type=float,
+        help='lowest requests per second after throttling')
+    parser.add_argument(
+        '--max-rate',
+        default=50.0,
+        type=float,
+        help='highest requests per second while calls succeed')
+    parser.add_argument(
+        '--max-retries',
+        default=6,
+        type=int,
+        help='retries of one request before it goes to the error file')
+    parser.add_argument(
+        '--retry-ratio',
+        default=0.2,
+        type=float,
+        help='retries earned per successful request, shared by all workers')
+    parser.add_argument(
+        '--metrics-port',
+        default=0,
+        type=int,
+        help='serve Prometheus metrics on 127.0.0.1:PORT/metrics, 0 disables')
+    parser.add_argument(
+        '--progress-interval',
+        default=30.0,
+        type=float,
+        help='seconds between progress lines, 0 disables')
+    parser.add_argument(
+        '--plan',
+        action='store_true',
+        help='only scan the inputs and report examples, characters, unique texts, oversize texts, '
+             'and projected requests and time for the given --workers, --concurrency and --pack-chars')
+    parser.add_argument(
+        '--plan-latency',
+        default=1.0,
+        type=float,
+        help='seconds per request assumed by --plan')
+    parser.add_argument(
+        '--plan-processes',
+        default=os.cpu_count(),
+        type=int,
+        help='processes scanning the inputs for --plan')
+    parser.add_argument(
+        '--plan-output',
+        default=None,
+        help='also write the --plan report to this JSON file')
+    parser.add_argument(
+        '--coordinator',
+        default=None,
+        help='work as a worker of coordinator.py: its SQLite file or http:// URL. '
+             'Inputs are read from the p3_{task}_{split}.jsonl files of the current directory')
+    parser.add_argument(
+        '--export',
+        action='store_true',
+        help='with --coordinator, write the outputs of the tasks it has finished instead of translating')
+    parser.add_argument(
+        '--lease-seconds',
+        default=600.0,
+        type=float,
+        help='lease of a coordinator unit, renewed while it is being translated')
+    parser.add_argument(
+        '--lease-prefetch',
+        default=2,
+        type=int,
+        help='coordinator units leased ahead of the busy workers')
+    parser.add_argument(
+        '--worker-id',
+        default=None,
+        help='name of this worker at the coordinator, host name and pid by default')
+    parser.add_argument(
+        '--dead-letters',
+        default='dead_letters.db',
+        help='SQLite store of the examples that failed, for --replay-failures')
+    parser.add_argument(
+        '--replay-failures',
+        action='store_true',
+        help='translate only the examples in --dead-letters again and patch them into the existing outputs')
+    parser.add_argument(
+        '--resume',
+        action='store_true',
+        help='skip examples found in the checkpoint journals of a previous run')
+    parser.add_argument(
+        '--segment-templates',
+        action='store_true',
+        help='translate the constant prompt template fragments of each task once')
+    parser.add_argument(
+        '--cache-path',
+        default='translation_memory.db',
+        help='SQLite translation memory shared across tasks and runs')
+    parser.add_argument(
+        '--cache-max-entries',
+        default=5000000,
+        type=int,
+        help='evict the least recently used translations above this size')
+    parser.add_argument(
+        '--no-cache',
+        action='store_true',
+        help='always call the translator, skip the translation memory')
+    return parser
+
+def parse_args():
+    args = build_parser().parse_args()
     return args
 
+# Move tasks from the incompleted list of a split to its translated list
+def mark_finished(split, task_names):
+    if not task_names:
+        return
+    with open(f'{split}_translated_list.txt', 'a+') as fp:
+        for task_name in task_names:
+            fp.write("%s\n" %task_name)
+    incompleted_path = f'incompleted_{split}_task_list.txt'
+    if os.path.exists(incompleted_path):
+        with open(incompleted_path) as fp:
+            incompleted = [line.rstrip("\n") for line in fp if line.strip()]
+        with open(incompleted_path, 'w') as ft:
+            for task_name in incompleted:
+                if task_name not in task_names:
+                    ft.write("%s\n" %task_name)
+    print(f'Write {split} translated_list successuflly!')
+
+# Tasks of a split listed in its translated list by earlier runs
+def translated_tasks(split):
+    path = f'{split}_translated_list.txt'
+    if not os.path.exists(path):
+        return set()
+    with open(path) as fp:
+        return {line.strip() for line in fp if line.strip()}
+
+# Count the examples of every task in the background, for the ETA
+def count_examples(task_list, splits, progress, finished=None):
+    finished = finished or {}
+    for split in splits:
+        for task_name in task_list:
+            if task_name in finished.get(split, ()):
+                continue
+            try:
+                with open(f'p3_{task_name}_{split}.jsonl', 'rb') as fp:
+                    total = sum(chunk.count(b'\n') for chunk in iter(partial(fp.read, 1 << 20), b''))
+                progress.set_total(progress_key(task_name, split, splits), total)
+            except OSError:
+                pass
+
+# Progress and log label of a task, with its split when several are translated
+def progress_key(task_name, split, splits):
+    return task_name if len(splits) == 1 else f'{task_name}/{split}'
+
+def run_summary(run_metrics):
+    requests = run_metrics.total('translate_requests_total')
+    errors = run_metrics.total('translate_request_errors_total')
+    hits = run_metrics.total('cache_hits_total')
+    lookups = hits + run_metrics.total('cache_misses_total')
+    return (f'{requests:.0f} requests, {errors / requests if requests else 0:.1%} errors, '
+            f'{run_metrics.total("translate_retries_total"):.0f} retries, '
+            f'{run_metrics.total("translate_failed_calls_total"):.0f} failed, '
+            f'cache hit {hits / lookups if lookups else 0:.1%}, '
+            f'{run_metrics.value("scheduler_pending_units"):.0f} units pending, '
+            f'rate {run_metrics.value("rate_limit_requests_per_second"):.1f} req/s')
+
+def report_progress(progress, refresh, interval):
+    while True:
+        time.sleep(interval)
+        line = f'[progress] {progress.line()} | {run_summary(refresh())}'
+        print(line, flush=True)
+        logger.info(line)
+
+# Distributed mode: lease units from the coordinator until every unit is done.
+# Leased units are kept in `leases` by id until their result is reported.
+def coordinator_units(coordinator, owner, lease_seconds, leases, segment_templates=False):
+    segmenters = {}
+    while True:
+        try:
+            lease = coordinator.lease(owner, lease_seconds)
+        except Exception as err:
+            # e.g. the coordinator restarting, try again shortly
+            logger.error(err)
+            print(f'Could not lease a unit: {type(err).__name__}: {err}')
+            time.sleep(5.0)
+            continue
+        if lease is None:
+            return
+        if 'wait' in lease:
+            # every unit left is leased, ours finish or the lease of a crashed worker expires
+            time.sleep(min(max(lease['wait'], 0.5), 5.0))
+            continue
+        task_name, split = lease['task'], lease['split']
+        examples, error = None, None
+        try:
+            if segment_templates and (task_name, split) not in segmenters:
+                segmenters[task_name, split] = fit_segmenter(iter_json(task_name, split))
+            examples = read_unit(task_name, split, lease['byte_offset'], lease['count'])
+        except Exception as err:
+            error = f'{type(err).__name__}: {err}'
+        leases[lease['id']] = lease
+        yield WorkUnit(task_name, split, lease['id'], lease['start'], examples,
+                       segmenters.get((task_name, split)), error=error)
+
+def renew_leases(coordinator, leases, lease_seconds):
+    while True:
+        time.sleep(lease_seconds / 3)
+        for unit_id, lease in list(leases.items()):
+            try:
+                coordinator.heartbeat(unit_id, lease['token'], lease_seconds)
+            except Exception as err:
+                logger.error(err)
+
+# Units a worker translates at once: the async engine starts more units while the requests
+# of earlier ones are in flight, so its --concurrency slots stay busy
+def units_per_worker(args):
+    return args.concurrency if args.engine == 'async' else 1
+
+def run_worker(coordinator, args):
+    owner = args.worker_id or f'{socket.gethostname()}-{os.getpid()}'
+    leases = {}
+    renewer = threading.Thread(target=renew_leases, args=(coordinator, leases, args.lease_seconds), daemon=True)
+    # Every pending unit is a lease: hold only what the workers can start soon,
+    # so other hosts still find units near the end of the run
+    scheduler = Scheduler(args.workers, args.workers * units_per_worker(args) + args.lease_prefetch,
+                          unit_threads=units_per_worker(args))
+    units = start_with_units(coordinator_units(coordinator, owner, args.lease_seconds, leases, args.segment_templates),
+                             [renewer.start])
+    worker_fn = partial(translate_unit, engine=args.engine, concurrency=args.concurrency)
+    run_metrics = Metrics()
+    print(f'Worker {owner} pulling units from {args.coordinator}')
+    for unit, result, error in scheduler.run(worker_fn, units):
+        lease = leases.pop(unit.index)
+        if error is not None:
+            logger.error(error)
+            print(f'Exception when translating task name: {unit.task_name} ({unit.split}), unit {unit.index}')
+            try:
+                coordinator.fail(unit.index, lease['token'], error)
+            except Exception as err:
+                # the lease expires and the unit is leased again
+                logger.error(err)
+                run_metrics.inc('coordinator_errors_total')
+            continue
+        records, unit_metrics, failures = result
+        run_metrics.merge(unit_metrics)
+        run_metrics.inc('examples_total', len(records))
+        run_metrics.inc('failed_examples_total', sum(1 for record in records if not record))
+        try:
+            kept = coordinator.complete(unit.index, lease['token'], records, failures)
+        except Exception as err:
+            # the lease expires and the unit is translated again
+            logger.error(err)
+            print(f'Could not report unit {unit.index} of {unit.task_name} ({unit.split}): {type(err).__name__}: {err}')
+            run_metrics.inc('coordinator_errors_total')
+            continue
+        if not kept:
+            # another worker reported this unit first
+            run_metrics.inc('duplicate_units_total')
+        run_metrics.inc('units_total')
+    run_metrics.merge(METRICS.drain())
+    run_metrics.set('rate_limit_requests_per_second', rate_limiter.rate)
+    print(f'Worker {owner} done: {run_metrics.total("units_total"):.0f} units, '
+          f'{run_metrics.total("examples_total"):.0f} examples, '
+          f'{run_metrics.total("duplicate_units_total"):.0f} duplicates dropped')
+    print(f'Run summary: {run_summary(run_metrics)}')
+
+# Write the outputs of the tasks the coordinator has finished
+def export_results(coordinator, output_format, max_shard_bytes=MAX_SHARD_BYTES, chunk_size=1000):
+    for task in coordinator.finished():
+        task_name, split = task['task'], task['split']
+        if task['error'] or task['error_units']:
+            print(f'Exception when translating task name: {task_name} ({split}): {task["error"] or "units given up"}')
+            continue
+        writer = TaskWriter(task_name, split, output_format, max_shard_bytes=max_shard_bytes, checkpoint=False)
+        results = (record if record and output_format in ('arrow', 'parquet')
+                   else {field: record[field] for field in FIELDS} if record else record
+                   for _, record in coordinator.results(task_name, split))
+        index = 0
+        chunk = list(islice(results, chunk_size))
+        while True:
+            next_chunk = list(islice(results, chunk_size))
+            writer.add(WorkUnit(task_name, split, index, index * chunk_size, None, last=not next_chunk), chunk, None)
+            if not next_chunk:
+                break
+            index += 1
+            chunk = next_chunk
+        if writer.count != task['examples']:
+            writer.errors.append(f'{writer.count} results for {task["examples"]} examples')
+        writer.close()
+        if writer.errors:
+            print(f'Exception when exporting task name: {task_name} ({split}): {writer.errors}')
+            continue
+        coordinator.mark_exported(task_name, split)
+        print(f'Done translation translated: {task_name} ({split}), {writer.count} examples, {writer.failed} failed.')
+        if not writer.failed:
+            mark_finished(split, [task_name])
+
+# Dry run: scan the inputs and print what translating them would cost
+def run_plan(task_list, args):
+    in_flight = args.workers * (args.concurrency if args.engine == 'async' else 1)
+    if args.proxy_pool:
+        in_flight = min(in_flight, len(args.proxy_pool) * args.proxy_concurrency)
+    plans, totals = make_plan(task_list, args.split, args.pack_chars, args.unit_size, args.plan_processes)
+    print(format_plan(plans, totals, in_flight, args.plan_latency, args.max_rate, memory=not args.no_cache))
+    if args.plan_output:
+        with open(args.plan_output, 'w') as fp:
+            json.dump({'tasks': plans, 'totals': totals, 'in_flight': in_flight,
+                       'latency': args.plan_latency, 'max_rate': args.max_rate}, fp, indent=2)
+        print(f'Write plan to {args.plan_output}')
+
+# Set the globals the workers inherit, before any worker is forked
+def setup(args):
+    global backend, proxy_pool, translation_memory, pack_chars, rate_limiter, retry_budget, max_retries
+    if args.proxy_pool:
+        proxy_pool = ProxyPool([parse_endpoint(spec, args.proxy_concurrency, args.tor_password)
+                                for spec in args.proxy_pool])
+    backend = make_backend(args.backend, url=args.backend_url, proxy=args.proxy, pool=proxy_pool)
+    pack_chars = args.pack_chars
+    rate_limiter = AdaptiveRateLimiter(args.rate, min_rate=args.min_rate, max_rate=args.max_rate)
+    retry_budget = RetryBudget(args.retry_ratio)
+    max_retries = args.max_retries
+    if not args.no_cache:
+        translation_memory = TranslationMemory(args.cache_path, max_entries=args.cache_max_entries)
+
+def get_output_format(args):
+    global keep_source
+    output_format = 'jsonl' if args.stream and args.output_format == 'json' else args.output_format
+    keep_source = output_format in ('arrow', 'parquet')
+    return output_format
+
 def main():
+    global keep_source
     args = parse_args()
+    output_format = get_output_format(args)
     with open(args.path, 'r+') as f:
         files = f.readlines()
     TASK_LIST = []
     for i in range(len(files)):
         files[i] = files[i].rstrip("\n")
         TASK_LIST.append(files[i])
-    FINISHED_TASK_LIST = []
+    if args.plan:
+        run_plan(TASK_LIST, args)
+        return
+    if args.coordinator and args.export:
+        export_results(connect(args.coordinator), output_format, args.shard_size_mb * 1024 * 1024)
+        return
+    setup(args)
+    if args.coordinator:
+        # Results go to the coordinator, with the source texts so any output format can be exported
+        keep_source = True
+        run_worker(connect(args.coordinator), args)
+        return
+    dead_letters = DeadLetterStore(args.dead_letters)
+    if args.replay_failures:
+        finished = replay_failures(TASK_LIST, args.split, dead_letters, args.concurrency)
+        for split in args.split:
+            mark_finished(split, finished[split])
+        print(f'{dead_letters.count()} failed examples left in {args.dead_letters}')
+        return
+    finished = {}
+    if args.resume:
+        # Finished tasks have no checkpoint journal left, the translated lists tell them apart
+        finished = {split: translated_tasks(split) & set(TASK_LIST) for split in args.split}
+        for split in args.split:
+            print(f'{len(finished[split])} tasks already translated ({split})')
+    progress = Progress()
+    counter = threading.Thread(target=count_examples, args=(TASK_LIST, args.split, progress, finished), daemon=True)
+    units = start_with_units(
+        iter_units(TASK_LIST, args.split, args.unit_size, args.segment_templates, args.resume, finished),
+        [counter.start])
+    run_units(units, TASK_LIST, args, output_format, dead_letters, progress, finished)
 
-    for task_name in TASK_LIST:
-        try:
-            data = read_json(task_name, args.split)
-            data_size = len(data)
-            data_chunks = list(divide_chunks(data, int(data_size / 16)))
-            print(f'Starting translation task: {task_name}...')
-            pool_chunks = (data_chunks[0:2], data_chunks[2:4],data_chunks[4:6], data_chunks[6:8], data_chunks[8:10], data_chunks[10:12], data_chunks[12:14], data_chunks[14:])
-            with Pool(8) as pool:
-                # translated length: len = 5 corresponds to 8 chunks (corresponds to 8 cores)
-                # translated_list_1: chunk 0, 2, 4, 6, 8, 10, 12, 14, (16)
-                # translated_list_2: chunk 1, 3, 5, 7, 9, 11, 13, 15
-                translated_list_1, translated_list_2 = zip(*pool.map(partial(translate_chunks, task_name), pool_chunks))
-                # report a message
-                print('Done translation translated.')
-
-            translated_list = translated_list_1 + translated_list_2
-            save_translated_json(translated_list, task_name, args.split)
-        
-            # if translated successful add this task_name to the translated list
-            FINISHED_TASK_LIST.append(task_name)
-            # write translated list to file
-            with open(f'{args.split}_translated_list.txt', 'a+') as fp:
-                fp.write("%s\n" %task_name)
-                print(f'Write {args.split} translated_list successuflly!')
+# Translate the units and write every task as it completes, with the per-split bookkeeping files
+# `finished` has the tasks already done per split, left out of the incompleted lists
+def run_units(units, TASK_LIST, args, output_format, dead_letters, progress, finished=None):
+    # Bookkeeping files stay per split
+    FINISHED_TASK_LIST = {split: list((finished or {}).get(split, [])) for split in args.split}
+
+    max_pending = max(args.workers * units_per_worker(args), args.queue_size // args.unit_size)
+    scheduler = Scheduler(args.workers, max_pending, hold_results=True, unit_threads=units_per_worker(args))
+    worker_fn = partial(translate_unit, engine=args.engine, concurrency=args.concurrency)
+    writers = {}
+
+    # Metrics of the whole run: the workers' snapshots plus this process's own
+    run_metrics = Metrics()
+
+    def refresh():
+        run_metrics.merge(METRICS.drain())
+        run_metrics.set('scheduler_pending_units', scheduler.pending)
+        run_metrics.set('reorder_buffer_units', sum(len(writer.buffer) for writer in list(writers.values())))
+        run_metrics.set('active_tasks', len(writers))
+        run_metrics.set('rate_limit_requests_per_second', rate_limiter.rate)
+        for endpoint in proxy_pool.stats() if proxy_pool is not None else []:
+            run_metrics.set('proxy_latency_seconds', endpoint['latency'], endpoint=endpoint['url'])
+            run_metrics.set('proxy_error_rate', endpoint['error_rate'], endpoint=endpoint['url'])
+            run_metrics.set('proxy_in_flight', endpoint['in_flight'], endpoint=endpoint['url'])
+            run_metrics.set('proxy_ejected', int(endpoint['ejected']), endpoint=endpoint['url'])
+        return run_metrics
 
+    def start_metrics():
+        serve_metrics(lambda: refresh().render(), args.metrics_port)
+        print(f'Serving metrics on http://127.0.0.1:{args.metrics_port}/metrics')
+
+    # Started once the workers are forked
+    starts = []
+    if args.metrics_port:
+        starts.append(start_metrics)
+    if args.progress_interval > 0:
+        starts.append(threading.Thread(target=report_progress, args=(progress, refresh, args.progress_interval),
+                                       daemon=True).start)
+
+    for unit, result, error in scheduler.run(worker_fn, start_with_units(units, starts)):
+        task_name, split = unit.task_name, unit.split
+        key = progress_key(task_name, split, args.split)
+        records = None
+        if result is not None:
+            records, unit_metrics, failures = result
+            run_metrics.merge(unit_metrics)
+            run_metrics.inc('examples_total', len(records))
+            run_metrics.inc('failed_examples_total', sum(1 for record in records if record == {}))
+            progress.advance(key, len(records))
+        if (task_name, split) not in writers:
+            writers[task_name, split] = TaskWriter(task_name, split, output_format, args.resume,
+                                                   args.shard_size_mb * 1024 * 1024, dead_letters)
+        writer = writers[task_name, split]
+        if result is not None:
+            dead_letters.add(failures)
+        scheduler.release(writer.add(unit, records, error))
+        if not writer.finished:
+            continue
+
+        del writers[task_name, split]
+        progress.finish(key)
+        try:
+            writer.close()
         except Exception as err:
-            # if Exception occurs, write the rest of the list to the task_list file
-            print(f'Exception when translating task name: {task_name}')
-            logger.error(err)
+            writer.errors.append(f'{type(err).__name__}: {err}')
+        if writer.errors:
+            # the task stays in the incompleted list
+            print(f'Exception when translating task name: {task_name} ({split})')
+            for error in writer.errors:
+                logger.error(error)
             print("Writing log. Continue to translate... ")
+            continue
+
+        print(f'Done translation translated: {task_name} ({split}), {writer.count} examples, {writer.failed} failed.')
+        if translation_memory is not None:
+            print(f'Translation memory: {translation_memory.stats()}')
+        if writer.failed:
+            # the task stays in the incompleted list, --resume only retries the failed examples
+            continue
+        # if translated successful add this task_name to the translated list
+        FINISHED_TASK_LIST[split].append(task_name)
+        # write translated list to file
+        with open(f'{split}_translated_list.txt', 'a+') as fp:
+            fp.write("%s\n" %task_name)
+            print(f'Write {split} translated_list successuflly!')
 
-    # remove finished tasks in the original task list
-    for task_name in FINISHED_TASK_LIST:
-        TASK_LIST.remove(task_name)
-    # Write again incompleted task list        
-    with open(f'incompleted_{args.split}_task_list.txt', 'w') as ft:
-        for task_name in TASK_LIST:
-            ft.write("%s\n" %task_name)
-        print(f'Write incompleted {args.split} task list after translating')
+    for split in args.split:
+        # remove finished tasks in the original task list, and the ones the units
+        # generator found finished while the run went on (e.g. a split a task does not have)
+        done = set(FINISHED_TASK_LIST[split]) | set((finished or {}).get(split, ()))
+        incompleted = [task_name for task_name in TASK_LIST if task_name not in done]
+        # Write again incompleted task list
+        with open(f'incompleted_{split}_task_list.txt', 'w') as ft:
+            for task_name in incompleted:
+                ft.write("%s\n" %task_name)
+            print(f'Write incompleted {split} task list after translating')
+    for task_name, split, error_class, count in dead_letters.summary():
+        print(f'Failed examples: {task_name} ({split}) {count} {error_class}')
+    if dead_letters.count():
+        print('Translate them again with --replay-failures')
+    print(f'Run summary: {run_summary(refresh())}')
+    if translation_memory is not None:
+        # the workers have exited and written their pending hits by now
+        print(f'Translation memory: {translation_memory.stats()}')
     
 if __name__ == '__main__':
     main()
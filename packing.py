@@ -0,0 +1,59 @@
+import re
+
+from template_segmenter import strip_parts
+
+"""
+Request packing: many short segments are joined into one translate call.
+
+Segments are joined with a delimiter line the translator leaves untouched and
+the reply is split on it again. A reply that does not split back into the
+same number of segments is reported as None so the caller can fall back to
+one segment per request. Texts containing a bar are never packed.
+"""
+
+# Google Translate rejects requests above ~5000 characters
+MAX_REQUEST_CHARS = 4500
+DELIMITER = '\n|||\n'
+# The translator may eat or add spaces around the bars
+DELIMITER_PATTERN = re.compile(r'\s*\|\s*\|\s*\|\s*')
+
+
+def can_pack(text):
+    # A bar next to the delimiter would merge with it and shift text between segments
+    return '|' not in text
+
+
+def pack_segments(texts, max_chars=MAX_REQUEST_CHARS, delimiter=DELIMITER):
+    # Group segment indexes into batches whose joined size stays under max_chars
+    batches = []
+    batch, size = [], 0
+    for i, text in enumerate(texts):
+        length = len(text.strip())
+        if not can_pack(text) or length + len(delimiter) > max_chars:
+            batches.append([i])
+            continue
+        if batch and size + len(delimiter) + length > max_chars:
+            batches.append(batch)
+            batch, size = [], 0
+        size += length + (len(delimiter) if batch else 0)
+        batch.append(i)
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def join_segments(texts, delimiter=DELIMITER):
+    return delimiter.join(text.strip() for text in texts)
+
+
+def split_segments(reply, texts):
+    # Split a packed reply back into one translation per text, keeping each
+    # text's surrounding whitespace. None when the segment count changed.
+    parts = DELIMITER_PATTERN.split(reply.strip())
+    if len(parts) != len(texts):
+        return None
+    result = []
+    for text, part in zip(texts, parts):
+        lead, _, trail = strip_parts(text)
+        result.append(lead + part + trail)
+    return result
@@ -0,0 +1,152 @@
+import json
+import os
+import queue
+import threading
+from functools import partial
+
+import p3_translated
+from dead_letters import DeadLetterStore
+from metrics import Progress
+from prepare_p3 import iter_rows, load_task
+from p3_translated import (build_parser, get_output_format, mark_finished, progress_key, run_units, setup, task_units,
+                           translated_tasks)
+
+"""
+Commands:
+python3 pipeline.py --path task_list.txt --split train validation --workers 8 --output-format arrow
+python3 pipeline.py --path task_list.txt --split train --source disk --keep-inputs
+python3 pipeline.py --path task_list.txt --split train --resume
+
+Loads P3 tasks and translates them in one run, without exporting every task
+to JSONL first.
+
+`--loaders` threads load tasks from the hub (or the local `load_from_disk`
+copy with `--source disk`) into a queue of at most `--prefetch-tasks` loaded
+tasks. Their rows are cut into work units and translated as soon as the task
+is taken from the queue. The queue and the scheduler's pending units are the
+backpressure: a loader waits while the queue is full, and no rows are read
+while `--queue-size` examples are waiting for a worker. Loading never gets
+more than a few tasks ahead of translation, and the first task is written
+as soon as it is translated.
+
+With `--keep-inputs`, the rows read are also written to
+`p3_{task}_{split}.jsonl`, so the same inputs can be used by
+`p3_translated.py` later. Outputs, checkpoints, dead letters and the
+bookkeeping files are the ones of `p3_translated.py`; `--resume` also skips
+the tasks already in `{split}_translated_list.txt`.
+"""
+
+
+def parse_args():
+    parser = build_parser('Load and translate P3 tasks in one pipeline')
+    parser.add_argument('--source', choices=['hub', 'disk'], default='hub',
+                        help='Load tasks from the hub or from the local load_from_disk copy')
+    parser.add_argument('--loaders', type=int, default=2, help='Threads loading tasks')
+    parser.add_argument('--prefetch-tasks', type=int, default=2,
+                        help='Loaded tasks waiting for translation, at most')
+    parser.add_argument('--batch-size', type=int, default=1000, help='Rows read from a task at a time')
+    parser.add_argument('--keep-inputs', action='store_true',
+                        help='Also write the rows read to p3_{task}_{split}.jsonl')
+    return parser.parse_args()
+
+
+def load_tasks(task_names, source, loaded, stop):
+    # Loader thread: put (task, dataset, error) in `loaded`, blocking while it is full
+    while not stop.is_set():
+        try:
+            task_name = task_names.get(block=False)
+        except queue.Empty:
+            return
+        try:
+            item = (task_name, load_task(task_name, source), None)
+        except Exception as err:
+            item = (task_name, None, err)
+        while not stop.is_set():
+            try:
+                loaded.put(item, timeout=1)
+                break
+            except queue.Full:
+                continue
+
+
+def tee_rows(examples, path):
+    # Write the examples to `path` while they are read, moved in place once all were read
+    with open(path + '.tmp', 'w', encoding='utf-8') as fp:
+        for example in examples:
+            fp.write(json.dumps(dict(zip(p3_translated.FIELDS, example)), ensure_ascii=False) + '\n')
+            yield example
+    os.replace(path + '.tmp', path)
+
+
+def read_split(dataset, batch_size, path=None):
+    examples = ([row['inputs'], row['targets']] for row in iter_rows(dataset, batch_size))
+    return tee_rows(examples, path) if path else examples
+
+
+def raise_error(error):
+    raise error
+
+
+def pipeline_units(task_list, splits, args, progress, finished=None):
+    # Work units of every (task, split), loading each task once for all its splits.
+    # Started by the scheduler after its workers are forked, so no loader thread is ever forked.
+    # Splits in `finished` are skipped, tasks finished for every split are not loaded.
+    # A split the task does not have is added to `finished` and to the translated list,
+    # like the missing_splits of prepare_p3.py, so --resume does not load the task again for it.
+    if finished is None:
+        finished = {}
+    task_list = [task_name for task_name in task_list
+                 if not all(task_name in finished.get(split, ()) for split in splits)]
+    task_names = queue.Queue()
+    for task_name in task_list:
+        task_names.put(task_name)
+    loaded = queue.Queue(maxsize=max(1, args.prefetch_tasks))
+    stop = threading.Event()
+    loaders = [threading.Thread(target=load_tasks, args=(task_names, args.source, loaded, stop), daemon=True)
+               for _ in range(max(1, args.loaders))]
+    for loader in loaders:
+        loader.start()
+    try:
+        for _ in range(len(task_list)):
+            task_name, ds, error = loaded.get()
+            for split in splits:
+                if task_name in finished.get(split, ()):
+                    continue
+                key = progress_key(task_name, split, splits)
+                if error is not None:
+                    # task_units turns the loading error into an error unit
+                    read = partial(raise_error, error)
+                elif split not in ds:
+                    print(f'{task_name} has no {split} split, skipped')
+                    finished.setdefault(split, set()).add(task_name)
+                    mark_finished(split, [task_name])
+                    continue
+                else:
+                    progress.set_total(key, ds[split].num_rows)
+                    path = f'p3_{task_name}_{split}.jsonl' if args.keep_inputs else None
+                    read = partial(read_split, ds[split], args.batch_size, path)
+                yield from task_units(task_name, split, read, args.unit_size, args.segment_templates, args.resume)
+            del ds
+    finally:
+        stop.set()
+
+
+def main():
+    args = parse_args()
+    output_format = get_output_format(args)
+    with open(args.path, 'r') as f:
+        task_list = [line.rstrip('\n') for line in f if line.strip()]
+    setup(args)
+    finished = {}
+    if args.resume:
+        finished = {split: translated_tasks(split) & set(task_list) for split in args.split}
+        for split in args.split:
+            print(f'{len(finished[split])} tasks already translated ({split})')
+    dead_letters = DeadLetterStore(args.dead_letters)
+    progress = Progress()
+    units = pipeline_units(task_list, args.split, args, progress, finished)
+    run_units(units, task_list, args, output_format, dead_letters, progress, finished)
+
+
+if __name__ == '__main__':
+    main()
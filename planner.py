@@ -0,0 +1,162 @@
+import hashlib
+import json
+import math
+from functools import partial
+from multiprocessing import Pool
+
+from long_docs import split_text, sort_by_length
+from packing import DELIMITER, MAX_REQUEST_CHARS, pack_segments
+
+"""
+Dry-run planner: what a run would cost, without translating anything.
+
+Every (task, split) input file is scanned by a pool of processes. Each task
+is cut into work units like a real run. Inside a unit, texts already seen
+earlier in the task are left out, as translation memory hits. The remaining
+texts are split and packed exactly as `p3_translated.py` would, which gives
+the number of requests. Duplicates across tasks are estimated with a
+HyperLogLog sketch merged over all tasks; they only change the projection
+with the translation memory enabled. Wall time assumes every request takes
+`latency` seconds, with `workers * concurrency` of them in flight and no
+more than `max_rate` per second.
+"""
+
+HLL_PRECISION = 14
+
+
+def text_hash(text):
+    return int.from_bytes(hashlib.blake2b(text.encode('utf-8'), digest_size=8).digest(), 'big')
+
+
+class HyperLogLog:
+    def __init__(self, precision=HLL_PRECISION):
+        self.precision = precision
+        self.registers = bytearray(1 << precision)
+
+    def add_hash(self, value):
+        # value is a 64 bit hash: the first bits pick a register, the rest give the rank
+        index = value >> (64 - self.precision)
+        rest = value & ((1 << (64 - self.precision)) - 1)
+        rank = (64 - self.precision) - rest.bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def merge(self, other):
+        self.registers = bytearray(max(a, b) for a, b in zip(self.registers, other.registers))
+
+    def count(self):
+        m = len(self.registers)
+        estimate = 0.7213 / (1 + 1.079 / m) * m * m / sum(2.0 ** -register for register in self.registers)
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * m and zeros:
+            # small range correction
+            return m * math.log(m / zeros)
+        return estimate
+
+
+def unit_requests(texts, pack_chars):
+    # Requests and characters sent for the texts of one unit, packed like _translate_texts
+    max_chars = pack_chars or MAX_REQUEST_CHARS
+    segments = list(dict.fromkeys(piece for text in texts for piece in split_text(text, max_chars) if piece.strip()))
+    segments = [segments[i] for i in sort_by_length(segments)]
+    if pack_chars:
+        batches = pack_segments(segments, pack_chars)
+    else:
+        batches = [[i] for i in range(len(segments))]
+    chars = sum(len(segment.strip()) for segment in segments) + len(DELIMITER) * (len(segments) - len(batches))
+    return len(batches), chars
+
+
+def plan_task(task_split, pack_chars=MAX_REQUEST_CHARS, unit_size=32):
+    task_name, split = task_split
+    plan = {'task': task_name, 'split': split, 'examples': 0, 'texts': 0, 'chars': 0, 'unique_texts': 0,
+            'unique_chars': 0, 'oversize': 0, 'max_chars': 0, 'requests': 0, 'request_chars': 0, 'error': None}
+    max_chars = pack_chars or MAX_REQUEST_CHARS
+    seen = set()
+    sketch = HyperLogLog()
+    unit = []
+    try:
+        with open(f'p3_{task_name}_{split}.jsonl', 'r', encoding='utf-8') as json_file:
+            for json_str in json_file:
+                if not json_str.strip():
+                    continue
+                plan['examples'] += 1
+                for text in json.loads(json_str).values():
+                    plan['texts'] += 1
+                    plan['chars'] += len(text)
+                    plan['max_chars'] = max(plan['max_chars'], len(text))
+                    if len(text) > max_chars:
+                        plan['oversize'] += 1
+                    if not text.strip():
+                        continue
+                    value = text_hash(text)
+                    if value in seen:
+                        continue
+                    seen.add(value)
+                    sketch.add_hash(value)
+                    plan['unique_texts'] += 1
+                    plan['unique_chars'] += len(text)
+                    unit.append(text)
+                if plan['examples'] % unit_size == 0:
+                    requests, chars = unit_requests(unit, pack_chars)
+                    plan['requests'] += requests
+                    plan['request_chars'] += chars
+                    unit = []
+        requests, chars = unit_requests(unit, pack_chars)
+        plan['requests'] += requests
+        plan['request_chars'] += chars
+    except Exception as err:
+        plan['error'] = f'{type(err).__name__}: {err}'
+    return plan, bytes(sketch.registers)
+
+
+def projected_seconds(requests, in_flight, latency, max_rate):
+    rate = min(max_rate, in_flight / latency) if latency > 0 else max_rate
+    return requests / rate if rate > 0 else None
+
+
+def make_plan(task_list, splits, pack_chars=MAX_REQUEST_CHARS, unit_size=32, processes=8):
+    # Return the per-task plans and the run totals
+    jobs = [(task_name, split) for split in splits for task_name in task_list]
+    sketch = HyperLogLog()
+    plans = []
+    with Pool(processes) as pool:
+        for plan, registers in pool.imap_unordered(partial(plan_task, pack_chars=pack_chars, unit_size=unit_size), jobs):
+            task_sketch = HyperLogLog()
+            task_sketch.registers = bytearray(registers)
+            sketch.merge(task_sketch)
+            plans.append(plan)
+    order = {job: i for i, job in enumerate(jobs)}
+    plans.sort(key=lambda plan: order[plan['task'], plan['split']])
+    totals = {key: sum(plan[key] for plan in plans) for key in
+              ('examples', 'texts', 'chars', 'unique_texts', 'unique_chars', 'oversize', 'requests', 'request_chars')}
+    totals['max_chars'] = max([plan['max_chars'] for plan in plans] or [0])
+    totals['global_unique_texts'] = min(totals['unique_texts'], int(round(sketch.count())))
+    return plans, totals
+
+
+def format_plan(plans, totals, in_flight, latency, max_rate, memory=True):
+    def minutes(requests):
+        seconds = projected_seconds(requests, in_flight, latency, max_rate)
+        return f'{seconds / 60:.1f}' if seconds is not None else '?'
+
+    lines = [f'{"task":<60} {"split":<10} {"examples":>9} {"chars":>12} {"unique":>7} {"oversize":>8} '
+             f'{"requests":>9} {"minutes":>8}']
+    for plan in plans:
+        if plan['error']:
+            lines.append(f'{plan["task"]:<60} {plan["split"]:<10} {plan["error"]}')
+            continue
+        unique = plan['unique_texts'] / plan['texts'] if plan['texts'] else 0
+        lines.append(f'{plan["task"]:<60} {plan["split"]:<10} {plan["examples"]:>9} {plan["chars"]:>12} '
+                     f'{unique:>7.1%} {plan["oversize"]:>8} {plan["requests"]:>9} {minutes(plan["requests"]):>8}')
+    requests = totals['requests']
+    if memory and totals['unique_texts']:
+        # Texts shared by several tasks are only translated once with the translation memory
+        requests = int(round(requests * totals['global_unique_texts'] / totals['unique_texts']))
+    unique = totals['global_unique_texts'] / totals['texts'] if totals['texts'] else 0
+    lines.append(f'{"total":<60} {"":<10} {totals["examples"]:>9} {totals["chars"]:>12} '
+                 f'{unique:>7.1%} {totals["oversize"]:>8} {requests:>9} {minutes(requests):>8}')
+    lines.append(f'{totals["unique_chars"]} unique characters, {totals["request_chars"]} characters sent, '
+                 f'longest text {totals["max_chars"]} characters; {in_flight} requests in flight, '
+                 f'{latency}s per request, at most {max_rate} requests/s')
+    return '\n'.join(lines)
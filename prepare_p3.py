@@ -1,8 +1,10 @@
 from functools import partial
+import argparse
+import hashlib
+import json
 import os
 import multiprocessing
 from datasets import load_dataset, load_from_disk
-import jsonlines
 
 """Get task list:
 !git clone https://github.com/bigscience-workshop/t-zero.git
@@ -17,8 +19,17 @@ print(tasks)
 
 
 
-After running the script, merge train & validation jsonls separately into two big files:
-cat folder_with_all_jsonl/*.jsonl > merged_file.jsonl
+After translating, merge the outputs of every task into one deduplicated and
+shuffled dataset per split (see merge_outputs.py):
+python3 merge_outputs.py --path task_list.txt --split train validation
+
+Commands:
+python3 prepare_p3.py --splits train validation --processes 8
+python3 prepare_p3.py --source disk --tasks task_list.txt
+
+Each task is loaded once and all requested splits are written in one pass.
+Finished tasks are recorded in p3_manifest.json (rows, bytes and sha256 of
+every file) and skipped on the next run unless --force is given.
 """
 TZERO_TASK_LIST = [
     'adversarial_qa_dbert_answer_the_following_q',
@@ -336,37 +347,172 @@ TZERO_TASK_LIST = [
     'yelp_review_full_this_place'
 ]
 
-with open('task_list.txt', 'w') as fp:
-    for task_name in TZERO_TASK_LIST:
-        task_name = task_name.replace("'", "")
-        fp.write("%s\n" %task_name)
+MANIFEST = 'p3_manifest.json'
+
+
+def write_task_list(path='task_list.txt'):
+    with open(path, 'w') as fp:
+        for task_name in TZERO_TASK_LIST:
+            task_name = task_name.replace("'", "")
+            fp.write("%s\n" %task_name)
 
 
 # Optonally download all first
 # for task_name in TZERO_TASK_LIST:
 #     ds = load_dataset("bigscience/P3", task_name)
 
+def load_task(task_name, source='hub'):
+    if source == 'disk':
+        return load_from_disk(f"{os.environ['six_ALL_CCFRSCRATCH']}/datasets/p3/{task_name}")
+    return load_dataset("bigscience/P3", task_name)
+
+
+def iter_rows(dataset, batch_size=1000):
+    # Arrow batch iteration: columns are read a batch at a time, no per-row select() copy
+    for batch in dataset.iter(batch_size=batch_size):
+        for inputs, targets in zip(batch["inputs_pretokenized"], batch["targets_pretokenized"]):
+            yield {"inputs": inputs, "targets": targets}
+
+
+def write_split(dataset, path, batch_size=1000):
+    # Write one split to a temporary file and move it in place once complete
+    digest = hashlib.sha256()
+    rows = 0
+    size = 0
+    with open(path + '.tmp', 'wb') as fp:
+        for row in iter_rows(dataset, batch_size):
+            line = (json.dumps(row, ensure_ascii=False) + '\n').encode('utf-8')
+            fp.write(line)
+            digest.update(line)
+            rows += 1
+            size += len(line)
+    os.replace(path + '.tmp', path)
+    return {'file': os.path.basename(path), 'rows': rows, 'bytes': size, 'sha256': digest.hexdigest()}
+
+
+def export_task(task_name, splits=('train', 'validation'), source='hub', out_dir='.', batch_size=1000):
+    ds = load_task(task_name, source)
+    entry = {'source': source, 'splits': {}, 'missing_splits': []}
+    for split in splits:
+        if split in ds:
+            path = os.path.join(out_dir, f'p3_{task_name}_{split}.jsonl')
+            entry['splits'][split] = write_split(ds[split], path, batch_size)
+        else:
+            entry['missing_splits'].append(split)
+    return entry
+
+
 def write_to_jsonl_hub(task_name, split):
-    # Could also use ds.to_json()
-    ds = load_dataset("bigscience/P3", task_name)
-    if split in ds:
-        with jsonlines.open(f'p3_{task_name}_{split}.jsonl', mode='w') as writer:
-            for example in ds[split].select(range(len(ds[split]))):
-                writer.write({
-                    "inputs": example["inputs_pretokenized"], 
-                    "targets": example["targets_pretokenized"]
-                })
+    return export_task(task_name, [split], source='hub')
+
 
 def write_to_jsonl_disk(task_name, split):
-    ds = load_from_disk(f"{os.environ['six_ALL_CCFRSCRATCH']}/datasets/p3/{task_name}")
-    if split in ds:
-        with jsonlines.open(f'p3_{task_name}_{split}.jsonl', mode='w') as writer:
-            for example in ds[split].select(range(len(ds[split]))):
-                writer.write({
-                    "inputs": example["inputs_pretokenized"], 
-                    "targets": example["targets_pretokenized"]
-                })
-
-with multiprocessing.Pool(8) as pool:
-    pool.map(partial(write_to_jsonl_hub, split="train"), TZERO_TASK_LIST)
-    pool.map(partial(write_to_jsonl_hub, split="validation"), TZERO_TASK_LIST)
+    return export_task(task_name, [split], source='disk')
+
+
+def _export_safely(task_name, splits, source, out_dir, batch_size):
+    try:
+        return task_name, export_task(task_name, splits, source, out_dir, batch_size), None
+    except Exception as err:
+        return task_name, None, f'{type(err).__name__}: {err}'
+
+
+def load_manifest(out_dir):
+    path = os.path.join(out_dir, MANIFEST)
+    if not os.path.exists(path):
+        return {'tasks': {}}
+    with open(path) as fp:
+        return json.load(fp)
+
+
+def save_manifest(manifest, out_dir):
+    path = os.path.join(out_dir, MANIFEST)
+    with open(path + '.tmp', 'w') as fp:
+        json.dump(manifest, fp, indent=2, sort_keys=True)
+    os.replace(path + '.tmp', path)
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def is_exported(entry, splits, out_dir, verify=False):
+    # Every requested split is either missing upstream or on disk with the recorded size
+    if entry is None:
+        return False
+    for split in splits:
+        if split in entry['missing_splits']:
+            continue
+        info = entry['splits'].get(split)
+        if info is None:
+            return False
+        path = os.path.join(out_dir, info['file'])
+        if not os.path.exists(path) or os.path.getsize(path) != info['bytes']:
+            return False
+        if verify and file_sha256(path) != info['sha256']:
+            return False
+    return True
+
+
+def read_task_list(path):
+    with open(path) as fp:
+        return [line.strip() for line in fp if line.strip()]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Export P3 tasks to jsonl')
+    parser.add_argument('--tasks', default=None, help='task list file, defaults to the T0 training mixture')
+    parser.add_argument('--splits', nargs='+', default=['train', 'validation'])
+    parser.add_argument('--source', default='hub', choices=['hub', 'disk'],
+                        help='hub: load_dataset("bigscience/P3"), disk: load_from_disk copies under $six_ALL_CCFRSCRATCH')
+    parser.add_argument('--processes', default=8, type=int)
+    parser.add_argument('--out-dir', default='.')
+    parser.add_argument('--batch-size', default=1000, type=int, help='rows read per Arrow batch')
+    parser.add_argument('--force', action='store_true', help='export again tasks found in the manifest')
+    parser.add_argument('--verify', action='store_true', help='check manifest checksums before skipping a task')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    if args.tasks is None:
+        write_task_list()
+        task_list = [task_name.replace("'", "") for task_name in TZERO_TASK_LIST]
+    else:
+        task_list = read_task_list(args.tasks)
+
+    os.makedirs(args.out_dir, exist_ok=True)
+    manifest = load_manifest(args.out_dir)
+    todo = [task_name for task_name in task_list
+            if args.force or not is_exported(manifest['tasks'].get(task_name), args.splits, args.out_dir, args.verify)]
+    print(f'{len(task_list) - len(todo)} tasks already exported, {len(todo)} to export')
+
+    export = partial(_export_safely, splits=args.splits, source=args.source,
+                     out_dir=args.out_dir, batch_size=args.batch_size)
+    failed = []
+    with multiprocessing.Pool(args.processes) as pool:
+        for task_name, entry, error in pool.imap_unordered(export, todo):
+            if error is not None:
+                print(f'Exception when exporting task name: {task_name}: {error}')
+                failed.append(task_name)
+                continue
+            # Keep what earlier runs recorded for other splits
+            previous = manifest['tasks'].get(task_name, {'splits': {}, 'missing_splits': []})
+            previous['splits'].update(entry['splits'])
+            previous['missing_splits'] = sorted(set(previous['missing_splits']) - set(entry['splits'])
+                                                | set(entry['missing_splits']))
+            previous['source'] = entry['source']
+            manifest['tasks'][task_name] = previous
+            save_manifest(manifest, args.out_dir)
+            rows = {split: info['rows'] for split, info in entry['splits'].items()}
+            print(f'Exported {task_name}: {rows}')
+    if failed:
+        print(f'{len(failed)} tasks failed: {failed}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,232 @@
+import multiprocessing
+import socket
+import time
+from contextlib import contextmanager
+
+from rate_limiter import is_throttled
+
+"""
+Pool of upstream endpoints (proxies or a direct connection) for the translator.
+
+Every endpoint has its own concurrency limit and a health record kept in
+shared memory, so the workers forked after the pool is created all see the
+same state. Requests go to the healthiest endpoint with a free slot, scored
+by its moving average latency, error rate and requests in flight. Only
+successful requests count toward the latency, so a failing endpoint never
+looks fast, and an endpoint without one yet is scored as slow as the
+slowest known one once it has failed. The error rate halves every
+`error_half_life` seconds, and an endpoint left unused for `probe_interval`
+seconds gets the next request as a probe, so an endpoint that failed a few
+times is not left out for good.
+
+An endpoint that fails `eject_failures` times in a row, or whose error rate
+goes above `eject_error_rate`, is ejected for `base_ejection` seconds,
+doubled on every new ejection up to `max_ejection`. Once that time is up it
+is admitted again: one success clears its record, one more failure ejects it
+again straight away.
+
+An endpoint with a Tor control port gets a NEWNYM signal (a new circuit) when
+it is throttled, at most once per `newnym_interval` seconds.
+
+Endpoint specs on the command line are `URL[,control=[HOST:]PORT][,max=N]`,
+where URL is an HTTP proxy or `direct`.
+"""
+
+
+def tor_newnym(control, password='', timeout=5.0):
+    # Ask the Tor daemon behind `control` (host, port) for a new circuit
+    with socket.create_connection(control, timeout=timeout) as conn:
+        conn.sendall(f'AUTHENTICATE "{password}"\r\nSIGNAL NEWNYM\r\nQUIT\r\n'.encode('ascii'))
+        reply = b''
+        while reply.count(b'\r\n') < 2:
+            data = conn.recv(1024)
+            if not data:
+                break
+            reply += data
+    lines = reply.decode('ascii', 'replace').splitlines()
+    if len(lines) < 2 or not all(line.startswith('250') for line in lines[:2]):
+        raise Exception(f'Tor control port {control[0]}:{control[1]} refused NEWNYM: {reply!r}')
+
+
+class ProxyEndpoint:
+    def __init__(self, url, max_concurrency=8, control=None, password=''):
+        self.url = url
+        self.max_concurrency = max_concurrency
+        self.control = control
+        self.password = password
+        self.slots = multiprocessing.BoundedSemaphore(max_concurrency)
+        self._lock = multiprocessing.Lock()
+        self._latency = multiprocessing.Value('d', 0.0, lock=False)
+        self._samples = multiprocessing.Value('i', 0, lock=False)
+        self._error_rate = multiprocessing.Value('d', 0.0, lock=False)
+        self._error_updated = multiprocessing.Value('d', 0.0, lock=False)
+        self._requests = multiprocessing.Value('i', 0, lock=False)
+        self._last_used = multiprocessing.Value('d', 0.0, lock=False)
+        self._in_flight = multiprocessing.Value('i', 0, lock=False)
+        self._failures = multiprocessing.Value('i', 0, lock=False)
+        self._ejections = multiprocessing.Value('i', 0, lock=False)
+        self._ejected_until = multiprocessing.Value('d', 0.0, lock=False)
+        self._last_newnym = multiprocessing.Value('d', 0.0, lock=False)
+
+    def __repr__(self):
+        return f'ProxyEndpoint({self.url})'
+
+    @property
+    def proxy(self):
+        # What backends.make_backend expects
+        return 'direct' if self.url == 'direct' else self.url
+
+    def ejected(self, now=None):
+        return (now or time.monotonic()) < self._ejected_until.value
+
+    def _decayed_error_rate(self, now, half_life):
+        # Called with the lock held
+        elapsed = max(0.0, now - self._error_updated.value)
+        return self._error_rate.value * 0.5 ** (elapsed / half_life)
+
+    def score(self, now=None, half_life=30.0, fallback_latency=0.0):
+        # Lower is better; endpoints without requests yet come first
+        now = now or time.monotonic()
+        with self._lock:
+            if self._samples.value:
+                latency = self._latency.value
+            else:
+                latency = fallback_latency if self._requests.value else 0.0
+            error_rate = self._decayed_error_rate(now, half_life)
+            in_flight = self._in_flight.value
+        return latency * (1 + in_flight) / max(0.05, 1.0 - error_rate)
+
+    def stats(self, half_life=30.0):
+        with self._lock:
+            return {
+                'url': self.url,
+                'latency': self._latency.value,
+                'error_rate': self._decayed_error_rate(time.monotonic(), half_life),
+                'requests': self._requests.value,
+                'in_flight': self._in_flight.value,
+                'ejections': self._ejections.value,
+                'ejected': self.ejected(),
+            }
+
+
+def parse_endpoint(spec, max_concurrency=8, password=''):
+    url, *options = spec.split(',')
+    control = None
+    for option in options:
+        key, _, value = option.partition('=')
+        if key == 'control':
+            host, _, port = value.rpartition(':')
+            control = (host or '127.0.0.1', int(port))
+        elif key == 'max':
+            max_concurrency = int(value)
+        else:
+            raise ValueError(f'unknown proxy endpoint option: {option}')
+    return ProxyEndpoint(url, max_concurrency, control, password)
+
+
+class ProxyPool:
+    def __init__(self, endpoints, alpha=0.2, eject_failures=5, eject_error_rate=0.5, min_requests=20,
+                 base_ejection=10.0, max_ejection=300.0, newnym_interval=10.0, poll_interval=0.01,
+                 error_half_life=30.0, probe_interval=10.0):
+        if not endpoints:
+            raise ValueError('a proxy pool needs at least one endpoint')
+        self.endpoints = list(endpoints)
+        self.alpha = alpha
+        self.eject_failures = eject_failures
+        self.eject_error_rate = eject_error_rate
+        self.min_requests = min_requests
+        self.base_ejection = base_ejection
+        self.max_ejection = max_ejection
+        self.newnym_interval = newnym_interval
+        self.poll_interval = poll_interval
+        self.error_half_life = error_half_life
+        self.probe_interval = probe_interval
+
+    def acquire(self):
+        # Block until an admitted endpoint has a free slot, best score first
+        while True:
+            now = time.monotonic()
+            admitted = [endpoint for endpoint in self.endpoints if not endpoint.ejected(now)]
+            if not admitted:
+                # Everything is ejected: probe the endpoint that comes back first
+                admitted = [min(self.endpoints, key=lambda endpoint: endpoint._ejected_until.value)]
+            fallback = max((endpoint._latency.value for endpoint in self.endpoints if endpoint._samples.value),
+                           default=0.0)
+            ranked = sorted(admitted, key=lambda endpoint: endpoint.score(now, self.error_half_life, fallback))
+            # Endpoints left unused for a while get a probe first, whatever their score, longest unused first
+            probes = [(endpoint, True) for endpoint in sorted(ranked, key=lambda endpoint: endpoint._last_used.value)
+                      if now - endpoint._last_used.value >= self.probe_interval]
+            for endpoint, probe in probes + [(endpoint, False) for endpoint in ranked]:
+                if not endpoint.slots.acquire(block=False):
+                    continue
+                with endpoint._lock:
+                    if probe and now - endpoint._last_used.value < self.probe_interval:
+                        # another worker sent the probe first
+                        endpoint.slots.release()
+                        continue
+                    endpoint._in_flight.value += 1
+                    endpoint._last_used.value = now
+                return endpoint
+            time.sleep(self.poll_interval)
+
+    def release(self, endpoint, latency, error=None):
+        throttled = error is not None and is_throttled(error)
+        newnym = False
+        now = time.monotonic()
+        with endpoint._lock:
+            endpoint._in_flight.value -= 1
+            endpoint._requests.value += 1
+            failed = 1.0 if error is not None else 0.0
+            if endpoint._requests.value == 1:
+                endpoint._error_rate.value = failed
+            else:
+                error_rate = endpoint._decayed_error_rate(now, self.error_half_life)
+                endpoint._error_rate.value = error_rate + self.alpha * (failed - error_rate)
+            endpoint._error_updated.value = now
+            if error is None:
+                # A failure often returns early, its time says nothing about the endpoint's speed
+                endpoint._samples.value += 1
+                if endpoint._samples.value == 1:
+                    endpoint._latency.value = latency
+                else:
+                    endpoint._latency.value += self.alpha * (latency - endpoint._latency.value)
+                endpoint._failures.value = 0
+                endpoint._ejections.value = 0
+            else:
+                endpoint._failures.value += 1
+                if (endpoint._failures.value >= self.eject_failures
+                        or (endpoint._requests.value >= self.min_requests
+                            and endpoint._error_rate.value > self.eject_error_rate)):
+                    self._eject(endpoint, now)
+                if throttled and endpoint.control and now - endpoint._last_newnym.value >= self.newnym_interval:
+                    endpoint._last_newnym.value = now
+                    newnym = True
+        endpoint.slots.release()
+        if newnym:
+            try:
+                tor_newnym(endpoint.control, endpoint.password)
+            except Exception as err:
+                print(f'NEWNYM failed for {endpoint.url}: {err}')
+
+    def _eject(self, endpoint, now):
+        # Called with the endpoint lock held
+        duration = min(self.max_ejection, self.base_ejection * 2 ** endpoint._ejections.value)
+        endpoint._ejected_until.value = now + duration
+        endpoint._ejections.value += 1
+        # Back in half-open: a single failure after re-admission ejects it again
+        endpoint._failures.value = self.eject_failures - 1
+        endpoint._error_rate.value = min(endpoint._error_rate.value, self.eject_error_rate)
+
+    @contextmanager
+    def endpoint(self):
+        endpoint = self.acquire()
+        started = time.monotonic()
+        try:
+            yield endpoint
+        except Exception as err:
+            self.release(endpoint, time.monotonic() - started, err)
+            raise
+        self.release(endpoint, time.monotonic() - started)
+
+    def stats(self):
+        return [endpoint.stats(self.error_half_life) for endpoint in self.endpoints]
@@ -0,0 +1,131 @@
+import multiprocessing
+import random
+import time
+
+"""
+Adaptive rate limiting and retries shared by every translator worker.
+
+AdaptiveRateLimiter is a token bucket whose state lives in shared memory, so
+the workers forked after it is created all draw from the same bucket. Its
+rate follows AIMD: it grows a little after each successful call, is cut in
+half on throttling (HTTP 429) and by a fifth on other errors, at most once
+per cooldown.
+
+call_with_retries retries a failing call with exponential backoff and full
+jitter. Retries are limited per call and by a shared RetryBudget that only
+earns retries from successful calls, so an outage can't turn into a retry
+storm. A call that runs out of retries raises RetryExhausted for the caller
+to send to its failure sink.
+"""
+
+
+class RetryExhausted(Exception):
+    pass
+
+
+def is_throttled(err):
+    text = str(err)
+    return '429' in text or 'Too Many Requests' in text
+
+
+class AdaptiveRateLimiter:
+    def __init__(self, rate=5.0, min_rate=0.2, max_rate=50.0, increase=0.2, decrease=0.5,
+                 error_decrease=0.8, cooldown=2.0):
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.increase = increase
+        self.decrease = decrease
+        self.error_decrease = error_decrease
+        self.cooldown = cooldown
+        self._lock = multiprocessing.Lock()
+        self._rate = multiprocessing.Value('d', rate, lock=False)
+        self._tokens = multiprocessing.Value('d', 1.0, lock=False)
+        self._updated = multiprocessing.Value('d', time.monotonic(), lock=False)
+        self._last_cut = multiprocessing.Value('d', 0.0, lock=False)
+
+    @property
+    def rate(self):
+        return self._rate.value
+
+    def _refill(self, now):
+        # Never bank more than one second of tokens, bursts stay small
+        rate = self._rate.value
+        tokens = self._tokens.value + (now - self._updated.value) * rate
+        self._tokens.value = min(max(rate, 1.0), tokens)
+        self._updated.value = now
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._refill(now)
+                if self._tokens.value >= 1.0:
+                    self._tokens.value -= 1.0
+                    return
+                wait = (1.0 - self._tokens.value) / self._rate.value
+            time.sleep(wait)
+
+    def on_success(self):
+        with self._lock:
+            self._rate.value = min(self.max_rate, self._rate.value + self.increase)
+
+    def on_failure(self, throttled=False):
+        # Many workers see the same throttling at once, only cut once per cooldown.
+        # Throttling halves the rate, other errors cut it more gently.
+        with self._lock:
+            now = time.monotonic()
+            if now - self._last_cut.value < self.cooldown:
+                return
+            self._last_cut.value = now
+            self._refill(now)
+            factor = self.decrease if throttled else self.error_decrease
+            self._rate.value = max(self.min_rate, self._rate.value * factor)
+            self._tokens.value = min(self._tokens.value, 0.0)
+
+
+class RetryBudget:
+    # Each success deposits `ratio` of a retry, each retry withdraws one
+    def __init__(self, ratio=0.2, initial=10.0, cap=100.0):
+        self.ratio = ratio
+        self.cap = cap
+        self._lock = multiprocessing.Lock()
+        self._balance = multiprocessing.Value('d', initial, lock=False)
+
+    def deposit(self):
+        with self._lock:
+            self._balance.value = min(self.cap, self._balance.value + self.ratio)
+
+    def withdraw(self):
+        with self._lock:
+            if self._balance.value < 1.0:
+                return False
+            self._balance.value -= 1.0
+            return True
+
+
+def call_with_retries(fn, limiter=None, budget=None, retries=6, base_delay=1.0, max_delay=60.0):
+    attempt = 0
+    while True:
+        if limiter is not None:
+            limiter.acquire()
+        try:
+            result = fn()
+        except Exception as err:
+            throttled = is_throttled(err)
+            if limiter is not None:
+                limiter.on_failure(throttled)
+            attempt += 1
+            if attempt > retries:
+                raise RetryExhausted(f'gave up after {attempt} attempts: {err}') from err
+            if budget is not None and not budget.withdraw():
+                raise RetryExhausted(f'retry budget exhausted: {err}') from err
+            # Full jitter, throttled calls wait at least half of the backoff
+            delay = min(max_delay, base_delay * 2 ** attempt)
+            low = delay / 2 if throttled else 0
+            time.sleep(random.uniform(low, delay))
+        else:
+            if limiter is not None:
+                limiter.on_success()
+            if budget is not None:
+                budget.deposit()
+            return result
@@ -0,0 +1,174 @@
+import threading
+from collections import namedtuple
+from functools import partial
+from multiprocessing import Pool, Process, SimpleQueue
+
+"""
+Work-stealing scheduler for translation work units.
+
+Units are small slices of a task (`unit_size` examples). They are fed lazily
+to one shared pool queue, so an idle worker simply pulls the next unit,
+whatever task it belongs to, and one slow worker never stalls a task. The
+number of units queued or in flight is capped by `max_pending`, which keeps
+the input generator from reading far ahead of the workers. With
+`hold_results` a unit keeps its slot until the consumer calls `release()`,
+e.g. once the result has left a reorder buffer, so buffered results count too.
+
+With `unit_threads` above 1, every worker process translates that many units
+at once on its own threads, pulling them from a shared queue, so it can start
+the next unit while the requests of earlier ones are still in flight (the
+async engine). Otherwise a `multiprocessing.Pool` runs one unit per worker.
+
+Once every unit is done the workers are stopped and joined rather than
+terminated, so they exit normally and run their exit hooks (see
+`multiprocessing.util.Finalize`), e.g. the translation memory flushing its
+pending hits.
+"""
+
+# `index` numbers the units of one task, `start` is the offset of the first example.
+# `last` marks the final unit of a task, `error` a task that could not be read.
+WorkUnit = namedtuple('WorkUnit', ['task_name', 'split', 'index', 'start', 'examples', 'segmenter', 'last', 'error'],
+                      defaults=[None, False, None])
+
+
+def _call_unit(fn, unit):
+    # Errors are returned as text: exceptions from http clients often can't be pickled
+    header = unit._replace(examples=None, segmenter=None)
+    if unit.error is not None:
+        return header, None, unit.error
+    try:
+        return header, fn(unit), None
+    except Exception as err:
+        return header, None, f'{type(err).__name__}: {err}'
+
+
+def _serve_units(call, inbox, outbox, threads):
+    # Worker process of Scheduler._run_threaded: `threads` threads take units until they get None
+    def serve():
+        for unit in iter(inbox.get, None):
+            outbox.put(call(unit))
+
+    servers = [threading.Thread(target=serve) for _ in range(threads)]
+    for server in servers:
+        server.start()
+    for server in servers:
+        server.join()
+
+
+class Scheduler:
+    def __init__(self, workers=8, max_pending=None, hold_results=False, unit_threads=1):
+        self.workers = workers
+        self.unit_threads = unit_threads
+        self.max_pending = max_pending or workers * unit_threads * 4
+        self.hold_results = hold_results
+        # Changed by the pool's feeder thread and by the consumer
+        self._pending = 0
+        self._pending_lock = threading.Lock()
+        self._slots = None
+
+    @property
+    def pending(self):
+        with self._pending_lock:
+            return self._pending
+
+    def release(self, count=1):
+        for _ in range(count):
+            with self._pending_lock:
+                self._pending -= 1
+            self._slots.release()
+
+    def run(self, fn, units):
+        # Yield (unit, result, error) for every unit, in completion order.
+        # The returned unit has `examples` and `segmenter` stripped.
+        slots = self._slots = threading.BoundedSemaphore(self.max_pending)
+        stop = threading.Event()
+
+        def gated():
+            units_iter = iter(units)
+            while True:
+                # The slot is taken before the next unit is pulled: pulling one may
+                # have side effects, e.g. a coordinator lease
+                slots.acquire()
+                if stop.is_set():
+                    return
+                unit = next(units_iter, None)
+                if unit is None:
+                    return
+                with self._pending_lock:
+                    self._pending += 1
+                yield unit
+
+        run = self._run_pool if self.unit_threads == 1 else self._run_threaded
+        results = run(partial(_call_unit, fn), gated())
+        try:
+            for item in results:
+                if not self.hold_results:
+                    self.release()
+                yield item
+        finally:
+            # Unblock the feeder thread if the consumer stops early, then stop the workers
+            stop.set()
+            for _ in range(self.max_pending):
+                try:
+                    slots.release()
+                except ValueError:
+                    break
+            results.close()
+
+    def _run_pool(self, call, units):
+        pool = Pool(self.workers)
+        done = False
+        try:
+            yield from pool.imap_unordered(call, units)
+            done = True
+        finally:
+            if done:
+                pool.close()
+            else:
+                pool.terminate()
+            pool.join()
+
+    def _run_threaded(self, call, units):
+        inbox, outbox = SimpleQueue(), SimpleQueue()
+        processes = [Process(target=_serve_units, args=(call, inbox, outbox, self.unit_threads), daemon=True)
+                     for _ in range(self.workers)]
+        for process in processes:
+            process.start()
+        fed = []
+        feed_errors = []
+
+        def feed():
+            try:
+                for unit in units:
+                    fed.append(1)
+                    inbox.put(unit)
+            except Exception as err:
+                feed_errors.append(err)
+            finally:
+                # Tells the consumer how many results to wait for
+                outbox.put(None)
+
+        threading.Thread(target=feed, daemon=True).start()
+        done = False
+        try:
+            received = 0
+            fed_all = False
+            while not fed_all or received < len(fed):
+                item = outbox.get()
+                if item is None:
+                    fed_all = True
+                    if feed_errors:
+                        raise feed_errors[0]
+                    continue
+                received += 1
+                yield item
+            done = True
+        finally:
+            if done:
+                for _ in range(self.workers * self.unit_threads):
+                    inbox.put(None)
+            else:
+                for process in processes:
+                    process.terminate()
+            for process in processes:
+                process.join()
@@ -0,0 +1,172 @@
+import argparse
+import json
+import random
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+
+"""
+Local stand-in for the translation service, for offline benchmarks and tests.
+
+It speaks the JSON protocol of backends.HttpBackend and "translates" by
+upper-casing, which keeps packing delimiters and whitespace intact. Latency
+is drawn from a log-normal distribution, a share of requests fail with 500
+and requests above the configured rate get 429, like a throttling endpoint.
+Any path ending in /translate is served, so the server also works as a
+stand-in HTTP proxy that receives absolute URLs.
+
+Commands:
+python3 stub_server.py --port 8765 --latency-ms 200 --latency-sigma 0.5 --error-rate 0.01 --rate-limit 50
+python3 p3_translated.py --path file_path --backend http --backend-url http://127.0.0.1:8765/translate
+"""
+
+
+class StubState:
+    def __init__(self, latency_ms=200.0, latency_sigma=0.5, error_rate=0.0, rate_limit=0.0, seed=None):
+        self.latency_ms = latency_ms
+        self.latency_sigma = latency_sigma
+        self.error_rate = error_rate
+        self.rate_limit = rate_limit
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.tokens = max(rate_limit, 1.0)
+        self.updated = time.monotonic()
+        self.requests = 0
+        self.texts = 0
+        self.chars = 0
+        self.errors = 0
+        self.throttled = 0
+        # Service time of the last requests, for latency percentiles
+        self.latencies = deque(maxlen=100000)
+
+    def admit(self):
+        # Token bucket of `rate_limit` requests per second, 0 means unlimited
+        with self.lock:
+            self.requests += 1
+            if self.rate_limit <= 0:
+                return True
+            now = time.monotonic()
+            self.tokens = min(max(self.rate_limit, 1.0), self.tokens + (now - self.updated) * self.rate_limit)
+            self.updated = now
+            if self.tokens < 1.0:
+                self.throttled += 1
+                return False
+            self.tokens -= 1.0
+            return True
+
+    def delay(self):
+        with self.lock:
+            if self.latency_ms <= 0:
+                return 0.0
+            return self.random.lognormvariate(0, self.latency_sigma) * self.latency_ms / 1000
+
+    def fail(self):
+        with self.lock:
+            failed = self.random.random() < self.error_rate
+            if failed:
+                self.errors += 1
+            return failed
+
+    def record(self, texts, seconds):
+        with self.lock:
+            self.texts += len(texts)
+            self.chars += sum(len(text) for text in texts)
+            self.latencies.append(seconds)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'requests': self.requests,
+                'texts': self.texts,
+                'chars': self.chars,
+                'errors': self.errors,
+                'throttled': self.throttled,
+                'latencies': list(self.latencies),
+            }
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, status, payload):
+        body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        path = urlsplit(self.path).path
+        if path.endswith('/stats'):
+            self._reply(200, self.server.state.stats())
+        elif path.endswith('/health'):
+            self._reply(200, {'ok': True})
+        else:
+            self._reply(404, {'error': 'not found'})
+
+    def do_POST(self):
+        started = time.monotonic()
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        state = self.server.state
+        if not urlsplit(self.path).path.endswith('/translate'):
+            self._reply(404, {'error': 'not found'})
+            return
+        if not state.admit():
+            self._reply(429, {'error': 'Too Many Requests'})
+            return
+        time.sleep(state.delay())
+        if state.fail():
+            self._reply(500, {'error': 'injected failure'})
+            return
+        texts = json.loads(body)['q']
+        self._reply(200, {'translations': [text.upper() for text in texts]})
+        state.record(texts, time.monotonic() - started)
+
+
+def serve(host='127.0.0.1', port=0, **options):
+    # Start a stub server on a background thread, port 0 picks a free port
+    server = ThreadingHTTPServer((host, port), StubHandler)
+    server.daemon_threads = True
+    server.state = StubState(**options)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+def server_url(server, path='/translate'):
+    host, port = server.server_address[:2]
+    return f'http://{host}:{port}{path}'
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Local stand-in translation server')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', default=8765, type=int)
+    parser.add_argument('--latency-ms', default=200.0, type=float, help='median service time')
+    parser.add_argument('--latency-sigma', default=0.5, type=float, help='log-normal spread of the service time')
+    parser.add_argument('--error-rate', default=0.0, type=float, help='share of requests answered with 500')
+    parser.add_argument('--rate-limit', default=0.0, type=float, help='requests per second before 429, 0 for none')
+    parser.add_argument('--seed', default=None, type=int)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    server = serve(args.host, args.port, latency_ms=args.latency_ms, latency_sigma=args.latency_sigma,
+                   error_rate=args.error_rate, rate_limit=args.rate_limit, seed=args.seed)
+    print(f'Stub translator listening on {server_url(server)}')
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+import math
+import os
+from collections import Counter
+
+"""
+Template-aware segmentation of P3 `inputs`.
+
+Every example of a P3 task is one prompt template rendered around dataset
+fields. Diffing a sample of a task's inputs gives the constant fragments of
+that template: the common prefix, the common suffix and the lines that occur
+in (almost) every example. Those fragments are translated once per task and
+only the variable spans in between go to the translator for every example.
+"""
+
+
+def _trim_prefix(prefix):
+    # Never cut a word in half, stop at the last whitespace
+    for i in range(len(prefix) - 1, -1, -1):
+        if prefix[i].isspace():
+            return prefix[:i + 1]
+    return ''
+
+
+def _trim_suffix(suffix):
+    for i in range(len(suffix)):
+        if suffix[i].isspace():
+            return suffix[i:]
+    return ''
+
+
+def _has_words(text):
+    return any(c.isalpha() for c in text)
+
+
+def strip_parts(piece):
+    # Split a piece into (leading whitespace, core, trailing whitespace)
+    core = piece.strip()
+    if not core:
+        return piece, '', ''
+    start = piece.index(core)
+    return piece[:start], core, piece[start + len(core):]
+
+
+class TemplateSegmenter:
+    def __init__(self, prefix='', suffix='', lines=()):
+        self.prefix = prefix
+        self.suffix = suffix
+        self.lines = frozenset(lines)
+
+    def __bool__(self):
+        return bool(self.prefix or self.suffix or self.lines)
+
+    def __repr__(self):
+        return (f'TemplateSegmenter(prefix={self.prefix!r}, suffix={self.suffix!r}, '
+                f'lines={sorted(self.lines)!r})')
+
+    @classmethod
+    def fit(cls, texts, min_support=0.9, max_samples=500):
+        sample = list(texts)[:max_samples]
+        if len(sample) < 2:
+            return cls()
+
+        prefix = _trim_prefix(os.path.commonprefix(sample))
+        suffix = _trim_suffix(os.path.commonprefix([text[::-1] for text in sample])[::-1])
+        shortest = min(len(text) for text in sample)
+        if len(prefix) + len(suffix) > shortest:
+            suffix = ''
+        if not _has_words(prefix):
+            prefix = ''
+        if not _has_words(suffix):
+            suffix = ''
+
+        # Infix fragments: whole lines shared by at least `min_support` of the sample
+        counts = Counter()
+        for text in sample:
+            middle = text[len(prefix):len(text) - len(suffix)]
+            counts.update(set(line.strip() for line in middle.splitlines()))
+        needed = math.ceil(min_support * len(sample))
+        lines = [line for line, count in counts.items()
+                 if count >= needed and _has_words(line)]
+        return cls(prefix, suffix, lines)
+
+    def split(self, text):
+        # Return [(piece, is_template)] such that the pieces join back to `text`
+        pieces = []
+        head, tail = '', ''
+        if self.prefix and text.startswith(self.prefix):
+            head = self.prefix
+        if self.suffix and text.endswith(self.suffix) and len(head) + len(self.suffix) <= len(text):
+            tail = self.suffix
+        if head:
+            pieces.append((head, True))
+
+        variable = []
+        for line in text[len(head):len(text) - len(tail)].splitlines(keepends=True):
+            if line.strip() in self.lines:
+                if variable:
+                    pieces.append((''.join(variable), False))
+                    variable = []
+                pieces.append((line, True))
+            else:
+                variable.append(line)
+        if variable:
+            pieces.append((''.join(variable), False))
+
+        if tail:
+            pieces.append((tail, True))
+        return pieces
@@ -0,0 +1,35 @@
+import threading
+import time
+
+from async_engine import run_ordered
+
+
+def test_run_ordered_keeps_input_order():
+    def slow_echo(item):
+        time.sleep(0.01 * (5 - item % 5))
+        return item * 2
+
+    assert run_ordered(slow_echo, range(20), concurrency=8) == [i * 2 for i in range(20)]
+
+
+def test_concurrent_calls_share_the_request_slots():
+    lock = threading.Lock()
+    in_flight = [0]
+    peak = [0]
+
+    def request(item):
+        with lock:
+            in_flight[0] += 1
+            peak[0] = max(peak[0], in_flight[0])
+        time.sleep(0.05)
+        with lock:
+            in_flight[0] -= 1
+        return item
+
+    # four units of three requests each, like one worker translating several units at once
+    units = [threading.Thread(target=run_ordered, args=(request, range(3), 8)) for _ in range(4)]
+    for unit in units:
+        unit.start()
+    for unit in units:
+        unit.join()
+    assert peak[0] == 8
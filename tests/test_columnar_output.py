@@ -0,0 +1,75 @@
+import json
+import os
+
+import pytest
+
+from columnar_output import ShardedWriter, iter_columnar
+from p3_translated import TaskWriter
+from scheduler import WorkUnit
+
+pytest.importorskip('pyarrow')
+
+
+def record(i):
+    return {'inputs': f'vi input {i}', 'targets': f'vi target {i}', 'task': 'task'}
+
+
+def expected_row(i):
+    return dict(record(i), source_inputs=None, source_targets=None)
+
+
+@pytest.mark.parametrize('fmt', ['arrow', 'parquet'])
+def test_sharded_writer_round_trip(tmp_path, fmt):
+    path = str(tmp_path / 'out')
+    writer = ShardedWriter(path, fmt, max_shard_bytes=1, batch_rows=10)
+    for i in range(25):
+        # failed examples are rows of nulls
+        writer.write(record(i) if i != 7 else {})
+    assert writer.close({'split': 'train'}) == 25
+    with open(os.path.join(path, 'index.json')) as fp:
+        index = json.load(fp)
+    assert index['num_rows'] == 25
+    assert [(shard['filename'], shard['rows'], shard['offset']) for shard in index['shards']] == [
+        (f'data-00000-of-00003.{fmt}', 10, 0), (f'data-00001-of-00003.{fmt}', 10, 10),
+        (f'data-00002-of-00003.{fmt}', 5, 20)]
+    rows = list(iter_columnar(path))
+    assert rows[7] == {column: None for column in rows[7]}
+    assert rows[:7] + rows[8:] == [expected_row(i) for i in range(25) if i != 7]
+    assert not os.path.exists(path + '.tmp')
+
+
+def test_arrow_output_loads_with_load_from_disk(tmp_path):
+    datasets = pytest.importorskip('datasets')
+    path = str(tmp_path / 'out')
+    writer = ShardedWriter(path, 'arrow', max_shard_bytes=1, batch_rows=2)
+    for i in range(5):
+        writer.write(record(i))
+    writer.close({'split': 'train'})
+    dataset = datasets.load_from_disk(path)
+    assert dataset.num_rows == 5 and dataset[4]['inputs'] == 'vi input 4'
+
+
+def test_abort_keeps_the_previous_output(tmp_path):
+    path = str(tmp_path / 'out')
+    writer = ShardedWriter(path, 'arrow')
+    writer.write(record(0))
+    writer.close()
+    writer = ShardedWriter(path, 'arrow')
+    writer.write(record(1))
+    writer.flush()
+    writer.abort()
+    assert list(iter_columnar(path)) == [expected_row(0)]
+    assert not os.path.exists(path + '.tmp')
+
+
+def test_task_writer_keeps_the_previous_output_on_error(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / 'p3_translated_task_train.jsonl').write_text(json.dumps(record(0)) + '\n', encoding='utf-8')
+    writer = TaskWriter('task', 'train', 'jsonl')
+    writer.add(WorkUnit('task', 'train', 0, 0, None), [record(9)], None)
+    # nothing is in place until the task is complete
+    assert (tmp_path / 'p3_translated_task_train.jsonl').read_text(encoding='utf-8') == json.dumps(record(0)) + '\n'
+    writer.add(WorkUnit('task', 'train', 1, 1, None, last=True), None, 'OSError: disk full')
+    writer.close()
+    assert (tmp_path / 'p3_translated_task_train.jsonl').read_text(encoding='utf-8') == json.dumps(record(0)) + '\n'
+    assert not (tmp_path / 'p3_translated_task_train.jsonl.tmp').exists()
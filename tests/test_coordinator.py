@@ -0,0 +1,45 @@
+import json
+
+from coordinator import Coordinator
+
+
+def write_task(path, examples):
+    with open(path, 'w', encoding='utf-8') as fp:
+        for i in range(examples):
+            fp.write(json.dumps({'inputs': f'input {i}', 'targets': f'target {i}'}) + '\n')
+
+
+def test_complete_is_exactly_once_after_a_lease_expired(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    write_task('p3_task_train.jsonl', 3)
+    coordinator = Coordinator('coordinator.db')
+    assert coordinator.add_task('task', 'train', unit_size=4) == 1
+
+    first = coordinator.lease('worker-1', lease_seconds=-1)
+    # the first lease is already expired, so the same unit is leased again
+    second = coordinator.lease('worker-2', lease_seconds=600)
+    assert second['id'] == first['id'] and second['token'] == first['token'] + 1
+    assert not coordinator.heartbeat(first['id'], first['token'])
+
+    records = [{'inputs': f'a{i}', 'targets': f'b{i}'} for i in range(3)]
+    assert coordinator.complete(first['id'], first['token'], records)
+    assert not coordinator.complete(second['id'], second['token'], [{'inputs': 'x', 'targets': 'y'}] * 3)
+
+    assert [record for _, record in coordinator.results('task', 'train')] == records
+    assert coordinator.lease('worker-3') is None
+    assert [task['task'] for task in coordinator.finished()] == ['task']
+
+
+def test_fail_gives_the_unit_back_to_the_current_lease_only(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    write_task('p3_task_train.jsonl', 2)
+    coordinator = Coordinator('coordinator.db')
+    coordinator.add_task('task', 'train', unit_size=2)
+
+    first = coordinator.lease('worker-1', lease_seconds=-1)
+    second = coordinator.lease('worker-2', lease_seconds=600)
+    # a stale lease cannot give back a unit another worker holds
+    coordinator.fail(first['id'], first['token'], 'stale')
+    assert 'wait' in coordinator.lease('worker-3')
+    coordinator.fail(second['id'], second['token'], 'error')
+    assert coordinator.lease('worker-3')['id'] == first['id']
@@ -0,0 +1,100 @@
+import json
+
+import pytest
+
+import p3_translated
+from checkpoint import CheckpointJournal, checkpoint_path
+from columnar_output import ShardedWriter, columnar_path, iter_columnar
+from dead_letters import DeadLetterStore
+from p3_translated import patch_output, replay_failures
+
+
+def test_count_keeps_examples_of_different_tasks_apart(tmp_path):
+    store = DeadLetterStore(str(tmp_path / 'dead_letters.sqlite'))
+    # 'a' + 'b1' + '2' and 'ab' + '1' + '2' are the same string once concatenated
+    store.add([('a', 'b1', 2, 'inputs', 'x', None, 'Error', 'failed'),
+               ('a', 'b1', 2, 'targets', 'y', None, 'Error', 'failed'),
+               ('ab', '1', 2, 'inputs', 'x', None, 'Error', 'failed')])
+    assert store.count() == 2
+    assert store.count('a', 'b1') == 1
+    assert store.count('ab', '1') == 1
+
+
+class UpperBackend:
+    def __init__(self, failing=()):
+        self.failing = failing
+
+    def translate_batch(self, texts, src='en', dest='vi'):
+        if any(text in self.failing for text in texts):
+            raise ConnectionError('endpoint down')
+        return [text.upper() for text in texts]
+
+
+def use_backend(monkeypatch, backend):
+    monkeypatch.setattr(p3_translated, 'backend', backend)
+    monkeypatch.setattr(p3_translated, 'translation_memory', None)
+    monkeypatch.setattr(p3_translated, 'pack_chars', 0)
+    monkeypatch.setattr(p3_translated, 'max_retries', 0)
+
+
+def write_output(examples):
+    with open('p3_translated_task_train.jsonl', 'w', encoding='utf-8') as fp:
+        for i in range(examples):
+            fp.write(json.dumps({'inputs': f'vi input {i}', 'targets': f'vi target {i}'}) + '\n')
+
+
+def read_output():
+    with open('p3_translated_task_train.jsonl', encoding='utf-8') as fp:
+        return [json.loads(line) for line in fp]
+
+
+def test_patch_output_rewrites_only_the_patched_lines(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    assert patch_output('task', 'train', {0: {}}) is None
+    write_output(3)
+    assert patch_output('task', 'train', {1: {'inputs': 'X', 'targets': 'Y'}}) == 1
+    assert read_output() == [{'inputs': 'vi input 0', 'targets': 'vi target 0'}, {'inputs': 'X', 'targets': 'Y'},
+                             {'inputs': 'vi input 2', 'targets': 'vi target 2'}]
+    assert not (tmp_path / 'p3_translated_task_train.jsonl.tmp').exists()
+
+
+def test_patch_output_patches_columnar_shards(tmp_path, monkeypatch):
+    pytest.importorskip('pyarrow')
+    monkeypatch.chdir(tmp_path)
+    writer = ShardedWriter(columnar_path('task', 'train'), 'parquet', max_shard_bytes=1, batch_rows=2)
+    for i in range(4):
+        writer.write({'inputs': f'vi input {i}', 'targets': f'vi target {i}', 'task': 'task'} if i != 2 else {})
+    writer.close()
+    patch = {'inputs': 'X', 'targets': 'Y', 'source_inputs': 'x', 'source_targets': 'y'}
+    assert patch_output('task', 'train', {2: patch}) == 1
+    rows = list(iter_columnar(columnar_path('task', 'train')))
+    assert rows[2] == dict(patch, task='task')
+    assert rows[3]['inputs'] == 'vi input 3'
+
+
+def test_replay_failures_patches_the_output_and_resolves_dead_letters(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    use_backend(monkeypatch, UpperBackend(failing={'still down'}))
+    write_output(4)
+    store = DeadLetterStore(str(tmp_path / 'dead_letters.sqlite'))
+    store.add([('task', 'train', 1, 'inputs', 'input 1', None, 'Throttled', 'failed'),
+               ('task', 'train', 1, 'targets', 'target 1', 'vi target 1', None, None),
+               ('task', 'train', 3, 'inputs', 'still down', None, 'ConnectionError', 'failed'),
+               ('task', 'train', 3, 'targets', 'target 3', None, 'ConnectionError', 'failed')])
+    assert replay_failures(['task'], ['train'], store) == {'train': []}
+    output = read_output()
+    # the translation kept in the dead letter is not sent again
+    assert output[1] == {'inputs': 'INPUT 1', 'targets': 'vi target 1'}
+    assert output[3] == {'inputs': 'vi input 3', 'targets': 'vi target 3'}
+    pending = store.pending('task', 'train')
+    assert list(pending) == [3]
+    assert pending[3]['inputs'] == ('still down', None, 'ConnectionError')
+    assert pending[3]['targets'] == ('target 3', 'TARGET 3', None)
+    # --resume keeps the patched example
+    assert CheckpointJournal(checkpoint_path('task', 'train')).load() == {1: output[1]}
+
+    use_backend(monkeypatch, UpperBackend())
+    assert replay_failures(['task'], ['train'], store) == {'train': ['task']}
+    assert read_output()[3] == {'inputs': 'STILL DOWN', 'targets': 'TARGET 3'}
+    assert store.count() == 0
+    assert not (tmp_path / checkpoint_path('task', 'train')).exists()
@@ -0,0 +1,46 @@
+import p3_translated
+from long_docs import sort_by_length, split_text
+from p3_translated import translate_texts
+
+
+def test_split_text_round_trip_under_the_limit():
+    text = ('First paragraph. It has two sentences.\n\nSecond paragraph is here!\n'
+            'A line\nand averyveryveryverylongwordwithoutanybreaks at the end.  ')
+    for max_chars in (5, 12, 40, 80):
+        pieces = split_text(text, max_chars)
+        assert ''.join(pieces) == text
+        assert all(0 < len(piece) <= max_chars for piece in pieces)
+
+
+def test_split_text_prefers_paragraph_breaks():
+    text = 'One sentence. Two sentence.\n\nThree sentence.'
+    assert split_text(text, 30) == ['One sentence. Two sentence.\n\n', 'Three sentence.']
+
+
+def test_short_text_is_one_piece():
+    assert split_text('short', 100) == ['short']
+
+
+def test_sort_by_length_puts_the_longest_first():
+    assert sort_by_length(['bb', 'a', 'cccc', 'ddd']) == [2, 3, 0, 1]
+
+
+class UpperBackend:
+    def __init__(self):
+        self.sent = []
+
+    def translate_batch(self, texts, src='en', dest='vi'):
+        self.sent.extend(texts)
+        return [text.upper() for text in texts]
+
+
+def test_a_long_document_is_sent_in_pieces_and_joined_back(monkeypatch):
+    backend = UpperBackend()
+    monkeypatch.setattr(p3_translated, 'backend', backend)
+    monkeypatch.setattr(p3_translated, 'translation_memory', None)
+    monkeypatch.setattr(p3_translated, 'pack_chars', 60)
+    document = '\n\n'.join(f'Paragraph {i} has a sentence. And then another one.' for i in range(6))
+    assert translate_texts('task', [document, 'short']) == [document.upper(), 'SHORT']
+    # packed requests stay under the limit
+    assert all(len(text) <= 60 for text in backend.sent)
+    assert len(backend.sent) > 1
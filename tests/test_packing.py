@@ -0,0 +1,37 @@
+from packing import DELIMITER, can_pack, join_segments, pack_segments, split_segments
+
+
+def test_pack_split_round_trip_keeps_whitespace():
+    texts = ['  Hello there.', 'Second one\n', 'third']
+    batches = pack_segments(texts, max_chars=200)
+    assert batches == [[0, 1, 2]]
+    reply = join_segments(texts).upper()
+    assert split_segments(reply, texts) == ['  HELLO THERE.', 'SECOND ONE\n', 'THIRD']
+
+
+def test_split_tolerates_spaces_around_delimiter():
+    texts = ['a', 'b']
+    assert split_segments('x | || y', texts) == ['x', 'y']
+
+
+def test_split_returns_none_when_segment_count_changes():
+    texts = ['a', 'b', 'c']
+    assert split_segments('x' + DELIMITER + 'y', texts) is None
+
+
+def test_batches_stay_under_max_chars():
+    texts = ['x' * 40] * 10
+    batches = pack_segments(texts, max_chars=100)
+    for batch in batches:
+        assert len(join_segments([texts[i] for i in batch])) <= 100
+    assert sorted(i for batch in batches for i in batch) == list(range(10))
+
+
+def test_texts_with_bars_are_sent_alone():
+    texts = ['Choose: A |', '| B or C', 'plain', 'also plain']
+    assert not can_pack(texts[0]) and not can_pack(texts[1])
+    batches = pack_segments(texts, max_chars=200)
+    assert [0] in batches and [1] in batches
+    assert [2, 3] in batches
+    packed = [texts[i] for batch in batches if len(batch) > 1 for i in batch]
+    assert split_segments(join_segments(packed), packed) == packed
@@ -0,0 +1,28 @@
+from argparse import Namespace
+
+import pipeline
+from metrics import Progress
+
+
+class FakeSplit:
+    def __init__(self, rows):
+        self.num_rows = rows
+
+    def iter(self, batch_size):
+        for start in range(0, self.num_rows, batch_size):
+            rows = range(start, min(self.num_rows, start + batch_size))
+            yield {'inputs_pretokenized': [f'input {i}' for i in rows],
+                   'targets_pretokenized': [f'target {i}' for i in rows]}
+
+
+def test_a_missing_split_is_skipped_and_finished(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(pipeline, 'load_task', lambda task_name, source: {'train': FakeSplit(5)})
+    args = Namespace(prefetch_tasks=2, loaders=1, source='disk', keep_inputs=False, batch_size=2,
+                     unit_size=4, segment_templates=False, resume=False)
+    finished = {}
+    units = list(pipeline.pipeline_units(['taskA'], ['train', 'validation'], args, Progress(), finished))
+    assert [(unit.split, unit.start, len(unit.examples)) for unit in units] == [('train', 0, 4), ('train', 4, 1)]
+    assert finished == {'validation': {'taskA'}}
+    assert pipeline.translated_tasks('validation') == {'taskA'}
+    assert pipeline.translated_tasks('train') == set()
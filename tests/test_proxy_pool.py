@@ -0,0 +1,55 @@
+import time
+
+import pytest
+
+import stub_server
+from backends import make_backend
+from proxy_pool import ProxyEndpoint, ProxyPool
+
+
+@pytest.fixture
+def stand_ins():
+    # Two stub servers used as HTTP proxies: `failing` answers 500 until told otherwise
+    healthy = stub_server.serve(latency_ms=2, latency_sigma=0)
+    failing = stub_server.serve(latency_ms=2, latency_sigma=0, error_rate=1.0)
+    yield healthy, failing
+    for server in (healthy, failing):
+        server.shutdown()
+        server.server_close()
+
+
+def endpoint(server):
+    return ProxyEndpoint(stub_server.server_url(server, ''), max_concurrency=2)
+
+
+def test_an_endpoint_that_failed_once_gets_probed_again(stand_ins):
+    healthy, failing = stand_ins
+    pool = ProxyPool([endpoint(failing), endpoint(healthy)], error_half_life=5.0, probe_interval=1.0)
+    backend = make_backend('http', url='http://translate.invalid/translate', pool=pool)
+    with pytest.raises(Exception):
+        backend.translate_batch(['first'])
+    bad = pool.stats()[0]
+    assert bad['requests'] == 1 and bad['error_rate'] > 0.9
+    # the failure's duration is not a latency sample
+    assert bad['latency'] == 0.0
+    failing.state.error_rate = 0.0
+
+    for _ in range(5):
+        assert backend.translate_batch(['hi']) == ['HI']
+    assert pool.stats()[0]['requests'] == 1
+    time.sleep(1.0)
+    assert backend.translate_batch(['probe']) == ['PROBE']
+    stats = pool.stats()[0]
+    assert stats['requests'] == 2
+    # the successful probe lowers its error rate and gives it a latency
+    assert stats['error_rate'] < bad['error_rate'] * 0.85 and stats['latency'] > 0.0
+
+
+def test_error_rate_decays_while_an_endpoint_is_unused():
+    pool = ProxyPool([ProxyEndpoint('direct')], error_half_life=1.0)
+    proxy = pool.endpoints[0]
+    pool.release(pool.acquire(), 0.01, Exception('Unexpected status code "500"'))
+    now = time.monotonic()
+    assert proxy.score(now, 1.0, fallback_latency=0.1) == pytest.approx(0.1 / 0.05, rel=1e-3)
+    # two half-lives later a quarter of the error rate is left
+    assert proxy.score(now + 2.0, 1.0, fallback_latency=0.1) == pytest.approx(0.1 / 0.75, rel=1e-3)
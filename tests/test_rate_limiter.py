@@ -0,0 +1,96 @@
+import time
+
+import pytest
+
+import rate_limiter
+from rate_limiter import AdaptiveRateLimiter, RetryBudget, RetryExhausted, call_with_retries, is_throttled
+
+
+@pytest.fixture
+def no_sleep(monkeypatch):
+    # Record the backoff delays instead of waiting them out
+    delays = []
+    monkeypatch.setattr(rate_limiter.time, 'sleep', delays.append)
+    return delays
+
+
+class Flaky:
+    def __init__(self, failures, error='Unexpected status code "500"'):
+        self.failures = failures
+        self.error = error
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        if self.calls <= self.failures:
+            raise Exception(self.error)
+        return 'ok'
+
+
+def test_is_throttled():
+    assert is_throttled(Exception('Unexpected status code "429" from url'))
+    assert is_throttled(Exception('Too Many Requests'))
+    assert not is_throttled(Exception('Unexpected status code "500"'))
+
+
+def test_retries_until_success_with_growing_backoff(no_sleep, monkeypatch):
+    monkeypatch.setattr(rate_limiter.random, 'uniform', lambda low, high: high)
+    call = Flaky(3)
+    assert call_with_retries(call, retries=6, base_delay=1.0, max_delay=5.0) == 'ok'
+    assert call.calls == 4
+    assert no_sleep == [2.0, 4.0, 5.0]
+
+
+def test_throttled_calls_wait_at_least_half_the_backoff(no_sleep, monkeypatch):
+    monkeypatch.setattr(rate_limiter.random, 'uniform', lambda low, high: low)
+    call_with_retries(Flaky(2, 'Too Many Requests'), base_delay=1.0)
+    assert no_sleep == [1.0, 2.0]
+
+
+def test_gives_up_after_the_retries(no_sleep):
+    call = Flaky(10)
+    with pytest.raises(RetryExhausted) as raised:
+        call_with_retries(call, retries=2)
+    assert call.calls == 3
+    assert 'gave up after 3 attempts' in str(raised.value)
+
+
+def test_the_budget_stops_retries_during_an_outage(no_sleep):
+    budget = RetryBudget(ratio=0.5, initial=2.0)
+    with pytest.raises(RetryExhausted, match='retry budget exhausted'):
+        call_with_retries(Flaky(10), budget=budget, retries=6)
+    assert len(no_sleep) == 2
+    # successes earn retries back
+    for _ in range(2):
+        call_with_retries(Flaky(0), budget=budget)
+    assert budget.withdraw() and not budget.withdraw()
+
+
+def test_limiter_follows_aimd():
+    limiter = AdaptiveRateLimiter(rate=10.0, min_rate=1.0, max_rate=11.0, increase=0.5, cooldown=60.0)
+    limiter.on_success()
+    limiter.on_success()
+    limiter.on_success()
+    assert limiter.rate == 11.0
+    limiter.on_failure(throttled=True)
+    assert limiter.rate == 5.5
+    # one cut per cooldown: workers see the same throttling at once
+    limiter.on_failure(throttled=True)
+    assert limiter.rate == 5.5
+
+
+def test_other_errors_cut_the_rate_gently():
+    limiter = AdaptiveRateLimiter(rate=10.0, cooldown=0.0)
+    limiter.on_failure(throttled=False)
+    assert limiter.rate == pytest.approx(8.0)
+    limiter.on_failure(throttled=True)
+    assert limiter.rate == pytest.approx(4.0)
+
+
+def test_acquire_paces_the_calls():
+    limiter = AdaptiveRateLimiter(rate=20.0, max_rate=20.0)
+    started = time.monotonic()
+    for _ in range(6):
+        limiter.acquire()
+    # one token is banked, the other five take 1/20 s each
+    assert time.monotonic() - started >= 0.2
@@ -0,0 +1,80 @@
+import json
+
+from checkpoint import CheckpointJournal, checkpoint_path
+from p3_translated import TaskWriter, iter_units, translated_tasks
+from scheduler import WorkUnit
+
+
+def write_task(task_name, examples):
+    with open(f'p3_{task_name}_train.jsonl', 'w', encoding='utf-8') as fp:
+        for i in range(examples):
+            fp.write(json.dumps({'inputs': f'input {i}', 'targets': f'target {i}'}) + '\n')
+
+
+def record(i):
+    return {'inputs': f'vi input {i}', 'targets': f'vi target {i}'}
+
+
+def read_output():
+    with open('p3_translated_task_train.jsonl', encoding='utf-8') as fp:
+        return [json.loads(line) for line in fp]
+
+
+def test_journal_survives_a_torn_write(tmp_path):
+    journal = CheckpointJournal(str(tmp_path / 'task_train.checkpoint.jsonl'))
+    journal.open()
+    assert not (tmp_path / 'task_train.checkpoint.jsonl').exists()
+    journal.append({0: record(0), 1: record(1)})
+    journal.close()
+    with open(journal.path, 'a', encoding='utf-8') as fp:
+        fp.write('{"records": {"2": {"inpu')
+    journal.open(resume=True)
+    journal.append({3: record(3)})
+    journal.close()
+    assert journal.load() == {0: record(0), 1: record(1), 3: record(3)}
+    # a fresh run starts over
+    journal.open()
+    assert journal.load() == {}
+
+
+def test_resume_sends_journaled_examples_as_none(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    write_task('task', 5)
+    journal = CheckpointJournal(checkpoint_path('task', 'train'))
+    journal.open()
+    journal.append({1: record(1), 4: record(4)})
+    journal.close()
+    units = list(iter_units(['task'], 'train', unit_size=3, resume=True))
+    assert [unit.examples for unit in units] == [[['input 0', 'target 0'], None, ['input 2', 'target 2']],
+                                                 [['input 3', 'target 3'], None]]
+
+
+def test_task_writer_restores_journaled_records(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    writer = TaskWriter('task', 'train', 'jsonl')
+    writer.add(WorkUnit('task', 'train', 0, 0, None), [record(0), {}], None)
+    writer.add(WorkUnit('task', 'train', 1, 2, None, last=True), [record(2), record(3)], None)
+    writer.close()
+    assert read_output() == [record(0), {}, record(2), record(3)]
+    # the failed example keeps the journal around
+    assert (tmp_path / checkpoint_path('task', 'train')).exists()
+
+    # on resume only example 1 is translated again, the others come back from the journal
+    writer = TaskWriter('task', 'train', 'jsonl', resume=True)
+    writer.add(WorkUnit('task', 'train', 1, 2, None, last=True), [None, None], None)
+    writer.add(WorkUnit('task', 'train', 0, 0, None), [None, record(1)], None)
+    writer.close()
+    assert read_output() == [record(i) for i in range(4)]
+    assert not (tmp_path / checkpoint_path('task', 'train')).exists()
+
+
+def test_resume_skips_tasks_in_the_translated_list(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    write_task('done', 3)
+    write_task('todo', 3)
+    (tmp_path / 'train_translated_list.txt').write_text('done\n\n', encoding='utf-8')
+    finished = {'train': translated_tasks('train')}
+    assert finished == {'train': {'done'}}
+    units = list(iter_units(['done', 'todo'], ['train'], unit_size=2, resume=True, finished=finished))
+    assert [(unit.task_name, unit.index, unit.last) for unit in units] == [('todo', 0, False), ('todo', 1, True)]
+    assert translated_tasks('validation') == set()
@@ -0,0 +1,60 @@
+import os
+import time
+
+from p3_translated import start_with_units
+from scheduler import Scheduler, WorkUnit
+
+
+def work(unit):
+    if unit.index == 3:
+        raise ValueError('bad unit')
+    time.sleep(0.01)
+    return unit.start, os.getpid()
+
+
+def units(count):
+    for i in range(count):
+        yield WorkUnit('task', 'train', i, i * 10, [['a', 'b']])
+
+
+def test_every_unit_comes_back_once():
+    for unit_threads in (1, 4):
+        results = {unit.index: (result, error) for unit, result, error in
+                   Scheduler(2, unit_threads=unit_threads).run(work, units(20))}
+        assert sorted(results) == list(range(20))
+        assert results[3] == (None, 'ValueError: bad unit')
+        assert all(results[i][0][0] == i * 10 for i in results if i != 3)
+        # the workers are other processes
+        assert os.getpid() not in {results[i][0][1] for i in results if i != 3}
+
+
+def test_held_units_keep_their_slot_until_released():
+    scheduler = Scheduler(2, max_pending=3, hold_results=True, unit_threads=2)
+    seen = 0
+    for unit, result, error in scheduler.run(work, units(10)):
+        seen += 1
+        assert scheduler.pending <= 3
+        scheduler.release()
+    assert seen == 10 and scheduler.pending == 0
+
+
+def test_stopping_early_stops_the_workers():
+    for unit_threads in (1, 4):
+        results = Scheduler(2, unit_threads=unit_threads).run(work, units(1000))
+        next(results)
+        results.close()
+
+
+started = []
+
+
+def saw_start(unit):
+    return bool(started)
+
+
+def test_units_generator_starts_run_after_the_workers_fork():
+    for unit_threads in (1, 4):
+        started.clear()
+        units_with_start = start_with_units(units(8), [lambda: started.append(1)])
+        results = [result for _, result, _ in Scheduler(2, unit_threads=unit_threads).run(saw_start, units_with_start)]
+        assert started and results == [False] * 8
@@ -0,0 +1,46 @@
+import json
+
+from checkpoint import checkpoint_path
+from p3_translated import ReorderBuffer, TaskWriter, iter_units
+from scheduler import WorkUnit
+
+
+def unit(index, start, count, last=False):
+    return WorkUnit('task', 'train', index, start, [['in', 'out']] * count, None, last)
+
+
+def record(i):
+    return {'inputs': f'vi input {i}', 'targets': f'vi target {i}'}
+
+
+def test_reorder_buffer_releases_in_index_order():
+    buffer = ReorderBuffer()
+    assert buffer.push(2, 'c') == []
+    assert buffer.push(1, 'b') == []
+    assert len(buffer) == 2
+    assert buffer.push(0, 'a') == ['a', 'b', 'c']
+    assert buffer.push(3, 'd') == ['d']
+    assert len(buffer) == 0
+
+
+def test_units_cover_the_input_file_in_order(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    with open('p3_task_train.jsonl', 'w', encoding='utf-8') as fp:
+        for i in range(7):
+            fp.write(json.dumps({'inputs': f'input {i}', 'targets': f'target {i}'}) + '\n')
+    units = list(iter_units(['task'], 'train', unit_size=3))
+    assert [(u.index, u.start, len(u.examples), u.last) for u in units] == [(0, 0, 3, False), (1, 3, 3, False),
+                                                                           (2, 6, 1, True)]
+    assert units[2].examples == [['input 6', 'target 6']]
+
+
+def test_task_writer_writes_units_in_order(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    writer = TaskWriter('task', 'train', 'jsonl')
+    assert writer.add(unit(1, 2, 2, last=True), [record(2), record(3)], None) == 0
+    assert writer.add(unit(0, 0, 2), [record(0), record(1)], None) == 2
+    assert writer.finished
+    writer.close()
+    with open('p3_translated_task_train.jsonl', encoding='utf-8') as fp:
+        assert [json.loads(line) for line in fp] == [record(i) for i in range(4)]
+    assert not (tmp_path / checkpoint_path('task', 'train')).exists()
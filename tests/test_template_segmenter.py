@@ -0,0 +1,73 @@
+import p3_translated
+from p3_translated import translate_examples
+from template_segmenter import TemplateSegmenter, strip_parts
+
+TEXTS = [
+    'Answer the following question about this review.\nGreat phone, the battery lasts two days.\n'
+    'Is this review positive or negative?',
+    'Answer the following question about this review.\nBroke after a week.\n\nWould not buy again.\n'
+    'Is this review positive or negative?',
+    'Answer the following question about this review.\n  Works as advertised  \n'
+    'Is this review positive or negative?',
+]
+
+
+def test_fit_finds_the_template_fragments():
+    segmenter = TemplateSegmenter.fit(TEXTS)
+    assert segmenter.prefix == 'Answer the following question about this review.\n'
+    assert segmenter.suffix == '\nIs this review positive or negative?'
+
+
+def test_split_joins_back_to_the_text():
+    segmenter = TemplateSegmenter.fit(TEXTS)
+    for text in TEXTS + ['Something without the template', '', 'Answer the following question about this review.\n']:
+        pieces = segmenter.split(text)
+        assert ''.join(piece for piece, _ in pieces) == text
+    pieces = segmenter.split(TEXTS[1])
+    assert pieces[0] == (segmenter.prefix, True)
+    assert pieces[1:] == [('Broke after a week.\n\nWould not buy again.', False), (segmenter.suffix, True)]
+
+
+def test_shared_lines_are_template_pieces():
+    texts = [f'Title: {i}\nOptions:\n- yes\n- no\nBody {i}' for i in range(10)]
+    segmenter = TemplateSegmenter.fit(texts)
+    pieces = segmenter.split(texts[3])
+    assert ''.join(piece for piece, _ in pieces) == texts[3]
+    assert ('Options:\n', True) in pieces and ('- yes\n', True) in pieces
+    assert not any(is_template and '3' in piece for piece, is_template in pieces)
+
+
+def test_unrelated_texts_give_no_template():
+    assert not TemplateSegmenter.fit(['apples are red', 'the sky is blue'])
+    assert not TemplateSegmenter.fit(['only one text'])
+
+
+def test_strip_parts_keeps_the_whitespace():
+    assert strip_parts('  core text\n') == ('  ', 'core text', '\n')
+    assert strip_parts(' \n ') == (' \n ', '', '')
+
+
+class UpperBackend:
+    def __init__(self):
+        self.sent = []
+
+    def translate_batch(self, texts, src='en', dest='vi'):
+        self.sent.extend(texts)
+        return [text.upper() for text in texts]
+
+
+def test_template_fragments_are_translated_once(monkeypatch):
+    backend = UpperBackend()
+    monkeypatch.setattr(p3_translated, 'backend', backend)
+    monkeypatch.setattr(p3_translated, 'translation_memory', None)
+    monkeypatch.setattr(p3_translated, 'pack_chars', 0)
+    monkeypatch.setattr(p3_translated, 'template_translations', {})
+    segmenter = TemplateSegmenter.fit(TEXTS)
+    examples = [[text, 'positive'] for text in TEXTS]
+    assert translate_examples('task', examples, segmenter) == [[text.upper(), 'POSITIVE'] for text in TEXTS]
+    assert backend.sent.count('Answer the following question about this review.') == 1
+    assert backend.sent.count('Is this review positive or negative?') == 1
+    # a later unit of the task reuses the fragments
+    backend.sent.clear()
+    assert translate_examples('task', examples[:1], segmenter) == [[TEXTS[0].upper(), 'POSITIVE']]
+    assert backend.sent == ['Great phone, the battery lasts two days.', 'positive']
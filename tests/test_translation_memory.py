@@ -0,0 +1,21 @@
+from scheduler import Scheduler, WorkUnit
+from translation_memory import TranslationMemory
+
+memory = None
+
+
+def look_up(unit):
+    return memory.get_many([text for text, _ in unit.examples], 'en', 'vi')
+
+
+def test_hits_of_forked_workers_reach_the_store(tmp_path):
+    global memory
+    memory = TranslationMemory(str(tmp_path / 'memory.db'), flush_interval=3600)
+    memory.put_many(['hello', 'world'], ['xin chao', 'the gioi'], 'en', 'vi')
+    units = [WorkUnit('task', 'train', i, i * 3, [['hello', ''], ['world', ''], ['new', '']]) for i in range(4)]
+    results = [result for _, result, _ in Scheduler(2).run(look_up, units)]
+    results += [result for _, result, _ in Scheduler(2, unit_threads=2).run(look_up, units)]
+    assert results == [['xin chao', 'the gioi', None]] * 8
+    # nothing was flushed by the workers before they exited
+    stats = TranslationMemory(str(tmp_path / 'memory.db')).stats()
+    assert (stats['hits'], stats['misses']) == (16, 8)
@@ -0,0 +1,190 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from multiprocessing.util import Finalize
+
+"""
+On-disk translation memory shared by every worker and every run.
+
+Entries are keyed by a hash of (source text, src lang, dest lang) and stored
+in a SQLite file in WAL mode, so several Pool workers and several runs can
+read and write it at the same time. The oldest used entries are evicted once
+the store grows past `max_entries`.
+
+Lookups only read. The last-used times of the hits and the hit/miss counters
+are kept in memory and written in one transaction every `flush_interval`
+seconds (or `FLUSH_ENTRIES` hits), or along with the next `put_many`, so
+readers don't queue behind SQLite's write lock on every unit. What is left is
+written when the process exits, including a Pool worker that exits normally.
+"""
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS memory (
+    key TEXT PRIMARY KEY,
+    translation TEXT NOT NULL,
+    last_used REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS memory_last_used ON memory (last_used);
+CREATE TABLE IF NOT EXISTS stats (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+INSERT OR IGNORE INTO stats (name, value) VALUES ('hits', 0), ('misses', 0);
+"""
+
+# Only check the size cap every so many writes, counting rows is not free
+EVICT_CHECK_INTERVAL = 1000
+# Pending last-used updates that force a flush before the interval is up
+FLUSH_ENTRIES = 10000
+
+
+def memory_key(text, src, dest):
+    return hashlib.sha1(f'{src}\x00{dest}\x00{text}'.encode('utf-8')).hexdigest()
+
+
+class TranslationMemory:
+    def __init__(self, path, max_entries=5000000, timeout=60, flush_interval=30.0):
+        self.path = path
+        self.max_entries = max_entries
+        self.timeout = timeout
+        self.flush_interval = flush_interval
+        self.hits = 0
+        self.misses = 0
+        self._local = threading.local()
+        self._writes = 0
+        self._lock = threading.Lock()
+        self._exit_pid = None
+        self._reset_pending()
+        # Create the schema up front so workers only open connections
+        self._connect()
+
+    def _connect(self):
+        # A sqlite connection must not cross a fork or a thread, open one per thread
+        local = self._local
+        if getattr(local, 'conn', None) is None or local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=self.timeout)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.executescript(SCHEMA)
+            local.conn = conn
+            local.pid = os.getpid()
+        return local.conn
+
+    def _reset_pending(self):
+        # Updates not written yet, owned by one process: a forked worker starts from nothing
+        self._pending_pid = os.getpid()
+        if self._exit_pid != self._pending_pid:
+            # Finalizers are not inherited by a fork, every process registers its own
+            self._exit_pid = self._pending_pid
+            Finalize(None, self.flush, exitpriority=10)
+        self._touched = {}
+        self._pending_hits = 0
+        self._pending_misses = 0
+        self._flushed = time.monotonic()
+
+    def _write_pending(self, conn):
+        # Called inside a transaction with the lock held
+        if self._touched:
+            conn.executemany('UPDATE memory SET last_used = ? WHERE key = ?',
+                             [(used, key) for key, used in self._touched.items()])
+        if self._pending_hits:
+            conn.execute("UPDATE stats SET value = value + ? WHERE name = 'hits'", (self._pending_hits,))
+        if self._pending_misses:
+            conn.execute("UPDATE stats SET value = value + ? WHERE name = 'misses'", (self._pending_misses,))
+        self._reset_pending()
+
+    def flush(self):
+        with self._lock:
+            if self._pending_pid != os.getpid() or not (
+                    self._touched or self._pending_hits or self._pending_misses):
+                self._reset_pending()
+                return
+            conn = self._connect()
+            with conn:
+                self._write_pending(conn)
+
+    def get_many(self, texts, src, dest):
+        # Return the cached translation of each text, or None when missing
+        conn = self._connect()
+        keys = [memory_key(text, src, dest) for text in texts]
+        found = {}
+        unique_keys = list(set(keys))
+        for i in range(0, len(unique_keys), 500):
+            batch = unique_keys[i:i + 500]
+            placeholders = ','.join('?' * len(batch))
+            rows = conn.execute(
+                f'SELECT key, translation FROM memory WHERE key IN ({placeholders})', batch).fetchall()
+            found.update(rows)
+        results = [found.get(key) for key in keys]
+        hits = sum(1 for result in results if result is not None)
+        misses = len(results) - hits
+        self.hits += hits
+        self.misses += misses
+        with self._lock:
+            if self._pending_pid != os.getpid():
+                self._reset_pending()
+            now = time.time()
+            self._touched.update((key, now) for key in found)
+            self._pending_hits += hits
+            self._pending_misses += misses
+            due = (len(self._touched) >= FLUSH_ENTRIES
+                   or time.monotonic() - self._flushed >= self.flush_interval)
+        if due:
+            self.flush()
+        return results
+
+    def get(self, text, src, dest):
+        return self.get_many([text], src, dest)[0]
+
+    def put_many(self, texts, translations, src, dest):
+        conn = self._connect()
+        now = time.time()
+        rows = [(memory_key(text, src, dest), translation, now)
+                for text, translation in zip(texts, translations)]
+        with self._lock, conn:
+            conn.executemany(
+                'INSERT OR REPLACE INTO memory (key, translation, last_used) VALUES (?, ?, ?)', rows)
+            # The write lock is taken anyway, pending updates go along
+            if self._pending_pid == os.getpid():
+                self._write_pending(conn)
+            else:
+                self._reset_pending()
+        self._writes += len(rows)
+        if self._writes >= EVICT_CHECK_INTERVAL:
+            self._writes = 0
+            self.evict()
+
+    def put(self, text, translation, src, dest):
+        self.put_many([text], [translation], src, dest)
+
+    def evict(self):
+        # Drop the least recently used entries down to 90% of the cap
+        conn = self._connect()
+        with conn:
+            size = conn.execute('SELECT COUNT(*) FROM memory').fetchone()[0]
+            if size <= self.max_entries:
+                return 0
+            excess = size - int(self.max_entries * 0.9)
+            conn.execute(
+                'DELETE FROM memory WHERE key IN '
+                '(SELECT key FROM memory ORDER BY last_used LIMIT ?)', (excess,))
+        return excess
+
+    def stats(self):
+        # Counters aggregated over every process and run that used this store
+        self.flush()
+        conn = self._connect()
+        stats = dict(conn.execute('SELECT name, value FROM stats').fetchall())
+        stats['entries'] = conn.execute('SELECT COUNT(*) FROM memory').fetchone()[0]
+        total = stats['hits'] + stats['misses']
+        stats['hit_rate'] = stats['hits'] / total if total else 0.0
+        return stats
+
+    def close(self):
+        self.flush()
+        local = self._local
+        if getattr(local, 'conn', None) is not None and local.pid == os.getpid():
+            local.conn.close()
+        local.conn = None